@@ -0,0 +1,80 @@
+import json
+import re
+import time
+import zlib
+from typing import Any, List, Optional
+
+import numpy as np
+import torch
+from langchain_community.vectorstores import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+
+from postprocess import RAG
+
+ANOMALY_KEYWORDS = ('error', 'failed', 'fatal', 'panic', 'terminated', 'invalid', 'severed', 'timeout', 'exception',
+                    'assert', 'missing', 'lost', 'bad')
+QUESTION_PATTERN = re.compile(r'Input Log Template: (.*)')
+
+
+def hashed_embedding(text, dim=768):
+    """ Deterministic bag-of-words embedding: each token adds +-1 to a hashed dimension, then l2-normalized """
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in text.lower().split():
+        code = zlib.crc32(token.encode('utf-8'))
+        vector[code % dim] += 1.0 if code & 1 << 31 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def fake_encoder(dim=768):
+    """ Drop-in for the BERT encoder of BGL_Dataset, returns a callable content -> torch tensor of shape (dim,) """
+    return lambda content: torch.from_numpy(hashed_embedding(content, dim))
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words embeddings, in place of OpenAIEmbeddings."""
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [hashed_embedding(text, self.dim).tolist() for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return hashed_embedding(text, self.dim).tolist()
+
+
+class FakeJudgeLLM(LLM):
+    """Keyword-based judge returning the JSON answer format of the prompts, with an optional simulated latency."""
+
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-judge'
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        match = QUESTION_PATTERN.search(prompt)
+        question = (match.group(1) if match else prompt).lower()
+        is_anomaly = int(any(keyword in question for keyword in ANOMALY_KEYWORDS))
+        return json.dumps({'is_anomaly': is_anomaly,
+                           'reason': 'contains an error keyword' if is_anomaly else 'no error keyword'})
+
+
+class BenchmarkRAGPostProcessor(RAG.RAGPostProcessor):
+    """RAGPostProcessor backed by FakeEmbeddings, an in-memory Chroma collection and FakeJudgeLLM."""
+
+    def __init__(self, configs, train_data_path, logger, profiler=None, llm_latency=0.0, collection_name='benchmark'):
+        super().__init__(configs, train_data_path, logger, profiler=profiler)
+        self.llm_latency = llm_latency
+        self.collection_name = collection_name
+
+    def get_llm(self, llm_name):
+        return FakeJudgeLLM(latency=self.llm_latency)
+
+    def get_vectordb(self, normal_log_entries):
+        return Chroma.from_texts(texts=normal_log_entries, embedding=FakeEmbeddings(),
+                                 collection_name=self.collection_name)
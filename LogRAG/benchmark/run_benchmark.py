@@ -0,0 +1,138 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+
+import pandas as pd
+import yaml
+
+from benchmark.fakes import BenchmarkRAGPostProcessor, fake_encoder
+from benchmark.synthetic import generate_structured_logs
+from prelogad.DeepSVDD.src.datasets.main import load_dataset
+from prelogad.DeepSVDD.src.deepSVDD import DeepSVDD
+from utils.evaluator import evaluate
+from utils.profiler import StageProfiler
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+# BGL_Dataset keeps a 768-dim float32 embedding per line (about 3 KB), 1M lines need ~3 GB and 10M ~30 GB,
+# so the default run stays small and larger sizes are passed explicitly with --sizes
+DEFAULT_SIZES = [10000, 100000]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def load_profiled_dataset(profiler, data_path, encoder):
+    """ BGL_Dataset build split into clean (parse, clean, dedup) and encode (embedding of the unique logs) """
+    with profiler.stage('clean') as stage:
+        dataset = load_dataset(data_path=data_path, encoder_path=None, encoder=encoder)
+        stage.items = len(dataset.test_set)
+        stage.exclude(dataset.encode_time, dataset.encode_cpu_time)
+    profiler.add('encode', dataset.encode_time, dataset.encode_cpu_time, items=dataset.num_encoded)
+    return dataset
+
+
+def run_size(configs, args, num_lines):
+    """ Run every stage of LogRAG on num_lines synthetic logs, returns the profiler of the run """
+    profiler = StageProfiler(logger)
+    run_dir = os.path.join(args.output_dir, f'bgl-synthetic-{num_lines}')
+    os.makedirs(run_dir, exist_ok=True)
+    log_path = os.path.join(run_dir, 'log_structured.csv')
+    train_path = os.path.join(run_dir, 'train_log_structured.csv')
+    test_path = os.path.join(run_dir, 'test_log_structured.csv')
+
+    with profiler.stage('generate', items=num_lines):
+        generate_structured_logs(log_path, num_lines, num_templates=args.templates, anomaly_rate=args.anomaly_rate,
+                                 seed=args.seed)
+
+    with profiler.stage('split', items=num_lines):
+        all_df = pd.read_csv(log_path)
+        num_train = int(configs['train_ratio'] * len(all_df))
+        train_df = all_df[:num_train]
+        train_df[train_df['Label'] == '-'].to_csv(train_path, index=False)
+        all_df[num_train:].to_csv(test_path, index=False)
+        del all_df, train_df
+
+    encoder = fake_encoder()
+    train_dataset = load_profiled_dataset(profiler, train_path, encoder)
+    test_dataset = load_profiled_dataset(profiler, test_path, encoder)
+
+    deep_SVDD = DeepSVDD('soft-boundary')
+    deep_SVDD.set_network("mlp")
+    with profiler.stage('train', items=len(train_dataset.train_set) * args.epochs):
+        deep_SVDD.train(train_dataset, optimizer_name=configs['optimizer_name'], lr=configs['lr'], n_epochs=args.epochs,
+                        lr_milestones=[], batch_size=configs['batch_size'], weight_decay=configs['weight_decay'],
+                        device=configs['device'], n_jobs_dataloader=configs['n_jobs_dataloader'])
+    with profiler.stage('score', items=len(test_dataset.test_set)):
+        anomalys, _ = deep_SVDD.test(test_dataset, device=configs['device'],
+                                     n_jobs_dataloader=configs['n_jobs_dataloader'])
+        anomaly_lineid_list = [int(item[0]) for item in anomalys]
+    del train_dataset, test_dataset
+
+    anomaly_logs_path = os.path.join(run_dir, 'anomaly_logs_detc_by_svdd.csv')
+    test_df = pd.read_csv(test_path)
+    test_df[test_df['LineId'].isin(anomaly_lineid_list)].to_csv(anomaly_logs_path, index=False)
+    del test_df
+
+    # vector_db, retrieval (retrieve), llm and rag_judge (judge) stages are recorded by the post processor
+    RagPoster = BenchmarkRAGPostProcessor(configs, train_data_path=train_path, logger=logger, profiler=profiler,
+                                          llm_latency=args.llm_latency, collection_name=f'benchmark-{num_lines}')
+    anomaly_lineid_list = RagPoster.post_process(anomaly_logs_path, test_path,
+                                                 result_path=os.path.join(run_dir, 'anomaly_logs_detc_by_rag.csv'),
+                                                 answer_path=os.path.join(run_dir, 'llm_answer.json'))
+
+    with profiler.stage('evaluate', items=len(anomaly_lineid_list)):
+        metrics = evaluate(configs, test_path, anomaly_lineid_list, logger)
+    return profiler, metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every LogRAG stage on synthetic BGL-shaped logs')
+    parser.add_argument('--config', type=str, default='config.yaml', help='config file, for the model and RAG parameters')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='number of log lines per run')
+    parser.add_argument('--templates', type=int, default=400, help='number of distinct event templates')
+    parser.add_argument('--anomaly-rate', type=float, default=0.07, help='fraction of anomalous lines')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic logs')
+    parser.add_argument('--epochs', type=int, default=5, help='DeepSVDD training epochs')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='simulated seconds per LLM call')
+    parser.add_argument('--output-dir', type=str, default='./output/benchmark', help='synthetic data and results')
+    parser.add_argument('--results', type=str, default=None,
+                        help='JSON lines file the results are appended to, defaults to <output-dir>/benchmark_results.jsonl')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        configs = yaml.safe_load(file)
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_path = args.results or os.path.join(args.output_dir, 'benchmark_results.jsonl')
+    commit = git_commit()
+
+    for num_lines in args.sizes:
+        logger.info(f'Benchmarking {num_lines} lines')
+        profiler, metrics = run_size(configs, args, num_lines)
+        record = {
+            'started_at': profiler.started_at,
+            'git_commit': commit,
+            'lines': num_lines,
+            'templates': args.templates,
+            'anomaly_rate': args.anomaly_rate,
+            'seed': args.seed,
+            'epochs': args.epochs,
+            'llm_latency': args.llm_latency,
+            'stages': profiler.summary(),
+            'metrics': metrics,
+        }
+        # one JSON object per line, so runs over time can be appended and compared
+        with open(results_path, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+        logger.info(f'Appended {num_lines} lines results to {results_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# vocabulary of the synthetic templates, taken from BGL messages
+NORMAL_WORDS = ['generating', 'floating', 'point', 'alignment', 'exceptions', 'double-hummer', 'instruction', 'cache',
+                'parity', 'corrected', 'total', 'interrupts', 'critical', 'input', 'microseconds', 'spent', 'handler',
+                'calls', 'maximum', 'time', 'single', 'instance', 'correctable', 'ddr', 'sym', 'mask', 'iar', 'dear',
+                'ciod', 'core', 'files', 'program', 'node', 'card', 'midplane', 'switch', 'link', 'torus', 'receiver',
+                'sender', 'status', 'ok', 'started', 'finished', 'job', 'block', 'boot', 'memory', 'rank', 'signal']
+ANOMALY_WORDS = ['error', 'failed', 'fatal', 'panic', 'terminated', 'invalid', 'severed', 'timeout', 'interrupt',
+                 'storage', 'tlb', 'assert', 'missing', 'lost', 'bad', 'stopping', 'execution', 'exception']
+ANOMALY_LABELS = ['KERNDTLB', 'KERNSTOR', 'APPREAD', 'APPCHILD', 'KERNRTSP', 'KERNTERM', 'APPSEV', 'KERNMNTF']
+NORMAL_COMPONENTS = ['KERNEL', 'KERNEL', 'KERNEL', 'APP', 'DISCOVERY', 'MMCS']
+ANOMALY_COMPONENTS = ['KERNEL', 'APP']
+
+# 2005-06-03 15:42:50, the first BGL log
+BGL_START_TIME = 1117838570
+
+COLUMNS = ['LineId', 'Label', 'Timestamp', 'Date', 'Node', 'Time', 'NodeRepeat', 'Type', 'Component', 'Level',
+           'Content', 'EventId', 'EventTemplate', 'ParameterList']
+
+
+def make_templates(num_templates, anomaly_template_ratio=0.1, seed=0):
+    """ Build num_templates BGL-like event templates
+    Returns
+    -------
+    pd.DataFrame with EventTemplate, EventId, is_anomaly, Label, Component and Level columns
+    """
+    rng = np.random.default_rng(seed)
+    num_anomaly = max(1, int(round(num_templates * anomaly_template_ratio)))
+    templates = set()
+    rows = []
+    while len(rows) < num_templates:
+        is_anomaly = len(rows) < num_anomaly
+        words = list(rng.choice(NORMAL_WORDS, size=rng.integers(3, 9)))
+        if is_anomaly:
+            words[rng.integers(len(words))] = rng.choice(ANOMALY_WORDS)
+        # parameters become <*> in the template, like Drain does
+        for _ in range(rng.integers(0, 4)):
+            words.insert(rng.integers(len(words) + 1), '<*>')
+        template = ' '.join(words)
+        if template in templates:
+            continue
+        templates.add(template)
+        rows.append({
+            'EventTemplate': template,
+            'EventId': format(zlib.crc32(template.encode('utf-8')), '08x'),
+            'is_anomaly': is_anomaly,
+            'Label': rng.choice(ANOMALY_LABELS) if is_anomaly else '-',
+            'Component': rng.choice(ANOMALY_COMPONENTS if is_anomaly else NORMAL_COMPONENTS),
+            'Level': 'FATAL' if is_anomaly else 'INFO',
+        })
+    return pd.DataFrame(rows)
+
+
+def _fill_templates(templates, parameters):
+    """ Replace every <*> of each template by the next parameter of its row """
+    contents, parameter_lists = [], []
+    for template, params in zip(templates, parameters):
+        parts = template.split('<*>')
+        used = params[:len(parts) - 1]
+        contents.append(''.join(part + value for part, value in zip(parts, used + [''])))
+        parameter_lists.append(str(used))
+    return contents, parameter_lists
+
+
+def generate_chunk(templates, start_line, num_lines, start_time, anomaly_rate, rng):
+    """ Generate num_lines structured logs, returns the DataFrame and the time of its last log """
+    anomaly_idx = np.flatnonzero(templates['is_anomaly'].to_numpy())
+    normal_idx = np.flatnonzero(~templates['is_anomaly'].to_numpy())
+
+    # template popularity is heavy tailed, as in real logs
+    normal_weights = 1.0 / np.arange(1, len(normal_idx) + 1) ** 1.1
+    anomaly_weights = 1.0 / np.arange(1, len(anomaly_idx) + 1) ** 1.1
+    is_anomaly = rng.random(num_lines) < anomaly_rate
+    template_idx = np.where(is_anomaly,
+                            rng.choice(anomaly_idx, size=num_lines, p=anomaly_weights / anomaly_weights.sum()),
+                            rng.choice(normal_idx, size=num_lines, p=normal_weights / normal_weights.sum()))
+    chunk_templates = templates.iloc[template_idx].reset_index(drop=True)
+
+    timestamps = start_time + np.cumsum(rng.exponential(0.05, size=num_lines)).astype(np.int64)
+    times = pd.to_datetime(timestamps, unit='s')
+    micros = rng.integers(0, 1000000, size=num_lines)
+    nodes = pd.Series(['R%02d-M%d-N%X-C:J%02d-U%02d' % node for node in zip(
+        rng.integers(0, 80, num_lines), rng.integers(0, 2, num_lines), rng.integers(0, 16, num_lines),
+        rng.integers(2, 18, num_lines), rng.integers(1, 12, num_lines))])
+
+    values = rng.integers(0, 10 ** 7, size=(num_lines, 3))
+    parameters = [[str(v) for v in row] for row in values.tolist()]
+    contents, parameter_lists = _fill_templates(chunk_templates['EventTemplate'].tolist(), parameters)
+
+    chunk = pd.DataFrame({
+        'LineId': np.arange(start_line, start_line + num_lines),
+        'Label': chunk_templates['Label'],
+        'Timestamp': timestamps,
+        'Date': times.strftime('%Y.%m.%d'),
+        'Node': nodes,
+        'Time': times.strftime('%Y-%m-%d-%H.%M.%S.') + pd.Series(micros).map('{:06d}'.format),
+        'NodeRepeat': nodes,
+        'Type': 'RAS',
+        'Component': chunk_templates['Component'],
+        'Level': chunk_templates['Level'],
+        'Content': contents,
+        'EventId': chunk_templates['EventId'],
+        'EventTemplate': chunk_templates['EventTemplate'],
+        'ParameterList': parameter_lists,
+    }, columns=COLUMNS)
+    return chunk, int(timestamps[-1]) if num_lines else start_time
+
+
+def generate_structured_logs(output_path, num_lines, num_templates=400, anomaly_rate=0.07,
+                             anomaly_template_ratio=0.1, seed=0, chunk_size=1000000):
+    """ Write num_lines BGL-shaped structured logs (same columns as BGL.log_structured.csv) to output_path
+
+    The file is written chunk by chunk, so memory stays bounded for 10M+ lines, and the same
+    arguments always produce the same file.
+    """
+    rng = np.random.default_rng(seed)
+    templates = make_templates(num_templates, anomaly_template_ratio=anomaly_template_ratio, seed=seed)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    current_time = BGL_START_TIME
+    for start in range(0, num_lines, chunk_size):
+        size = min(chunk_size, num_lines - start)
+        chunk, current_time = generate_chunk(templates, start + 1, size, current_time, anomaly_rate, rng)
+        chunk.to_csv(output_path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+    return output_path
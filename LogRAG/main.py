@@ -9,6 +9,7 @@ import logging
 from postprocess import RAG
 import yaml
 from utils.evaluator import evaluate
+from utils.profiler import StageProfiler
 import torch
 
 with open('config.yaml', 'r') as file:
@@ -32,59 +33,87 @@ file_handler.setLevel(logging.INFO)
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 
-def train_deepsvdd(train_data_path):
-    if not os.path.exists('./output'):
-        os.makedirs('./output')
+# per-stage timing and memory, saved next to results.json
+profiler = StageProfiler(logger, hook=configs.get('profile_hook'), profile_dir=os.path.join(output_dir, 'profile'))
+
+def split_dataset(configs, train_log_structed_path, test_log_structed_path):
+    with profiler.stage('split') as stage:
+        all_df = pd.read_csv(configs['log_structed_path'])
+        num_train = int(configs['train_ratio']*len(all_df))
+
+        train_df = all_df[:num_train]
+        train_df = train_df[train_df['Label'] == '-']
+        test_df = all_df[num_train:]
+
+        train_df.to_csv(train_log_structed_path, index=False)
+        test_df.to_csv(test_log_structed_path, index=False)
+        stage.items = len(all_df)
+    return train_log_structed_path, test_log_structed_path
+
+def profiled_load_dataset(data_path, encoder_path):
+    with profiler.stage('dataset_build') as stage:
+        dataset = load_dataset(data_path=data_path, encoder_path=encoder_path)
+        stage.items = len(dataset.test_set)
+        stage.exclude(dataset.encode_time, dataset.encode_cpu_time)
+    profiler.add('encode', dataset.encode_time, dataset.encode_cpu_time, items=dataset.num_encoded)
+    return dataset
+
+def train_deepsvdd(configs, train_data_path, output_dir=output_dir):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
     
     deep_SVDD = DeepSVDD('soft-boundary')
     deep_SVDD.set_network("mlp")
     
+    model_path = os.path.join(output_dir, 'model.tar')
     if not configs['is_train']:
-        deep_SVDD.load_model(model_path='./output/model.tar', load_ae=False)
-        logger.info('Loading model from ./output/model.tar' )
+        deep_SVDD.load_model(model_path=model_path, load_ae=False)
+        logger.info(f'Loading model from {model_path}')
     else :
         # dataloader 
-        train_dataset = load_dataset(data_path=train_data_path, encoder_path=configs['encoder_path'])
+        train_dataset = profiled_load_dataset(data_path=train_data_path, encoder_path=configs['encoder_path'])
         # pretrain and train 
         if configs['is_pretrain']:
-            deep_SVDD.pretrain( train_dataset,
-                                optimizer_name=configs['optimizer_name'],
-                                lr=configs['lr'],
-                                n_epochs=configs['n_epochs'],
-                                lr_milestones=configs['lr_milestones'],
-                                batch_size=configs['batch_size'],
-                                weight_decay=configs['weight_decay'],
-                                device=configs['device'],
-                                n_jobs_dataloader=configs['n_jobs_dataloader'])
-        deep_SVDD.train(train_dataset,
-                        optimizer_name=configs['optimizer_name'],  
-                        lr=configs['lr'],  
-                        n_epochs=configs['n_epochs'],  
-                        lr_milestones=configs['lr_milestones'],  
-                        batch_size=configs['batch_size'],  
-                        weight_decay=configs['weight_decay'],  
-                        device=configs['device'],  
-                        n_jobs_dataloader=configs['n_jobs_dataloader'])  
+            with profiler.stage('pretrain', items=len(train_dataset.train_set)):
+                deep_SVDD.pretrain( train_dataset,
+                                    optimizer_name=configs['optimizer_name'],
+                                    lr=configs['lr'],
+                                    n_epochs=configs['n_epochs'],
+                                    lr_milestones=configs['lr_milestones'],
+                                    batch_size=configs['batch_size'],
+                                    weight_decay=configs['weight_decay'],
+                                    device=configs['device'],
+                                    n_jobs_dataloader=configs['n_jobs_dataloader'])
+        with profiler.stage('train', items=len(train_dataset.train_set)):
+            deep_SVDD.train(train_dataset,
+                            optimizer_name=configs['optimizer_name'],  
+                            lr=configs['lr'],  
+                            n_epochs=configs['n_epochs'],  
+                            lr_milestones=configs['lr_milestones'],  
+                            batch_size=configs['batch_size'],  
+                            weight_decay=configs['weight_decay'],  
+                            device=configs['device'],  
+                            n_jobs_dataloader=configs['n_jobs_dataloader'])  
     # Save results, model, and configuration
-    model_path = './output/model.tar'
-    deep_SVDD.save_results(export_json='./output/results.json')
-    deep_SVDD.save_model(export_model= './output/model.tar', save_ae=False)
+    deep_SVDD.save_results(export_json=os.path.join(output_dir, 'results.json'))
+    deep_SVDD.save_model(export_model=model_path, save_ae=False)
     return model_path
 
-def anomaly_detection(model_path, test_data_path):
+def anomaly_detection(configs, model_path, test_data_path, output_dir=output_dir):
     logger.info("start testing....")
     
     deep_SVDD = DeepSVDD('soft-boundary')
     deep_SVDD.set_network("mlp")
     deep_SVDD.load_model(model_path=model_path, load_ae=False)
-    logger.info('Loading model from ./output/model.tar' )
+    logger.info(f'Loading model from {model_path}')
     
-    test_dataset = load_dataset(data_path=test_data_path, encoder_path=configs['encoder_path'])
-    anomalys, _ = deep_SVDD.test(test_dataset, device='cpu', n_jobs_dataloader=configs['n_jobs_dataloader'])   
+    test_dataset = profiled_load_dataset(data_path=test_data_path, encoder_path=configs['encoder_path'])
+    with profiler.stage('score', items=len(test_dataset.test_set)):
+        anomalys, _ = deep_SVDD.test(test_dataset, device='cpu', n_jobs_dataloader=configs['n_jobs_dataloader'])   
 
     anomaly_lineid_list = [item[0] for item in tqdm(anomalys, desc='saving anomaly LineIds to list')]
    
-    output_file = 'output/anomaly_logs_detc_by_svdd.csv'
+    output_file = os.path.join(output_dir, 'anomaly_logs_detc_by_svdd.csv')
     # 保存deepsvdd检测为异常的
     df_test = pd.read_csv(test_data_path)
     
@@ -96,31 +125,28 @@ def anomaly_detection(model_path, test_data_path):
 
 def main():
     logger.info(configs)
-    all_df = pd.read_csv(configs['log_structed_path'])
-    num_train = int(configs['train_ratio']*len(all_df))
-
-    train_df = all_df[:num_train]
-    train_df = train_df[train_df['Label'] == '-']
-    test_df = all_df[num_train:]
-    
     
     train_log_structed_path = f"./dataset/{configs['dataset_name']}/train_log_structured.csv"
     test_log_structed_path = f"./dataset/{configs['dataset_name']}/test_log_structured.csv"
-
-    train_df.to_csv(train_log_structed_path, index=False)
-    test_df.to_csv(test_log_structed_path, index=False)
+    split_dataset(configs, train_log_structed_path, test_log_structed_path)
     
     # train deepsvdd, get log token embeddings
-    model_path = train_deepsvdd(train_log_structed_path)
+    model_path = train_deepsvdd(configs, train_log_structed_path)
     # do anomaly detection
-    anomaly_logs_path, anomaly_lineid_list = anomaly_detection(model_path, test_log_structed_path)
+    anomaly_logs_path, anomaly_lineid_list = anomaly_detection(configs, model_path, test_log_structed_path)
     
     # rag postporcessing, get log templates embeddings
     if configs['is_rag']:
-        RagPoster = RAG.RAGPostProcessor(configs, train_data_path=train_log_structed_path, logger=logger)
+        RagPoster = RAG.RAGPostProcessor(configs, train_data_path=train_log_structed_path, logger=logger, profiler=profiler)
         anomaly_lineid_list = RagPoster.post_process(anomaly_logs_path, test_log_structed_path)
     # print final results
-    evaluate(configs, test_log_structed_path, anomaly_lineid_list, logger)
+    with profiler.stage('evaluate'):
+        evaluate(configs, test_log_structed_path, anomaly_lineid_list, logger)
+
+    profiler.check_regressions(configs.get('profile_baseline', os.path.join(output_dir, 'profile_baseline.json')),
+                               tolerance=configs.get('profile_tolerance', 0.2),
+                               update_baseline=configs.get('profile_update_baseline', False))
+    profiler.save(os.path.join(output_dir, 'profile.json'))
     
 
 if __name__ == '__main__':
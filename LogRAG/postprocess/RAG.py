@@ -15,11 +15,58 @@ import json
 from openai import OpenAI
 import numpy as np
 from postprocess.prompts import prompt1, prompt2, prompt3, prompt4, prompt5
+from postprocess.stream_judge import StreamJudge
 import importlib
+import time
 import torch, gc
+from langchain.callbacks.base import BaseCallbackHandler
+from utils.profiler import StageProfiler
+
+
+class TimingCallback(BaseCallbackHandler):
+    """Sums the wall time langchain spends in retrievers and LLM calls."""
+
+    def __init__(self):
+        self.start_times = {}
+        self.totals = {'retrieval': 0.0, 'llm': 0.0}
+        self.counts = {'retrieval': 0, 'llm': 0}
+
+    def _start(self, run_id):
+        self.start_times[run_id] = time.perf_counter()
+
+    def _end(self, kind, run_id):
+        start_time = self.start_times.pop(run_id, None)
+        if start_time is not None:
+            self.add(kind, time.perf_counter() - start_time)
+
+    def add(self, kind, seconds):
+        self.totals[kind] += seconds
+        self.counts[kind] += 1
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end('retrieval', run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end('retrieval', run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end('llm', run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end('llm', run_id)
+
 
 class RAGPostProcessor:
-    def __init__(self, configs, train_data_path, logger):
+    def __init__(self, configs, train_data_path, logger, profiler=None):
         self.train_data_path = train_data_path
         self.llm_name = configs['llm_name']
         self.threshold = configs['threshold']
@@ -28,8 +75,20 @@ class RAGPostProcessor:
         self.api_base = configs['api_base']
         self.persist_directory = configs['persist_directory']
         self.device = configs['device']
-        self.prompt = self._import_prompt(configs['prompt'])
+        self.prompt_name = configs['prompt']
+        self.prompt = self._import_prompt(self.prompt_name)
+        # stream the judge answer and stop once the verdict and a bounded reason have arrived
+        self.stream_judge = configs.get('stream_judge', False)
+        self.stream_stop_early = configs.get('stream_stop_early', True)
+        self.max_reason_chars = configs.get('max_reason_chars', 200)
+        # auto-decision band on the top-1 similarity to the known normal templates, None disables a bound:
+        # at or above auto_normal_threshold the template is normal, with no neighbour at or above
+        # auto_anomaly_threshold it is an anomaly, in both cases without asking the LLM
+        self.auto_normal_threshold = configs.get('auto_normal_threshold')
+        self.auto_anomaly_threshold = configs.get('auto_anomaly_threshold')
+        self.auto_decision = self.auto_normal_threshold is not None or self.auto_anomaly_threshold is not None
         self.logger = logger
+        self.profiler = profiler if profiler is not None else StageProfiler(logger)
 
     def _import_prompt(self, prompt_name):
         # 动态导入 postprocess.prompts 模块
@@ -61,6 +120,60 @@ class RAGPostProcessor:
         content = chat_completion.choices[0].message.content
         return content 
 
+    def get_stream_judge(self):
+        return StreamJudge(self.api_base, self.api_key, self.llm_name,
+                           max_reason_chars=self.max_reason_chars, stop_early=self.stream_stop_early)
+
+    def search(self, vector_db, test_log, timing):
+        """ Top-k known normal templates with their relevance scores, on the scale of the retriever score_threshold """
+        retrieval_start = time.perf_counter()
+        results = vector_db.similarity_search_with_relevance_scores(test_log, k=self.topk)
+        timing.add('retrieval', time.perf_counter() - retrieval_start)
+        return [doc for doc, _ in results], [float(score) for _, score in results]
+
+    def auto_answer(self, test_log, documents, scores):
+        """ Answer of the auto-decision band, None when the template has to go to the LLM """
+        top_score = scores[0] if scores else None
+        if self.auto_normal_threshold is not None and top_score is not None and top_score >= self.auto_normal_threshold:
+            is_anomaly = 0
+            reason = (f"auto: top-1 similarity {top_score:.4f} >= {self.auto_normal_threshold} "
+                      f"with known normal template: {documents[0].page_content}")
+        elif self.auto_anomaly_threshold is not None and (top_score is None or top_score < self.auto_anomaly_threshold):
+            is_anomaly = 1
+            reason = (f"auto: no known normal template with similarity >= {self.auto_anomaly_threshold} "
+                      f"(top-1 {'none' if top_score is None else f'{top_score:.4f}'})")
+        else:
+            return None
+        self.logger.info(f"Auto decision is_anomaly={is_anomaly} without LLM for template: {test_log} | {reason}")
+        return {'query': test_log, 'result': json.dumps({'is_anomaly': is_anomaly, 'reason': reason}),
+                'source_documents': documents[:1], 'auto_decision': True, 'top1_score': top_score}
+
+    def answer(self, llm, judge, vector_db, prompt_template, test_log, timing):
+        """ Same answer as the RetrievalQA 'stuff' chain, with one search shared by the auto-decision band and
+        the prompt context; the LLM call is streamed through judge when stream_judge is set
+        """
+        documents, scores = self.search(vector_db, test_log, timing)
+        if self.auto_decision:
+            answer = self.auto_answer(test_log, documents, scores)
+            if answer is not None:
+                return answer
+        # the prompt context is what the 'thr' retriever returns
+        context = [doc for doc, score in zip(documents, scores) if score >= self.threshold]
+        prompt = prompt_template.format(context="\n\n".join(doc.page_content for doc in context), question=test_log)
+        answer = {'query': test_log, 'source_documents': context, 'auto_decision': False,
+                  'top1_score': scores[0] if scores else None}
+        if judge is None:
+            llm_start = time.perf_counter()
+            response = llm.invoke(prompt)
+            timing.add('llm', time.perf_counter() - llm_start)
+            answer['result'] = getattr(response, 'content', response)
+            return answer
+        judged = judge.judge(prompt)
+        timing.add('llm', judged['latency'])
+        answer.update({'result': judged['result'], 'content': judged['content'], 'latency': judged['latency'],
+                       'first_token_latency': judged['first_token_latency'],
+                       'completion_tokens': judged['completion_tokens'], 'stopped_early': judged['stopped_early']})
+        return answer
 
     def get_vectordb(self, normal_log_entries):
         # 做成Embedding存入到Vector db
@@ -96,10 +209,9 @@ class RAGPostProcessor:
                         search_kwargs={"k": 5}
                     )
         elif retriever_type == "thr":
-            if self.prompt == "prompt3":
+            # prompt3 is written for a single known normal template
+            if self.prompt_name == "prompt3":
                 self.topk = 1
-            else:
-                self.topk = 5
             retriever = vectordb.as_retriever(
                         search_type="similarity_score_threshold", 
                         search_kwargs={"score_threshold": self.threshold, "k":self.topk}
@@ -144,23 +256,45 @@ class RAGPostProcessor:
         normal_log_entries = train_df['EventTemplate'].unique().tolist()
         return normal_log_entries
 
-    def post_process(self, anomaly_logs_path, test_data_path):
-        result_path = 'output/anomaly_logs_detc_by_rag.csv'        
-        answer_path = 'output/llm_answer.json'
-        
+    def log_stream_summary(self, answer_list):
+        latencies = [answer['latency'] for answer in answer_list]
+        first_tokens = [answer['first_token_latency'] for answer in answer_list if answer['first_token_latency'] is not None]
+        tokens = [answer['completion_tokens'] for answer in answer_list]
+        stopped = sum(answer['stopped_early'] for answer in answer_list)
+        self.logger.info(f"Stream judge: {len(answer_list)} templates, mean latency {np.mean(latencies):.3f}s, "
+                         f"mean first token {np.mean(first_tokens) if first_tokens else 0:.3f}s, "
+                         f"mean completion tokens {np.mean(tokens):.1f}, stopped early {stopped}")
+
+    def log_auto_summary(self, answer_list):
+        auto = [answer for answer in answer_list if answer.get('auto_decision')]
+        anomalies = sum(json.loads(answer['result'])['is_anomaly'] for answer in auto)
+        self.logger.info(f"Auto decision band: {len(auto)}/{len(answer_list)} templates decided without LLM "
+                         f"({len(auto) - anomalies} normal, {anomalies} anomaly)")
+
+    def post_process(self, anomaly_logs_path, test_data_path, result_path='output/anomaly_logs_detc_by_rag.csv',
+                     answer_path='output/llm_answer.json', vector_db=None):
         QA_CHAIN_PROMPT = PromptTemplate.from_template(template=self.prompt)
-        normal_log_entries = self.get_normal_log_entries()
-        self.logger.info(f"Normal log templates to embedding: , {len(normal_log_entries)}")
-        vector_db = self.get_vectordb(normal_log_entries)
+        # vector_db can be shared by several post processors built on the same train data
+        if vector_db is None:
+            normal_log_entries = self.get_normal_log_entries()
+            self.logger.info(f"Normal log templates to embedding: , {len(normal_log_entries)}")
+            with self.profiler.stage('vector_db', items=len(normal_log_entries)):
+                vector_db = self.get_vectordb(normal_log_entries)
         retriever = self.get_retriever("thr", vector_db)
-        qa_chain = RetrievalQA.from_chain_type(
-                        self.get_llm(self.llm_name),
-                        chain_type='stuff',
-                        retriever= retriever,
-                        return_source_documents=True,
-                        # verbose=True,
-                        chain_type_kwargs={"prompt": QA_CHAIN_PROMPT}
-                    )
+        llm, judge = None, None
+        if self.stream_judge:
+            judge = self.get_stream_judge()
+        elif self.auto_decision:
+            llm = self.get_llm(self.llm_name)
+        else:
+            qa_chain = RetrievalQA.from_chain_type(
+                            self.get_llm(self.llm_name),
+                            chain_type='stuff',
+                            retriever= retriever,
+                            return_source_documents=True,
+                            # verbose=True,
+                            chain_type_kwargs={"prompt": QA_CHAIN_PROMPT}
+                        )
         pos_df = pd.read_csv(anomaly_logs_path)
         test_df = pd.read_csv(test_data_path)
  
@@ -171,50 +305,66 @@ class RAGPostProcessor:
 
         df_result = pd.DataFrame(columns=['is_anomaly', f'frequency_inpos', 'frequency_intest', 'EventTemplate', 'reason', 'topk_similary_log_list'])
 
-        answer_list = []
+        # retrieval and LLM time are reported as stages of their own, rag_judge keeps the rest
+        timing = TimingCallback()
+        with self.profiler.stage('rag_judge', items=len(pos_log_templates)) as stage:
+            answer_list = []
         
-        for test_log in tqdm(pos_log_templates):
+            for test_log in tqdm(pos_log_templates):
 
-            answer = qa_chain.invoke({"query": test_log})
-            # 提取每个Document对象的page_content
-            answer['source_documents'] = [doc.page_content for doc in answer['source_documents']]
+                if self.stream_judge or self.auto_decision:
+                    answer = self.answer(llm, judge, vector_db, QA_CHAIN_PROMPT, test_log, timing)
+                else:
+                    answer = qa_chain.invoke({"query": test_log}, config={"callbacks": [timing]})
+                # 提取每个Document对象的page_content
+                answer['source_documents'] = [doc.page_content for doc in answer['source_documents']]
             
-            topk_similary_log_list = answer['source_documents']
-            answer_list.append(answer)
+                topk_similary_log_list = answer['source_documents']
+                answer_list.append(answer)
             
-            content = answer['result']
-            try:
-                result = json.loads(content)
-            except Exception as e:
-                self.logger.info('---begin---')
-                self.logger.info(e)
-                self.logger.info(content)
-                self.logger.info('---end-----')
-                prompt = "Please keep only the Json part of the following content, and fill the is_anomaly into the \'is_anomaly\', \
+                content = answer['result']
+                try:
+                    result = json.loads(content)
+                except Exception as e:
+                    self.logger.info('---begin---')
+                    self.logger.info(e)
+                    self.logger.info(content)
+                    self.logger.info('---end-----')
+                    prompt = "Please keep only the Json part of the following content, and fill the is_anomaly into the \'is_anomaly\', \
                 fill the reason into the \'reason\' field of the json. The returned content only needs a string in json format, Input:\n\n"
-                prompt_content = prompt + content      
-                content = self.ask_ChatGPT(prompt_content)
-                self.logger.info("regenerate: "  + content)
-                result = json.loads(content)
-            # 提取is_anomaly和reason
-            is_anomaly = result['is_anomaly']
-            try:
-                reason = result['reason']
-            except:
-                reason = "None"
-            # 将数据追加到DataFrame
-            df_result = pd.concat([ df_result, 
-                                    pd.DataFrame({
-                                        'is_anomaly':[is_anomaly],
-                                        'frequency_inpos':[int(pos_event_template_counts[test_log])],
-                                        'frequency_intest':[int(test_event_template_counts[test_log])],
-                                        'EventTemplate': [test_log], 
-                                        'reason': [reason],
-                                        'topk_similary_log_list': [topk_similary_log_list]
-                                        })
-                                ], ignore_index=True)
+                    prompt_content = prompt + content      
+                    regenerate_start = time.perf_counter()
+                    content = self.ask_ChatGPT(prompt_content)
+                    timing.add('llm', time.perf_counter() - regenerate_start)
+                    self.logger.info("regenerate: "  + content)
+                    result = json.loads(content)
+                # 提取is_anomaly和reason
+                is_anomaly = result['is_anomaly']
+                try:
+                    reason = result['reason']
+                except:
+                    reason = "None"
+                # 将数据追加到DataFrame
+                df_result = pd.concat([ df_result, 
+                                        pd.DataFrame({
+                                            'is_anomaly':[is_anomaly],
+                                            'frequency_inpos':[int(pos_event_template_counts[test_log])],
+                                            'frequency_intest':[int(test_event_template_counts[test_log])],
+                                            'EventTemplate': [test_log], 
+                                            'reason': [reason],
+                                            'topk_similary_log_list': [topk_similary_log_list]
+                                            })
+                                    ], ignore_index=True)
             
-            df_result.to_csv(result_path, index=False)
+                df_result.to_csv(result_path, index=False)
+            stage.exclude(timing.totals['retrieval'] + timing.totals['llm'])
+        self.profiler.add('retrieval', timing.totals['retrieval'], items=timing.counts['retrieval'])
+        self.profiler.add('llm', timing.totals['llm'], items=timing.counts['llm'])
+        if self.auto_decision:
+            self.log_auto_summary(answer_list)
+        judged = [answer for answer in answer_list if 'stopped_early' in answer]
+        if judged:
+            self.log_stream_summary(judged)
         df_result.to_csv(result_path, index=False)
 
         with open(answer_path, 'w') as file:
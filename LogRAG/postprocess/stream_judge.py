@@ -0,0 +1,151 @@
+import json
+import re
+import time
+
+from openai import OpenAI
+
+# verdict value, only accepted once the character after it has arrived ("1" could still become "10", "tr" is not "true")
+VERDICT_PATTERN = re.compile(r'"is_anomaly"\s*:\s*"?(0|1|true|false)(?=[\s,}"])', re.IGNORECASE)
+REASON_PATTERN = re.compile(r'"reason"\s*:\s*"')
+VERDICT_VALUES = {'0': 0, '1': 1, 'false': 0, 'true': 1}
+
+
+class VerdictParser:
+    """ Incremental parser of the judge answer {"is_anomaly": 0/1, "reason": "..."}
+    Text is fed chunk by chunk as it streams in; the verdict is available as soon as its value is complete,
+    the reason as soon as its string is closed or max_reason_chars characters of it have arrived.
+    """
+
+    def __init__(self, max_reason_chars=200):
+        self.max_reason_chars = max_reason_chars
+        self.text = ''
+        self.is_anomaly = None
+        self.verdict_end = None
+        self.reason = None
+        self.reason_start = None
+        self.reason_done = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        if self.is_anomaly is None:
+            match = VERDICT_PATTERN.search(self.text)
+            if match:
+                self.is_anomaly = VERDICT_VALUES[match.group(1).lower()]
+                self.verdict_end = match.end()
+        if self.reason_start is None:
+            match = REASON_PATTERN.search(self.text)
+            if match:
+                self.reason_start = match.end()
+        if self.reason_start is not None and not self.reason_done:
+            self._scan_reason()
+        return self.done
+
+    def _scan_reason(self):
+        raw = self.text[self.reason_start:]
+        escaped = False
+        for i, char in enumerate(raw):
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                self.reason = self._decode(raw[:i])
+                self.reason_done = True
+                return
+        # unterminated string: keep what has arrived, without a dangling escape
+        self.reason = self._decode(raw[:-1] if escaped else raw)
+        if len(self.reason) >= self.max_reason_chars:
+            self.reason = self.reason[:self.max_reason_chars]
+            self.reason_done = True
+
+    @staticmethod
+    def _decode(raw):
+        try:
+            return json.loads(f'"{raw}"')
+        except ValueError:
+            return raw
+
+    @property
+    def done(self):
+        """ Verdict received, and the reason is complete, truncated, or the object closed without one """
+        if self.is_anomaly is None:
+            return False
+        if self.reason_done:
+            return True
+        return self.reason_start is None and '}' in self.text[self.verdict_end:]
+
+    def result(self):
+        """ The answer as the JSON string post_process expects, None when no verdict was found """
+        if self.is_anomaly is None:
+            return None
+        return json.dumps({'is_anomaly': self.is_anomaly, 'reason': self.reason if self.reason is not None else 'None'})
+
+
+class StreamJudge:
+    """ Judges a prompt with a streamed chat completion of an OpenAI compatible endpoint
+    The verdict is parsed while the answer streams in; with stop_early the stream is closed once the verdict and
+    a reason of at most max_reason_chars characters have arrived, so the server stops generating the rest.
+    """
+
+    def __init__(self, api_base, api_key, model, max_reason_chars=200, stop_early=True, client=None):
+        self.client = client if client is not None else OpenAI(base_url=api_base, api_key=api_key)
+        self.model = model
+        self.max_reason_chars = max_reason_chars
+        self.stop_early = stop_early
+
+    @staticmethod
+    def _answer(parser, stopped_early):
+        if not stopped_early:
+            try:
+                json.loads(parser.text)
+                return parser.text
+            except ValueError:
+                pass
+        result = parser.result()
+        return result if result is not None else parser.text
+
+    def judge(self, prompt):
+        """ Returns {result, content, is_anomaly, latency, first_token_latency, completion_tokens, stopped_early}
+        result is the streamed content when it is a complete JSON answer, otherwise the JSON answer rebuilt
+        from the parsed fields, or the raw content when no verdict was found.
+        completion_tokens is the usage reported by the server when the stream ran to the end,
+        otherwise the number of content chunks received (one token per chunk for OpenAI streams).
+        """
+        start_time = time.perf_counter()
+        parser = VerdictParser(self.max_reason_chars)
+        first_token_latency = None
+        chunks = 0
+        usage_tokens = None
+        stopped_early = False
+        stream = self.client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model=self.model,
+            temperature=0,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            for chunk in stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    usage_tokens = chunk.usage.completion_tokens
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if first_token_latency is None:
+                    first_token_latency = time.perf_counter() - start_time
+                chunks += 1
+                if parser.feed(chunk.choices[0].delta.content) and self.stop_early:
+                    stopped_early = True
+                    break
+        finally:
+            # closing the connection makes the server abort the rest of the generation
+            stream.close()
+
+        return {
+            'result': self._answer(parser, stopped_early),
+            'content': parser.text,
+            'is_anomaly': parser.is_anomaly,
+            'latency': time.perf_counter() - start_time,
+            'first_token_latency': first_token_latency,
+            'completion_tokens': usage_tokens if usage_tokens is not None else chunks,
+            'stopped_early': stopped_early,
+        }
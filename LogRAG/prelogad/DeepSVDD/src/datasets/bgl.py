@@ -13,6 +13,7 @@ import torch
 import re
 import pickle
 import string
+import time
 
 def read_json(filename):
     with open(filename, 'r') as load_f:
@@ -69,12 +70,15 @@ def clean(s):
 
 
 class BGL_Dataset(TorchvisionDataset):
-    def __init__(self, root: str, encoder_path: str):
+    def __init__(self, root: str, encoder_path: str, encoder=None):
         '''
             root: data_path
+            encoder: optional callable mapping a cleaned log to its embedding, defaults to the BERT model in encoder_path
         '''
-        biglog_tokenizer = AutoTokenizer.from_pretrained(encoder_path)
-        pretrained_model = BertModel.from_pretrained(encoder_path)
+        if encoder is None:
+            biglog_tokenizer = AutoTokenizer.from_pretrained(encoder_path)
+            pretrained_model = BertModel.from_pretrained(encoder_path)
+            encoder = lambda s: bert_encoder(s, biglog_tokenizer, pretrained_model, no_wordpiece=0)
 
 
         df_logs = pd.read_csv(root)
@@ -82,6 +86,9 @@ class BGL_Dataset(TorchvisionDataset):
         test_set = []
         # 遍历DataFrame中的每一行
         E = {}
+        # time spent in BERT, reported apart from the dataset build
+        self.encode_time = 0.0
+        self.encode_cpu_time = 0.0
         for _, row in tqdm(df_logs.iterrows(), total=len(df_logs)):
             lineid  = row['LineId']
             content = row['Content']
@@ -98,7 +105,10 @@ class BGL_Dataset(TorchvisionDataset):
                 continue
             
             if content not in E.keys():
-                E[content] = bert_encoder(content,biglog_tokenizer, pretrained_model, no_wordpiece=0)
+                encode_start, encode_cpu_start = time.perf_counter(), time.process_time()
+                E[content] = encoder(content)
+                self.encode_time += time.perf_counter() - encode_start
+                self.encode_cpu_time += time.process_time() - encode_cpu_start
             log_embedding = E[content]
 
             if label == 0:
@@ -108,4 +118,5 @@ class BGL_Dataset(TorchvisionDataset):
             
         self.train_set = train_set
         self.test_set  = test_set
+        self.num_encoded = len(E)
 
@@ -1,8 +1,8 @@
 from .bgl import BGL_Dataset
 
-def load_dataset(data_path, encoder_path):
+def load_dataset(data_path, encoder_path, encoder=None):
     """Loads the dataset."""
 
-    dataset = BGL_Dataset(root=data_path, encoder_path=encoder_path)
+    dataset = BGL_Dataset(root=data_path, encoder_path=encoder_path, encoder=encoder)
 
     return dataset
@@ -0,0 +1,203 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import yaml
+from langchain.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
+
+import main as pipeline
+from postprocess import RAG
+from utils.evaluator import evaluate
+
+logger = pipeline.logger
+
+# config keys each stage depends on; a stage is also re-run whenever an upstream stage changes
+STAGE_KEYS = {
+    'split': ['dataset_name', 'log_structed_path', 'train_ratio'],
+    'train': ['is_train', 'is_pretrain', 'encoder_path', 'optimizer_name', 'lr', 'n_epochs', 'lr_milestones',
+              'batch_size', 'weight_decay', 'device'],
+    'detect': ['encoder_path'],
+    'rag': ['is_rag', 'llm_name', 'threshold', 'topk', 'prompt', 'persist_directory', 'stream_judge',
+            'stream_stop_early', 'max_reason_chars', 'auto_normal_threshold', 'auto_anomaly_threshold'],
+    'evaluate': ['window_size', 'window_time', 'window_step'],
+}
+
+# metrics shown in the comparison table, every metric is kept in sweep_results.json
+TABLE_METRICS = ['pre', 'rec', 'f1']
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def stage_key(stage, configs, upstream_key='', extra=None):
+    """ Name a stage output after the config subset it depends on, e.g. rag-1a2b3c4d5e6f """
+    subset = {k: configs.get(k) for k in STAGE_KEYS[stage]}
+    payload = json.dumps([stage, upstream_key, subset, extra], sort_keys=True, default=str)
+    return f"{stage}-{hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12]}"
+
+
+class StageCache:
+    """Computes each stage output once and keeps it on disk under cache_dir/<stage key>/."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def run(self, key, fn):
+        # one lock per key, so parallel variants sharing a stage compute it only once
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            stage_dir = os.path.join(self.cache_dir, key)
+            stage_file = os.path.join(stage_dir, 'stage.json')
+            if os.path.exists(stage_file):
+                logger.info(f'Reusing {key}')
+                with open(stage_file, 'r') as f:
+                    return json.load(f)
+
+            logger.info(f'Running {key}')
+            os.makedirs(stage_dir, exist_ok=True)
+            output = fn(stage_dir)
+            # write then rename, an interrupted stage is never picked up as finished
+            with open(stage_file + '.tmp', 'w') as f:
+                json.dump(output, f)
+            os.replace(stage_file + '.tmp', stage_file)
+            return output
+
+
+def expand_sweep(base_configs, sweep_configs):
+    """ Every combination of the swept values, on top of the base configs """
+    names = list(sweep_configs.keys())
+    combinations = itertools.product(*[sweep_configs[name] for name in names])
+    return [dict(base_configs, **dict(zip(names, values))) for values in combinations]
+
+
+def run_detection(cache, configs):
+    """ Split, train and detect for one config, returns the split and detect stage keys and outputs """
+    split_key = stage_key('split', configs, extra=file_signature(configs['log_structed_path']))
+    split = cache.run(split_key, lambda stage_dir: dict(zip(
+        ['train_path', 'test_path'],
+        pipeline.split_dataset(configs,
+                               os.path.join(stage_dir, 'train_log_structured.csv'),
+                               os.path.join(stage_dir, 'test_log_structured.csv')))))
+
+    if configs['is_train']:
+        train_key = stage_key('train', configs, split_key)
+        model_path = cache.run(train_key, lambda stage_dir: {
+            'model_path': pipeline.train_deepsvdd(configs, split['train_path'], output_dir=stage_dir)})['model_path']
+    else:
+        # use the already trained model, like main.py does
+        model_path = os.path.join(pipeline.output_dir, 'model.tar')
+        train_key = stage_key('train', configs, split_key, extra=file_signature(model_path))
+
+    def detect(stage_dir):
+        anomaly_logs_path, anomaly_lineid_list = pipeline.anomaly_detection(
+            configs, model_path, split['test_path'], output_dir=stage_dir)
+        return {'anomaly_logs_path': anomaly_logs_path,
+                'anomaly_lineid_list': [int(x) for x in anomaly_lineid_list]}
+
+    detect_key = stage_key('detect', configs, train_key)
+    detection = cache.run(detect_key, detect)
+    return split_key, detect_key, split, detection
+
+
+def run_rag(cache, configs, split_key, detect_key, split, detection, vector_dbs):
+    if not configs['is_rag']:
+        return detection['anomaly_lineid_list']
+
+    def rag(stage_dir):
+        RagPoster = RAG.RAGPostProcessor(configs, train_data_path=split['train_path'], logger=logger,
+                                         profiler=pipeline.profiler)
+        anomaly_lineid_list = RagPoster.post_process(
+            detection['anomaly_logs_path'], split['test_path'],
+            result_path=os.path.join(stage_dir, 'anomaly_logs_detc_by_rag.csv'),
+            answer_path=os.path.join(stage_dir, 'llm_answer.json'),
+            vector_db=vector_dbs[(configs['persist_directory'], split_key)])
+        return {'anomaly_lineid_list': [int(x) for x in anomaly_lineid_list]}
+
+    return cache.run(stage_key('rag', configs, detect_key), rag)['anomaly_lineid_list']
+
+
+def build_table(config_list, swept_names, results):
+    rows = []
+    for configs, result in zip(config_list, results):
+        row = {name: configs[name] for name in swept_names}
+        for variant, metrics in result.items():
+            for metric in TABLE_METRICS:
+                row[f'{variant} {metric}'] = metrics[metric]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run LogRAG over a grid of configs, sharing every stage output')
+    parser.add_argument('--config', type=str, default='config.yaml', help='base config file')
+    parser.add_argument('--sweep', type=str, default='sweep.yaml', help='values to sweep, one list per config key')
+    parser.add_argument('--cache-dir', type=str, default='./output/sweep', help='stage outputs and results directory')
+    parser.add_argument('--workers', type=int, default=4, help='parallel RAG / evaluation variants')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        base_configs = yaml.safe_load(file)
+    with open(args.sweep, 'r') as file:
+        sweep_configs = yaml.safe_load(file)
+    os.environ["OPENAI_API_BASE"] = base_configs['api_base']
+    os.environ["OPENAI_API_KEY"] = base_configs['api_key']
+
+    config_list = expand_sweep(base_configs, sweep_configs)
+    logger.info(f'Sweeping {len(config_list)} configs over {list(sweep_configs.keys())}')
+
+    cache = StageCache(args.cache_dir)
+    # identical LLM prompts (same template, same retrieved context) are answered once across variants and runs
+    set_llm_cache(SQLiteCache(database_path=os.path.join(args.cache_dir, 'llm_cache.db')))
+
+    # expensive stages run in order, configs sharing a stage key reuse its output
+    detections = [run_detection(cache, configs) for configs in config_list]
+
+    # build or load every vector db once before fanning out, one per persist directory and train split
+    vector_dbs = {}
+    for configs, (split_key, _, split, _) in zip(config_list, detections):
+        db_key = (configs['persist_directory'], split_key)
+        if not configs['is_rag'] or db_key in vector_dbs:
+            continue
+        if any(directory == configs['persist_directory'] for directory, _ in vector_dbs):
+            # get_vectordb loads a non-empty persist directory as is, whatever split it was built from
+            logger.warning(f"{configs['persist_directory']} is shared by several train splits, "
+                           f"sweep train_ratio together with persist_directory to embed each split")
+        RagPoster = RAG.RAGPostProcessor(configs, train_data_path=split['train_path'], logger=logger,
+                                         profiler=pipeline.profiler)
+        vector_dbs[db_key] = RagPoster.get_vectordb(RagPoster.get_normal_log_entries())
+
+    def run_config(item):
+        configs, (split_key, detect_key, split, detection) = item
+        anomaly_lineid_list = run_rag(cache, configs, split_key, detect_key, split, detection, vector_dbs)
+        return evaluate(configs, split['test_path'], anomaly_lineid_list, logger)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(run_config, zip(config_list, detections)))
+
+    table = build_table(config_list, list(sweep_configs.keys()), results)
+    table_path = os.path.join(args.cache_dir, 'sweep_results.csv')
+    table.to_csv(table_path, index=False)
+    with open(os.path.join(args.cache_dir, 'sweep_results.json'), 'w') as file:
+        json.dump([{'configs': {name: configs[name] for name in sweep_configs}, 'results': result}
+                   for configs, result in zip(config_list, results)], file, indent=2, default=str)
+
+    pipeline.profiler.save(os.path.join(args.cache_dir, 'profile.json'))
+    logger.info('\n' + table.to_string(index=False, float_format=lambda x: f'{x:.4f}'))
+    logger.info(f'Saved sweep results to {table_path}')
+
+
+if __name__ == '__main__':
+    main()
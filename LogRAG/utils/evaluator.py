@@ -1,113 +1,170 @@
-from sklearn.metrics import f1_score, precision_score, recall_score, accuracy_score, confusion_matrix
 import pandas as pd
 import numpy as np
+
+from utils.label_store import LineIdBitmap, load_anomaly_labels
+
+
+def confusion_counts(y_true, y_pred):
+    """ Count tn, fp, fn, tp of binary labels with a single bincount """
+    y_true = np.asarray(y_true) != 0
+    y_pred = np.asarray(y_pred) != 0
+    tn, fp, fn, tp = np.bincount(2 * y_true + y_pred, minlength=4)
+    return tn, fp, fn, tp
+
+
+def safe_divide(numerator, denominator):
+    # sklearn reports 0.0 when a metric is undefined (zero_division="warn")
+    return numerator / denominator if denominator else 0.0
+
+
 def calculate_metrics(y_true, y_pred):
-    tn, fp, fn, tp = confusion_matrix(y_true, y_pred, labels=[0, 1]).ravel()
-    acc = accuracy_score(y_true, y_pred)
-    pre = precision_score(y_true, y_pred, pos_label=1)
-    rec = recall_score(y_true, y_pred, pos_label=1)
-    f1 = f1_score(y_true, y_pred, pos_label=1)
+    tn, fp, fn, tp = confusion_counts(y_true, y_pred)
+    # derive every score from the confusion matrix instead of one sklearn call per score
+    acc = safe_divide(tp + tn, tn + fp + fn + tp)
+    pre = safe_divide(tp, tp + fp)
+    rec = safe_divide(tp, tp + fn)
+    f1 = safe_divide(2 * tp, 2 * tp + fp + fn)
 
     return tp, fp, tn, fn, acc, pre, rec, f1
 
 
-def time_sliding_window(y_true,y_pred, time_data, window_size, step_size):
-
-    log_size = len(time_data)
-    start_end_index_pair = set()
-
-    start_time = time_data[0]
-    end_time = start_time + window_size
-    start_index = 0
-    end_index = 0
-
-    # get the first start, end index, end time
-    for cur_time in time_data:
-        if cur_time < end_time:
-            end_index += 1
-        else:
-            break
-
-    start_end_index_pair.add(tuple([start_index, end_index]))
-
-    # move the start and end index until next sliding window
-    while end_index < log_size:
-        start_time = start_time + step_size
-        end_time = start_time + window_size
-        for i in range(start_index, log_size):
-            if time_data[i] < start_time:
-                i += 1
-            else:
-                break
-        for j in range(end_index, log_size):
-            if time_data[j] < end_time:
-                j += 1
-            else:
-                break
-        start_index = i
-        end_index = j
-
-        # when start_index == end_index, there is no value in the window
-        if start_index != end_index:
-            start_end_index_pair.add(tuple([start_index, end_index]))
-
-    y_pred_windowed = []
-    y_true_windowed = []
-    for (start_index, end_index) in start_end_index_pair:
-        if any(y_pred[start_index:end_index]):
-            y_pred_windowed.append(1)
-        else:
-            y_pred_windowed.append(0)
-            
-        if any(y_true[start_index:end_index]):
-            y_true_windowed.append(1)
-        else:
-            y_true_windowed.append(0)
+def metrics_dict(tp, fp, tn, fn, acc, pre, rec, f1):
+    return {'tp': int(tp), 'fp': int(fp), 'tn': int(tn), 'fn': int(fn),
+            'acc': float(acc), 'pre': float(pre), 'rec': float(rec), 'f1': float(f1)}
+
+
+def fixed_window_any(y, window_size):
+    """ Return 1 for every consecutive block of window_size entries of y containing a non-zero value
+    (the last block may be shorter), otherwise 0
+    """
+    y = np.asarray(y) != 0
+    n_windows = -(-len(y) // window_size)
+    padded = np.zeros(n_windows * window_size, dtype=bool)
+    padded[:len(y)] = y
+    return padded.reshape(n_windows, window_size).any(axis=1).astype(int)
+
+
+def time_window_bounds(time_data, window_size, step_size):
+    """ Compute the [start, end) row indices of every time sliding window
+    Parameters
+    ----------
+    time_data: sequence of timestamps, in log order
+    window_size: window length, in the same unit as time_data
+    step_size: distance between two window starts
+
+    Returns
+    -------
+    (np.array, np.array), start and end indices of the non-empty windows, deduplicated
+    """
+    if window_size <= 0 or step_size <= 0:
+        raise ValueError("window_size and step_size must be positive")
+
+    # a window ends at the first log whose time reaches the window end; the running
+    # maximum keeps that lookup valid even if a few timestamps are out of order
+    sorted_time = np.maximum.accumulate(np.asarray(time_data))
+    first_time = sorted_time[0]
+    last_time = sorted_time[-1]
+
+    # windows keep advancing until one of them reaches past the last log;
+    # the two loops only correct floating point rounding of the division
+    n_steps = max(int(np.floor((last_time - first_time - window_size) / step_size)) + 1, 0)
+    while first_time + n_steps * step_size + window_size <= last_time:
+        n_steps += 1
+    while n_steps > 0 and first_time + (n_steps - 1) * step_size + window_size > last_time:
+        n_steps -= 1
+
+    window_start_time = first_time + np.arange(n_steps + 1) * step_size
+    start_index = np.searchsorted(sorted_time, window_start_time, side='left')
+    end_index = np.searchsorted(sorted_time, window_start_time + window_size, side='left')
+
+    # skip empty windows, and windows whose rows are the same as the previous window
+    keep = start_index < end_index
+    keep[1:] &= (start_index[1:] != start_index[:-1]) | (end_index[1:] != end_index[:-1])
+    return start_index[keep], end_index[keep]
+
+
+def prefix_count(y):
+    """ Prefix sums of the non-zero entries of y, so that any(y[i:j]) == (count[j] > count[i]) """
+    return np.concatenate(([0], np.cumsum(np.asarray(y) != 0)))
+
+
+def time_sliding_window(y_true, y_pred, time_data, window_size, step_size):
+
+    time_windows = time_sliding_windows(y_true, y_pred, time_data, [window_size], [step_size])
+    y_true_windowed, y_pred_windowed = time_windows[(window_size, step_size)]
 
     return y_true_windowed, y_pred_windowed
 
 
+def time_sliding_windows(y_true, y_pred, time_data, window_sizes, step_sizes=None):
+    """ Window y_true and y_pred for several time window sizes in one pass
+    Parameters
+    ----------
+    window_sizes: list of window lengths
+    step_sizes: list of step sizes, one per window size; defaults to the window sizes (tumbling windows)
+
+    Returns
+    -------
+    dict, (window_size, step_size) -> (y_true_windowed, y_pred_windowed)
+    """
+    if step_sizes is None:
+        step_sizes = window_sizes
+    assert len(step_sizes) == len(window_sizes), "step_sizes must have one step per window size"
+
+    # timestamps and prefix sums are shared by every window size
+    sorted_time = np.maximum.accumulate(np.asarray(time_data))
+    true_count = prefix_count(y_true)
+    pred_count = prefix_count(y_pred)
+
+    results = {}
+    for window_size, step_size in zip(window_sizes, step_sizes):
+        start_index, end_index = time_window_bounds(sorted_time, window_size, step_size)
+        y_true_windowed = (true_count[end_index] > true_count[start_index]).astype(int)
+        y_pred_windowed = (pred_count[end_index] > pred_count[start_index]).astype(int)
+        results[(window_size, step_size)] = (y_true_windowed, y_pred_windowed)
+
+    return results
+
+
 
 def evaluate(configs, test_data_path, anomaly_lineid_list, logger):
     
     dataset_name = configs['dataset_name']
     window_size = configs['window_size']
-    seconds = configs['window_time']
+    # window_time / window_step accept a single value or a list of values
+    window_times = configs['window_time']
+    window_times = window_times if isinstance(window_times, list) else [window_times]
+    window_steps = configs.get('window_step', window_times)
+    window_steps = window_steps if isinstance(window_steps, list) else [window_steps] * len(window_times)
 
-    
-    df_test = pd.read_csv(test_data_path)
-    # get the acc pre rec f1 scores
-    idxs = df_test['LineId'].tolist()
-    
-    if dataset_name == "HDFS":
-        y_true = df_test['Label'].tolist()
-    else :
-        y_true = df_test['Label'].apply(lambda x : 0 if x == '-' else 1).tolist()
-        
-    y_true = np.array(y_true)
-    
-    y_pred_dict = {idx: 0 for idx in idxs}
-    for x in anomaly_lineid_list:
-        if x in y_pred_dict:
-            y_pred_dict[x] = 1
-            
-    assert set(y_pred_dict.keys()) == set(idxs), "y_pre_dict do not have same idxs in prediction"
-    
-    y_pred = np.array([y_pred_dict[idx] for idx in idxs])
-    
-    
+    df_test = pd.read_csv(test_data_path, usecols=['LineId', 'Timestamp'])
+    line_ids = df_test['LineId'].to_numpy()
+    # ground truth comes from the cached LineId bitmap instead of comparing every Label string
+    y_true = load_anomaly_labels(test_data_path, dataset_name).contains(line_ids).astype(int)
+
+    # a log is predicted as anomaly iff its LineId was reported
+    y_pred = LineIdBitmap.from_ids(anomaly_lineid_list).contains(line_ids).astype(int)
+
+    results = {}
     TP, FP, TN, FN, acc, pre, rec, f1 = calculate_metrics(y_true, y_pred)
+    results['window 1'] = metrics_dict(TP, FP, TN, FN, acc, pre, rec, f1)
     logger.info("fixing windows size 1:  TP: {}, FP: {}, TN: {}, FN: {} ".format(TP, FP, TN, FN))
     logger.info(f"fixing windows size {1}: Acc: {acc:.4f}, Precision: {pre:.4f}, Recall: {rec:.4f}, F1: {f1:.4f}\n")
-    
-   
-    y_pred_windowed = [1 if any(y_pred[i:i + window_size]) else 0 for i in range(0, len(y_pred), window_size)]
-    y_true_windowed = [1 if any(y_true[i:i + window_size]) else 0 for i in range(0, len(y_true), window_size)]
-    wdtp, wdfp, wdtn, wdfn, wdacc, wdpre, wdrec, wdf1 = calculate_metrics(y_true_windowed, y_pred_windowed)
-    logger.info(f"fixing windows size {window_size}, Tp: {wdtp}, Fp: {wdfp}, Tn: {wdtn}, Fn: {wdfn}")
-    logger.info(f"fixing windows size {window_size}, Acc: {wdacc:.4f}, Precision: {wdpre:.4f}, Recall: {wdrec:.4f}, F1: {wdf1:.4f}\n")    
 
-    y_true_windowed, y_pred_windowed = time_sliding_window(y_true, y_pred, df_test['Timestamp'].tolist(), window_size=seconds, step_size=seconds)
+    y_pred_windowed = fixed_window_any(y_pred, window_size)
+    y_true_windowed = fixed_window_any(y_true, window_size)
     wdtp, wdfp, wdtn, wdfn, wdacc, wdpre, wdrec, wdf1 = calculate_metrics(y_true_windowed, y_pred_windowed)
-    logger.info(f"time windows size {seconds} seconds, Tp: {wdtp}, Fp: {wdfp}, Tn: {wdtn}, Fn: {wdfn}")
-    logger.info(f"time windows size {seconds} seconds, Acc: {wdacc:.4f}, Precision: {wdpre:.4f}, Recall: {wdrec:.4f}, F1: {wdf1:.4f}\n")     
\ No newline at end of file
+    results[f'window {window_size}'] = metrics_dict(wdtp, wdfp, wdtn, wdfn, wdacc, wdpre, wdrec, wdf1)
+    logger.info(f"fixing windows size {window_size}, Tp: {wdtp}, Fp: {wdfp}, Tn: {wdtn}, Fn: {wdfn}")
+    logger.info(f"fixing windows size {window_size}, Acc: {wdacc:.4f}, Precision: {wdpre:.4f}, Recall: {wdrec:.4f}, F1: {wdf1:.4f}\n")
+
+    time_windows = time_sliding_windows(y_true, y_pred, df_test['Timestamp'].to_numpy(), window_sizes=window_times, step_sizes=window_steps)
+    for (seconds, step), (y_true_windowed, y_pred_windowed) in time_windows.items():
+        step_info = "" if step == seconds else f", step {step} seconds"
+        wdtp, wdfp, wdtn, wdfn, wdacc, wdpre, wdrec, wdf1 = calculate_metrics(y_true_windowed, y_pred_windowed)
+        results[f'time {seconds}s' + ("" if step == seconds else f" step {step}s")] = \
+            metrics_dict(wdtp, wdfp, wdtn, wdfn, wdacc, wdpre, wdrec, wdf1)
+        logger.info(f"time windows size {seconds} seconds{step_info}, Tp: {wdtp}, Fp: {wdfp}, Tn: {wdtn}, Fn: {wdfn}")
+        logger.info(f"time windows size {seconds} seconds{step_info}, Acc: {wdacc:.4f}, Precision: {wdpre:.4f}, Recall: {wdrec:.4f}, F1: {wdf1:.4f}\n")
+
+    return results
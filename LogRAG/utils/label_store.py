@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+# bump when the sidecar layout changes so stale files are rebuilt
+LABEL_STORE_VERSION = 2
+
+
+def replace_file(path, write, mode='w'):
+    """ Write path through a temporary file of this thread and os.replace it, readers never see a partial file
+    and a file another thread has memory-mapped is replaced, not truncated.
+    LogRCA/label_store.py has the same helper: the two projects are installed and run separately and share no package.
+    """
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class LineIdBitmap:
+    """ Set of non-negative LineIds stored as a packed bitmap (one bit per LineId)
+    A million labeled lines take 125 KB; the bitmap is saved as a plain .npy file
+    and loaded with mmap_mode='r', so opening it costs milliseconds regardless of size.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+
+    @classmethod
+    def from_ids(cls, line_ids, size=None):
+        """ Build the bitmap of line_ids; size is the number of LineIds it must be able to hold
+        Negative ids can never be looked up and are ignored
+        """
+        line_ids = np.asarray(line_ids, dtype=np.int64).ravel()
+        line_ids = line_ids[line_ids >= 0]
+        if size is None:
+            size = int(line_ids.max()) + 1 if len(line_ids) else 0
+        mask = np.zeros(size, dtype=bool)
+        mask[line_ids] = True
+        return cls(np.packbits(mask))
+
+    @classmethod
+    def from_mask(cls, line_ids, mask):
+        """ Build the bitmap of the line_ids whose mask entry is set """
+        line_ids = np.asarray(line_ids, dtype=np.int64)
+        size = int(line_ids.max()) + 1 if len(line_ids) else 0
+        return cls.from_ids(line_ids[np.asarray(mask, dtype=bool)], size=size)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path, mmap_mode='r'))
+
+    def save(self, path):
+        replace_file(path, lambda f: np.save(f, np.asarray(self.bits, dtype=np.uint8)), mode='wb')
+
+    def contains(self, line_ids):
+        """ Vectorized membership test, returns a bool array shaped like line_ids """
+        line_ids = np.asarray(line_ids, dtype=np.int64)
+        if not len(self.bits):
+            return np.zeros(line_ids.shape, dtype=bool)
+        inside = (line_ids >= 0) & (line_ids < len(self.bits) * 8)
+        ids = np.where(inside, line_ids, 0)
+        found = (np.asarray(self.bits)[ids >> 3] >> (7 - (ids & 7))) & 1
+        return inside & (found != 0)
+
+    def __contains__(self, line_id):
+        return bool(self.contains([line_id])[0])
+
+    def __len__(self):
+        """ Number of LineIds in the set """
+        return int(np.unpackbits(np.asarray(self.bits)).sum())
+
+
+def anomaly_mask(labels, dataset_name):
+    """ Ground truth of a Label column: HDFS stores 0/1, the other datasets '-' for normal logs """
+    if dataset_name == "HDFS":
+        return labels.to_numpy().astype(int) != 0
+    return (labels != '-').to_numpy()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """ sha1 of the file content, read in 1 MB chunks """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_meta(meta_path, meta):
+    try:
+        replace_file(meta_path, lambda f: json.dump(meta, f))
+    except OSError:
+        # read-only dataset directory
+        pass
+
+
+def load_anomaly_labels(data_path, dataset_name):
+    """ Bitmap of the anomalous LineIds of a structured log csv
+    The bitmap is cached next to the csv as <csv>.labels.npy together with <csv>.labels.meta.json,
+    which records the csv size, modification time and content sha1. An unchanged size and mtime reuse the bitmap
+    without reading the csv; otherwise the csv is hashed, which is much cheaper than parsing it, so a csv that is
+    rewritten with the same content (main.py splits the dataset again on every run) still reuses the bitmap.
+    """
+    bitmap_path = data_path + '.labels.npy'
+    meta_path = data_path + '.labels.meta.json'
+    stat = os.stat(data_path)
+    meta = {'version': LABEL_STORE_VERSION, 'dataset': dataset_name,
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    cached = None
+    if os.path.exists(bitmap_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            cached = json.load(f)
+        if {key: cached.get(key) for key in meta} == meta:
+            return LineIdBitmap.load(bitmap_path)
+
+    meta['sha1'] = file_digest(data_path)
+    if cached is not None and all(cached.get(key) == meta[key] for key in ('version', 'dataset', 'size', 'sha1')):
+        # same content under a new mtime: record the mtime so the next load skips hashing
+        save_meta(meta_path, meta)
+        return LineIdBitmap.load(bitmap_path)
+
+    df = pd.read_csv(data_path, usecols=['LineId', 'Label'])
+    bitmap = LineIdBitmap.from_mask(df['LineId'].to_numpy(), anomaly_mask(df['Label'], dataset_name))
+    try:
+        # the meta is written last, so a concurrent loader only trusts a bitmap that is already complete
+        bitmap.save(bitmap_path)
+    except OSError:
+        # read-only dataset directory: keep the in-memory bitmap
+        return bitmap
+    save_meta(meta_path, meta)
+    return bitmap
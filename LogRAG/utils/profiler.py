@@ -0,0 +1,213 @@
+import cProfile
+import json
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def current_rss_mb():
+    """ Resident set size of this process in MB, falls back to the peak RSS when /proc is not available """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return max_rss_mb()
+
+
+def max_rss_mb():
+    """ Peak resident set size of this process in MB """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+class MemorySampler(threading.Thread):
+    """Polls the RSS in the background to get the peak memory of a single stage."""
+
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_rss_mb = current_rss_mb()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+        return self.peak_rss_mb
+
+
+class StageRecord:
+    """Timing and memory of one pipeline stage, items can be set while the stage runs."""
+
+    def __init__(self, name, items=None):
+        self.name = name
+        self.items = items
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.rss_start_mb = None
+        self.peak_rss_mb = None
+        self.excluded_wall_time = 0.0
+        self.excluded_cpu_time = 0.0
+
+    def exclude(self, wall_time, cpu_time=0.0):
+        """Leave out time that is recorded as a stage of its own, e.g. BERT encoding inside the dataset build."""
+        self.excluded_wall_time += wall_time
+        self.excluded_cpu_time += cpu_time
+
+    def to_dict(self):
+        throughput = self.items / self.wall_time if self.items is not None and self.wall_time > 0 else None
+        return {
+            'name': self.name,
+            'wall_time': round(self.wall_time, 6),
+            'cpu_time': round(self.cpu_time, 6),
+            'rss_start_mb': self.rss_start_mb,
+            'peak_rss_mb': self.peak_rss_mb,
+            'items': self.items,
+            'throughput': throughput,
+        }
+
+
+class StageProfiler:
+    """Records per-stage wall time, CPU time, peak RSS, item counts and throughput of a run.
+
+    Attributes:
+        hook: None, 'cprofile' to dump a .prof file per stage, or 'py-spy' to record a flamegraph per stage.
+        profile_dir: Directory of the hook outputs.
+    """
+
+    def __init__(self, logger, hook=None, profile_dir='./output/profile', sample_interval=0.05):
+        assert hook in (None, 'cprofile', 'py-spy'), "hook must be None, 'cprofile' or 'py-spy'."
+        self.logger = logger
+        self.hook = hook
+        self.profile_dir = profile_dir
+        self.sample_interval = sample_interval
+        self.records = []
+        self.regressions = []
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+
+    @contextmanager
+    def _hook(self, name):
+        if self.hook is None:
+            yield
+            return
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if self.hook == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(os.path.join(self.profile_dir, f'{name}.prof'))
+        else:
+            if shutil.which('py-spy') is None:
+                self.logger.warning('py-spy is not installed, stage %s is not profiled' % name)
+                yield
+                return
+            recorder = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()),
+                                         '--output', os.path.join(self.profile_dir, f'{name}.svg')],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                yield
+            finally:
+                # py-spy writes its output when interrupted
+                recorder.send_signal(signal.SIGINT)
+                recorder.wait()
+
+    @contextmanager
+    def stage(self, name, items=None):
+        """Profile the enclosed block as stage name, set record.items inside the block if unknown upfront."""
+        record = StageRecord(name, items)
+        record.rss_start_mb = current_rss_mb()
+        sampler = MemorySampler(self.sample_interval)
+        sampler.start()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            with self._hook(name):
+                yield record
+        finally:
+            record.wall_time = time.perf_counter() - start_wall - record.excluded_wall_time
+            record.cpu_time = time.process_time() - start_cpu - record.excluded_cpu_time
+            record.peak_rss_mb = sampler.stop()
+            self.records.append(record)
+            self.logger.info('Stage %s: wall %.3fs, cpu %.3fs, peak RSS %.1f MB, items %s'
+                             % (name, record.wall_time, record.cpu_time, record.peak_rss_mb, record.items))
+
+    def add(self, name, wall_time, cpu_time=0.0, items=None):
+        """Record a stage timed by the caller, e.g. the encoding share of a dataset build."""
+        record = StageRecord(name, items)
+        record.wall_time = wall_time
+        record.cpu_time = cpu_time
+        # memory is not measured for stages timed by the caller
+        self.records.append(record)
+        return record
+
+    def summary(self):
+        """Stage records merged by name: times and items are summed, peak RSS is the max."""
+        stages = {}
+        for record in self.records:
+            stage = stages.setdefault(record.name, StageRecord(record.name))
+            stage.wall_time += record.wall_time
+            stage.cpu_time += record.cpu_time
+            if record.items is not None:
+                stage.items = (stage.items or 0) + record.items
+            if record.peak_rss_mb is not None:
+                stage.peak_rss_mb = max(stage.peak_rss_mb or 0.0, record.peak_rss_mb)
+        return {name: stage.to_dict() for name, stage in stages.items()}
+
+    def check_regressions(self, baseline_path, tolerance=0.2, min_seconds=0.1, update_baseline=False):
+        """Compare this run with the stored baseline and log every stage slower or larger than
+        (1 + tolerance) times its baseline. The first run (or update_baseline) stores the baseline."""
+        summary = self.summary()
+        if update_baseline or not os.path.exists(baseline_path):
+            with open(baseline_path, 'w') as f:
+                json.dump({'started_at': self.started_at, 'stages': summary}, f, indent=2)
+            self.logger.info(f'Saved profiling baseline to {baseline_path}')
+            return []
+
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)['stages']
+
+        self.regressions = []
+        for name, stage in summary.items():
+            if name not in baseline:
+                continue
+            for metric in ('wall_time', 'cpu_time', 'peak_rss_mb'):
+                old, new = baseline[name].get(metric), stage[metric]
+                if not old or new is None:
+                    continue
+                # ignore timing noise of very short stages
+                if metric != 'peak_rss_mb' and max(old, new) < min_seconds:
+                    continue
+                if new > old * (1 + tolerance):
+                    self.regressions.append({'stage': name, 'metric': metric, 'baseline': old, 'current': new,
+                                             'ratio': round(new / old, 3)})
+                    self.logger.warning(f'Regression in stage {name}: {metric} {new:.3f} vs baseline {old:.3f} '
+                                        f'({new / old:.2f}x)')
+        return self.regressions
+
+    def save(self, export_json):
+        """Save the stage records, the per-stage summary and the detected regressions to a JSON-file."""
+        with open(export_json, 'w') as f:
+            json.dump({
+                'started_at': self.started_at,
+                'hook': self.hook,
+                'max_rss_mb': max_rss_mb(),
+                'records': [record.to_dict() for record in self.records],
+                'stages': self.summary(),
+                'regressions': self.regressions,
+            }, f, indent=2)
+        self.logger.info(f'Saved profiling results to {export_json}')
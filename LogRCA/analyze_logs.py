@@ -1,10 +1,13 @@
 import os
 import json
-import time
 import argparse
-from openai import OpenAI
+import asyncio
+from openai import AsyncOpenAI, OpenAI
 import yaml
 
+from prompt_builder import PromptBuilder, full_prompt
+from report_generator import ReportCache, ReportGenerator, ReportJournal, record_key, record_specifics, report_key
+
 # 读取配置文件
 def load_config(config_path="config.yaml"):
     with open(config_path, 'r', encoding='utf-8') as f:
@@ -48,55 +51,70 @@ class GPTAnalyzer:
 
 def generate_prompt(anomaly_data):
     """
-    根据异常日志数据生成提示
+    根据异常日志数据生成提示（完整上下文和源码，不限长度）
     """
-    anomaly_log = anomaly_data["anomaly_log"]
-    
-    # 准备异常日志文本
-    log_text = anomaly_log["text"]
-    
-    # 准备上下文信息
-    context_before = "\n".join([log["text"] for log in anomaly_data.get("context_before", [])])
-    context_after = "\n".join([log["text"] for log in anomaly_data.get("context_after", [])])
-    
-    # 准备源码片段
-    code_context = anomaly_log.get("code_context", {})
-    source_code = ""
-    if code_context and "context" in code_context:
-        file_path = code_context.get("file", "未知文件")
-        source_code = f"文件路径: {file_path}\n"
-        source_code += "\n".join([f"{line['line_number']}: {line['content']}" for line in code_context["context"]])
-    
-    # 生成完整提示
-    prompt = f"""指令：你是一名经验丰富的软件工程师。你的任务是分析异常日志、上下文
-信息及源码，找出异常发生的原因，并生成格式化分析报告。输入：
-•异常日志:
-{log_text}
+    return full_prompt(anomaly_data)
+
+def build_job(anomaly_data, builder=None):
+    """
+    一条带代码上下文的异常记录 -> ReportGenerator的任务
+    传入PromptBuilder时按token预算生成提示，任务中记录提示的token数和节省的token数
+    """
+    job = {
+        'record_key': record_key(anomaly_data),
+        'report_key': report_key(anomaly_data),
+        'vm_id': anomaly_data.get("vm_id", "unknown"),
+        'anomaly_log': anomaly_data["anomaly_log"]["text"],
+        'specifics': record_specifics(anomaly_data)
+    }
+    if builder is None:
+        job['prompt'] = generate_prompt(anomaly_data)
+    else:
+        job['prompt'], tokens = builder.build(anomaly_data)
+        job['prompt_tokens'] = tokens['prompt_tokens']
+        job['tokens_saved'] = tokens['tokens_saved']
+    return job
 
-• 上下文信息:
---- 之前的日志 ---
-{context_before}
+def prompt_builder(config, model, budget=None):
+    """按配置的token预算创建PromptBuilder，预算为0时返回None（不压缩提示）"""
+    if budget is None:
+        budget = config['log_analysis'].get('prompt_token_budget', 0)
+    return PromptBuilder(budget, model) if budget else None
 
---- 之后的日志 ---
-{context_after}
+def print_token_summary(jobs):
+    budgeted = [job for job in jobs if 'prompt_tokens' in job]
+    if budgeted:
+        prompt_tokens = sum(job['prompt_tokens'] for job in budgeted)
+        saved = sum(job['tokens_saved'] for job in budgeted)
+        print(f"{len(budgeted)} 个提示共 {prompt_tokens} 个token，压缩节省 {saved} 个token"
+              f"（{saved / max(prompt_tokens + saved, 1):.1%}）")
 
-•源码片段:
-{source_code}
+def open_report_cache(config, base_dir):
+    """按配置打开跨运行的报告缓存"""
+    output_config = config['output']
+    cache_file = os.path.join(base_dir, output_config['output_dir'], output_config.get('report_cache_file', 'report_cache.json'))
+    cache = ReportCache(cache_file,
+                        max_entries=config['log_analysis'].get('report_cache_size', 10000),
+                        max_age_days=config['log_analysis'].get('report_cache_days', 30))
+    print(f"报告缓存: {cache_file}（{len(cache.entries)} 条）")
+    return cache
 
-异常分析报告输出格式：
-1.异常概述
-- 异常类型：｛异常类型｝
-- 异常信息：｛错误消息｝
-2.详细分析
-- 可能的异常原因：
--｛基于日志、上下文和源码的推断｝
-- 影响范围：
--｛异常可能影响的系统组件｝
-3. 解决方案建议
-- 短期修复：｛快速缓解措施｝
-- 长期优化：｛提升代码健壮性的方案｝
-"""
-    return prompt
+def write_report(jobs, journal, output_file):
+    """按任务顺序写出完整报告，只包含journal中已完成的记录"""
+    analysis_results = []
+    for job in jobs:
+        entry = journal.entries.get(job['record_key'])
+        if entry:
+            analysis_results.append({
+                "vm_id": entry["vm_id"],
+                "anomaly_log": entry["anomaly_log"],
+                "analysis": entry["analysis"],
+                "report_key": entry["report_key"],
+                "specifics": entry["specifics"],
+                **{key: job[key] for key in ('prompt_tokens', 'tokens_saved') if key in job}
+            })
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(analysis_results, f, ensure_ascii=False, indent=2)
 
 def parse_args():
     """
@@ -124,6 +142,15 @@ def parse_args():
     parser.add_argument('--config', type=str,
                         default='config.yaml',
                         help='配置文件路径')
+    parser.add_argument('--concurrency', type=int,
+                        default=config['log_analysis'].get('concurrency', 8),
+                        help='最大并发请求数，收到429时自动降低')
+    parser.add_argument('--restart', action='store_true',
+                        help='忽略已有的结果日志，重新分析所有记录')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='不使用跨运行的报告缓存')
+    parser.add_argument('--prompt-budget', type=int,
+                        help='每个提示的token上限，0为不压缩；默认为配置中的prompt_token_budget')
     return parser.parse_args()
 
 def main():
@@ -152,8 +179,11 @@ def main():
     print(f"输入文件: {input_file}")
     print(f"输出文件: {output_file}")
     
-    # 初始化GPT分析器
-    analyzer = GPTAnalyzer(api_base, api_key, model, config)
+    # 只追加的结果日志，中断后重新运行时从中恢复
+    journal_file = os.path.splitext(output_file)[0] + '.journal.jsonl'
+    if args.restart and os.path.exists(journal_file):
+        os.remove(journal_file)
+    print(f"结果日志: {journal_file}")
     
     try:
         # 读取code_context.json
@@ -162,48 +192,28 @@ def main():
             anomaly_data_list = json.load(f)
         
         print(f"共读取到 {len(anomaly_data_list)} 条异常记录")
-        analysis_results = []
         
         # 获取最大处理的日志数量
         max_logs = config['log_analysis']['max_logs']
+        anomaly_data_list = anomaly_data_list[:max_logs]
         
-        # 处理每个异常日志
-        for i, anomaly_data in enumerate(anomaly_data_list):
-            print(f"处理第 {i+1}/{len(anomaly_data_list)} 条异常日志...")
-            if i > max_logs:
-                break
-            
-            try:
-                # 生成提示
-                prompt = generate_prompt(anomaly_data)
-                
-                # 发送到ChatGPT
-                print(f"正在发送请求到ChatGPT...")
-                analysis = analyzer.ask_chatgpt(prompt)
-                
-                if analysis:
-                    # 保存分析结果
-                    result = {
-                        "vm_id": anomaly_data.get("vm_id", "unknown"),
-                        "anomaly_log": anomaly_data["anomaly_log"]["text"],
-                        "analysis": analysis
-                    }
-                    analysis_results.append(result)
-                    
-                    # 保存中间结果，以防程序中断
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        json.dump(analysis_results, f, ensure_ascii=False, indent=2)
-                    
-                    print(f"已保存第 {i+1} 条分析结果")
-                    
-                    # 避免API限制
-                    time.sleep(1)
-                else:
-                    print(f"无法获取第 {i+1} 条异常日志的分析结果")
-            except Exception as e:
-                print(f"处理第 {i+1} 条异常日志时出错: {e}")
-                # 继续处理下一条
-                continue
+        builder = prompt_builder(config, model, args.prompt_budget)
+        jobs = [build_job(anomaly_data, builder) for anomaly_data in anomaly_data_list]
+        print_token_summary(jobs)
+        
+        # 异常模板、代码位置和上下文模板相同的记录（通常来自不同虚拟机）共享同一个分析结果
+        cache = None if args.no_cache else open_report_cache(config, current_dir)
+        
+        # 并发请求ChatGPT，限流由响应的429和速率限制头自动调整
+        client = AsyncOpenAI(base_url=api_base, api_key=api_key, max_retries=0)
+        journal = ReportJournal(journal_file)
+        generator = ReportGenerator(client, model, journal, cache=cache, concurrency=args.concurrency)
+        try:
+            asyncio.run(generator.run(jobs))
+        finally:
+            journal.close()
+        
+        write_report(jobs, journal, output_file)
         
         print(f"分析完成！结果已保存到 {output_file}")
         
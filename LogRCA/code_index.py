@@ -0,0 +1,414 @@
+import ast
+import bisect
+import fnmatch
+import hashlib
+import json
+import os
+import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+# 日志调用语句（与find_code_context.LOG_CODE_PATTERN一致）
+LOG_CODE_PATTERN = re.compile(
+    r"(LOG\.\w+\(|logging\.\w+\(|\.\w+_log\(|\w+log\(|print\()"
+)
+
+# 函数/类定义
+DEF_PATTERN = re.compile(r'^(\s*)(?:async\s+)?(def|class)\s+(\w+)')
+
+# 调用的第一个参数中相邻的字符串字面量，可以被_()、_LE()等翻译函数或括号包裹
+FORMAT_STRING_PATTERN = re.compile(
+    r'\(\s*(?:_\w*\(\s*|\(\s*)?((?:[rRuU]?(?:\'(?:[^\'\\\n]|\\.)*\'|"(?:[^"\\\n]|\\.)*")\s*)+)'
+)
+
+# %格式化的占位符，如 %s、%(name)s、%.2f、%%
+CONVERSION_PATTERN = re.compile(r'%(?:\((?P<name>\w+)\))?[-#0 +]*(?:\d+|\*)?(?:\.(?:\d+|\*))?(?P<type>[diouxXeEfFgGcrsa%])')
+
+# 各类占位符对应的正则
+CONVERSION_REGEX = {
+    'd': r'[-+]?\d+', 'i': r'[-+]?\d+', 'u': r'[-+]?\d+',
+    'e': r'[-+]?[\d.]+(?:[eE][-+]?\d+)?', 'E': r'[-+]?[\d.]+(?:[eE][-+]?\d+)?',
+    'f': r'[-+]?(?:[\d.]+|inf|nan)', 'F': r'[-+]?(?:[\d.]+|INF|NAN)',
+    'g': r'[-+]?[\d.]+(?:[eE][-+]?\d+)?', 'G': r'[-+]?[\d.]+(?:[eE][-+]?\d+)?',
+}
+
+# oslo.log为带instance参数的日志加上的前缀
+INSTANCE_PREFIX_PATTERN = re.compile(r'^\[instance: [^\]]*\] ')
+
+# 格式字符串中常量文本至少包含的字符数，过短的（如 "%s"）能匹配任何消息，不参与精确匹配
+MIN_CONSTANT_CHARS = 6
+
+# 格式变化时旧索引自动重建
+INDEX_VERSION = 2
+
+# 需要解析的文件数超过该值时使用进程池并行解析
+PARALLEL_MIN_FILES = 32
+
+# 格式字符串最多跨越的行数
+MAX_STATEMENT_LINES = 10
+
+
+def tokenize(text: str) -> List[str]:
+    """小写的单词token"""
+    return re.findall(r'\w+', text.lower())
+
+
+def first_token(text: str) -> Optional[str]:
+    """文本开头的单词token，文本不以单词字符开头时返回None"""
+    match = re.match(r'\w+', text)
+    return match.group().lower() if match else None
+
+
+def compile_format_string(format_string: str):
+    """
+    把%格式字符串编译为锚定的正则
+    返回 (正则, 常量前缀, 常量文本长度)；格式字符串不合法时返回None
+    """
+    parts = []
+    constants = []
+    position = 0
+    for match in CONVERSION_PATTERN.finditer(format_string):
+        constants.append(format_string[position:match.start()])
+        parts.append(re.escape(format_string[position:match.start()]))
+        if match.group('type') == '%':
+            constants.append('%')
+            parts.append('%')
+        else:
+            parts.append(f"(?:{CONVERSION_REGEX.get(match.group('type'), '.*?')})")
+        position = match.end()
+    constants.append(format_string[position:])
+    parts.append(re.escape(format_string[position:]))
+    try:
+        regex = re.compile(''.join(parts) + r'\s*\Z', re.DOTALL)
+    except re.error:
+        return None
+    return regex, constants[0], len(re.sub(r'\s+', '', ''.join(constants)))
+
+
+class FormatStringMatcher:
+    """
+    日志消息到日志调用的反向匹配
+    每个日志调用的格式字符串被编译为锚定正则，并按常量前缀的第一个单词分桶；
+    匹配消息时只需尝试同一个桶（以及以占位符开头的格式字符串）中的正则，按常量文本从长到短依次尝试。
+    """
+
+    def __init__(self, statements: List[tuple]):
+        self.buckets = defaultdict(list)  # 前缀单词 -> [(常量文本长度, 语句编号, 正则)]
+        self.wildcard = []  # 以占位符开头的格式字符串
+        for statement_id, (_, statement) in enumerate(statements):
+            format_string = statement.get('format_string')
+            if not format_string:
+                continue
+            compiled = compile_format_string(format_string)
+            if compiled is None:
+                continue
+            regex, prefix, constant_chars = compiled
+            if constant_chars < MIN_CONSTANT_CHARS:
+                continue
+            token = first_token(prefix)
+            bucket = self.buckets[token] if token else self.wildcard
+            bucket.append((constant_chars, statement_id, regex))
+        for bucket in list(self.buckets.values()) + [self.wildcard]:
+            bucket.sort(key=lambda item: (-item[0], item[1]))
+
+    def match(self, message: str):
+        """
+        返回与消息精确匹配的 ([语句编号], 置信度)，没有匹配时返回 ([], 0.0)
+        常量文本最长的格式字符串优先，置信度为常量文本占消息的比例
+        """
+        message = INSTANCE_PREFIX_PATTERN.sub('', message.strip())
+        if not message:
+            return [], 0.0
+        token = first_token(message)
+
+        matched = []  # [(常量文本长度, 语句编号)]
+        for bucket in (self.buckets.get(token, []) if token else [], self.wildcard):
+            for constant_chars, statement_id, regex in bucket:
+                if matched and constant_chars < matched[0][0]:
+                    break
+                if regex.match(message):
+                    if matched and constant_chars > matched[0][0]:
+                        matched = []
+                    matched.append((constant_chars, statement_id))
+        if not matched:
+            return [], 0.0
+        message_chars = len(re.sub(r'\s+', '', message))
+        confidence = min(1.0, matched[0][0] / message_chars) if message_chars else 1.0
+        return [statement_id for _, statement_id in matched], confidence
+
+
+def parse_format_string(lines: List[str], line_index: int, call_start: int) -> Optional[str]:
+    """从日志调用处解析第一个参数中的格式字符串，支持跨行拼接的字符串"""
+    text = '\n'.join(lines[line_index:line_index + MAX_STATEMENT_LINES])[call_start:]
+    match = FORMAT_STRING_PATTERN.match(text, text.find('('))
+    if not match:
+        return None
+    try:
+        # 括号内跨行的相邻字符串字面量会被拼接
+        value = ast.literal_eval('(' + match.group(1).strip() + ')')
+    except (SyntaxError, ValueError):
+        return None
+    return value if isinstance(value, str) else None
+
+
+def make_statement(line_number: int, end_line_number: int, function: Optional[str], function_range, class_range,
+                   log_statement: str, format_string: Optional[str]) -> Dict[str, Any]:
+    return {
+        'line_number': line_number,
+        'end_line_number': end_line_number,
+        'function': function,
+        'function_range': function_range,
+        'class_range': class_range,
+        'log_statement': log_statement,
+        'format_string': format_string,
+        'tokens': sorted(set(tokenize(log_statement) + tokenize(format_string or '')))
+    }
+
+
+def ast_format_string(call: ast.Call) -> Optional[str]:
+    """日志调用第一个参数中的格式字符串，去掉_LE()等翻译函数和 "..." % args 的格式化"""
+    if not call.args:
+        return None
+    arg = call.args[0]
+    for _ in range(3):
+        if isinstance(arg, ast.Call) and isinstance(arg.func, ast.Name) and arg.func.id.startswith('_') and arg.args:
+            arg = arg.args[0]
+        elif isinstance(arg, ast.BinOp) and isinstance(arg.op, ast.Mod):
+            arg = arg.left
+        else:
+            break
+    if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+        return arg.value
+    return None
+
+
+def node_range(node: ast.AST) -> List[int]:
+    """节点的 [起始行, 结束行]，包括装饰器"""
+    start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+    return [start, node.end_lineno]
+
+
+class LogCallVisitor:
+    """
+    收集日志调用的完整范围、格式字符串以及所在函数和类的范围
+    只进入包含LOG_CODE_PATTERN匹配行的子树，其余子树直接跳过
+    """
+
+    def __init__(self, lines: List[str]):
+        self.lines = lines
+        self.candidate_lines = [i + 1 for i, line in enumerate(lines) if LOG_CODE_PATTERN.search(line)]
+        self.scopes = []
+        self.statements = []
+
+    def _has_candidate(self, node: ast.AST) -> bool:
+        end_lineno = getattr(node, 'end_lineno', None)
+        if end_lineno is None:
+            return True
+        start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+        i = bisect.bisect_left(self.candidate_lines, start)
+        return i < len(self.candidate_lines) and self.candidate_lines[i] <= end_lineno
+
+    def visit(self, node: ast.AST):
+        is_scope = isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+        if is_scope:
+            self.scopes.append(node)
+        if isinstance(node, ast.Call):
+            self.visit_Call(node)
+        for child in ast.iter_child_nodes(node):
+            if self._has_candidate(child):
+                self.visit(child)
+        if is_scope:
+            self.scopes.pop()
+
+    def _func_text(self, func: ast.AST) -> str:
+        """被调用表达式的源码（col_offset是UTF-8字节偏移）"""
+        if func.lineno != func.end_lineno:
+            return ''
+        line = self.lines[func.lineno - 1].encode('utf-8')
+        return line[func.col_offset:func.end_col_offset].decode('utf-8', errors='ignore')
+
+    def visit_Call(self, node: ast.Call):
+        if LOG_CODE_PATTERN.search(self._func_text(node.func) + '('):
+            function = next((scope for scope in reversed(self.scopes) if not isinstance(scope, ast.ClassDef)), None)
+            klass = next((scope for scope in reversed(self.scopes) if isinstance(scope, ast.ClassDef)), None)
+            self.statements.append(make_statement(
+                node.lineno, node.end_lineno,
+                '.'.join(scope.name for scope in self.scopes) or None,
+                node_range(function) if function else None,
+                node_range(klass) if klass else None,
+                self.lines[node.lineno - 1].strip(),
+                ast_format_string(node)))
+
+
+def extract_log_statements_by_line(lines: List[str]) -> List[Dict[str, Any]]:
+    """逐行匹配LOG_CODE_PATTERN提取日志调用，用于无法被ast解析的文件（如Python 2语法）"""
+    statements = []
+    scopes = []  # [(缩进, 函数/类名)]
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped and not stripped.startswith('#'):
+            indent = len(line) - len(line.lstrip())
+            while scopes and scopes[-1][0] >= indent:
+                scopes.pop()
+            definition = DEF_PATTERN.match(line)
+            if definition:
+                scopes.append((indent, definition.group(3)))
+                continue
+
+        match = LOG_CODE_PATTERN.search(line)
+        if not match:
+            continue
+        statements.append(make_statement(i + 1, i + 1, '.'.join(name for _, name in scopes) or None, None, None,
+                                         stripped, parse_format_string(lines, i, match.start())))
+    return statements
+
+
+def parse_source_file(path: str):
+    """
+    提取一个源码文件中的所有日志调用，返回 (文件内容的sha1, 语句列表)
+    语句: {line_number, end_line_number, function, function_range, class_range, log_statement, format_string, tokens}
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    source = content.decode('utf-8', errors='ignore')
+    lines = source.splitlines()
+    visitor = LogCallVisitor(lines)
+    if not visitor.candidate_lines:
+        return hashlib.sha1(content).hexdigest(), []
+    try:
+        visitor.visit(ast.parse(source))
+        statements = sorted(visitor.statements, key=lambda statement: statement['line_number'])
+    except (SyntaxError, ValueError):
+        statements = extract_log_statements_by_line(lines)
+    return hashlib.sha1(content).hexdigest(), statements
+
+
+def file_sha1(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class LogStatementIndex:
+    """
+    源码树中所有日志调用（LOG.*、logging.*等）的索引
+
+    首次使用时用ast并行解析一次源码树，记录每个日志调用的完整范围、所在函数和类的范围、格式字符串和token集合，
+    持久化到index_file。之后只重新解析内容变化的文件（先比较修改时间，再比较文件sha1），查询完全在内存中进行:
+    token -> 语句的倒排表用于筛选候选语句，不再需要glob、grep和重复读取文件。
+    """
+
+    def __init__(self, source_dir: str, index_file: Optional[str] = None, workers: Optional[int] = None):
+        self.source_dir = source_dir
+        self.index_file = index_file
+        self.workers = workers
+        self.files = {}  # 相对路径 -> {mtime, sha1, statements}
+        self.statements = []  # [(相对路径, 语句)]
+        self.postings = defaultdict(list)  # token -> 语句编号列表
+        self.matcher = None
+        self.refresh()
+
+    def _load(self) -> Dict[str, Any]:
+        if not self.index_file or not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+        if data.get('version') != INDEX_VERSION or data.get('source_dir') != os.path.abspath(self.source_dir):
+            return {}
+        return data['files']
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'source_dir': os.path.abspath(self.source_dir), 'files': self.files},
+                      f, ensure_ascii=False)
+        os.replace(tmp_file, self.index_file)
+
+    def refresh(self):
+        """加载已保存的索引，重新解析新增和修改过的文件，删除已不存在的文件"""
+        cached_files = self._load()
+        files = {}
+        to_parse = []  # [(相对路径, 修改时间)]
+        for root, _, names in os.walk(self.source_dir):
+            for name in names:
+                if not name.endswith('.py'):
+                    continue
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, self.source_dir)
+                mtime = os.stat(path).st_mtime_ns
+                cached = cached_files.get(rel_path)
+                if cached and cached['mtime'] == mtime:
+                    files[rel_path] = cached
+                elif cached and cached['sha1'] == file_sha1(path):
+                    # 只是修改时间变化，内容没变
+                    files[rel_path] = dict(cached, mtime=mtime)
+                else:
+                    to_parse.append((rel_path, mtime))
+
+        paths = [os.path.join(self.source_dir, rel_path) for rel_path, _ in to_parse]
+        if len(paths) >= PARALLEL_MIN_FILES and self.workers != 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                parsed = list(executor.map(parse_source_file, paths, chunksize=16))
+        else:
+            parsed = [parse_source_file(path) for path in paths]
+        for (rel_path, mtime), (sha1, statements) in zip(to_parse, parsed):
+            files[rel_path] = {'mtime': mtime, 'sha1': sha1, 'statements': statements}
+
+        changed = files != cached_files
+        self.files = files
+        self._build_postings()
+        if changed and self.index_file:
+            self._save()
+        print(f"日志语句索引: {len(self.files)} 个文件, {len(self.statements)} 条日志语句, 重新解析 {len(to_parse)} 个文件")
+
+    def _build_postings(self):
+        self.statements = []
+        self.postings = defaultdict(list)
+        for rel_path in sorted(self.files):
+            for statement in self.files[rel_path]['statements']:
+                statement_id = len(self.statements)
+                self.statements.append((rel_path, statement))
+                for token in statement['tokens']:
+                    self.postings[token].append(statement_id)
+        self.matcher = FormatStringMatcher(self.statements)
+        self._token_lookup.cache_clear()
+        self.module_files.cache_clear()
+
+    @lru_cache(maxsize=4096)
+    def _token_lookup(self, word: str) -> frozenset:
+        """包含word作为子串的token对应的所有语句编号"""
+        ids = set()
+        for token, statement_ids in self.postings.items():
+            if word in token:
+                ids.update(statement_ids)
+        return frozenset(ids)
+
+    def match_message(self, message: str):
+        """按格式字符串精确匹配日志消息，返回 ([语句编号], 置信度)"""
+        return self.matcher.match(message)
+
+    def candidates(self, words: List[str]) -> List[int]:
+        """语句中（作为子串）包含任一word的所有语句编号，按文件和行号排序"""
+        ids = set()
+        for word in set(words):
+            ids |= self._token_lookup(word)
+        return sorted(ids)
+
+    @lru_cache(maxsize=1024)
+    def module_files(self, module_name: str) -> frozenset:
+        """可能包含指定模块的文件（与find_module_files的glob规则一致）"""
+        parts = module_name.split('.')
+        patterns = []
+        for i in range(len(parts)):
+            patterns.append(f"*{'/'.join(parts[i:])}*.py")
+        patterns.append(f"*{parts[-1]}*.py")
+        return frozenset(rel_path for rel_path in self.files
+                         if any(fnmatch.fnmatch(rel_path, pattern) for pattern in patterns))
+
+    def path(self, rel_path: str) -> str:
+        return os.path.join(self.source_dir, rel_path)
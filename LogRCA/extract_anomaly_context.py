@@ -1,19 +1,29 @@
 import json
 import re
-from collections import defaultdict, Counter
-from typing import List, Dict, Any, Set, Tuple
+from collections import defaultdict, Counter, deque, OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Any, Iterator, Optional, Set, Tuple
 import os
 import time
 import yaml
 import argparse
+import numpy as np
 from tqdm import tqdm
 
+from nova_log_parser import parse_line
+from label_store import UUIDLabelStore, uuid_array
+from log_index import LogIndex
+from template_miner import mask_log
+
 # 读取配置文件
 def load_config(config_path="config.yaml"):
     with open(config_path, 'r', encoding='utf-8') as f:
         config = yaml.safe_load(f)
     return config
 
+# UUID格式的VM ID (如 "550e8400-e29b-41d4-a716-446655440000")
+UUID_PATTERN = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
 def read_anomaly_vms(file_path: str) -> List[str]:
     """读取包含异常VM ID的文件"""
     with open(file_path, 'r') as f:
@@ -21,94 +31,45 @@ def read_anomaly_vms(file_path: str) -> List[str]:
         next(f)
         return [line.strip() for line in f if line.strip()]
 
-def normalize_log(log_line: str) -> str:
-    """
-    标准化日志行，移除时间戳、ID等变动部分
-    """
-    # 移除日期时间格式 (如 "2023-05-20 15:30:45.123")
-    normalized = re.sub(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:\.\d+)?', 'TIMESTAMP', log_line)
-    
-    # 移除十六进制ID (如 "0x1a2b3c4d")
-    normalized = re.sub(r'0x[0-9a-fA-F]+', 'HEX_ID', normalized)
-    
-    # 移除UUID格式 (如 "550e8400-e29b-41d4-a716-446655440000")
-    normalized = re.sub(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}', 'UUID', normalized)
-    
-    # 移除IP地址 (如 "192.168.1.1")
-    normalized = re.sub(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', 'IP_ADDR', normalized)
-    
-    # 移除单独的数字 (如单独的数字如 "123" 或 "456")
-    normalized = re.sub(r'\b\d+\b', 'NUMBER', normalized)
-    
-    # 移除引号内容
-    normalized = re.sub(r'"[^"]*"', 'QUOTED_STRING', normalized)
-    normalized = re.sub(r"'[^']*'", 'QUOTED_STRING', normalized)
-    
-    return normalized
+# 日志行 -> 掩码后的模板缓存的最大条目数，与TemplateMiner的cache_size相同
+LINE_TEMPLATE_CACHE_SIZE = 100000
 
-def extract_log_template(logs: List[str]) -> Dict[str, List[int]]:
+@lru_cache(maxsize=LINE_TEMPLATE_CACHE_SIZE)
+def line_template(log: str) -> str:
     """
-    提取日志模板，将相似日志归为一组
-    返回模板到日志索引的映射
+    mask_log的逐行缓存: 同一VM相邻异常的上下文窗口互相重叠，同一行日志会被多次去重，
+    只在第一次执行正则替换
     """
-    templates = {}  # 模板 -> [日志索引列表]
-    
-    for i, log in enumerate(logs):
-        # 标准化日志行
-        normalized = normalize_log(log)
-        
-        # 添加到相应模板组
-        if normalized not in templates:
-            templates[normalized] = []
-        templates[normalized].append(i)
-    
-    return templates
-
-def are_logs_similar(log1: str, log2: str) -> bool:
-    """
-    判断两个日志是否相似，使用更精确的日志比较逻辑
-    """
-    # 标准化并比较
-    norm1 = normalize_log(log1)
-    norm2 = normalize_log(log2)
-    
-    # 完全相同的模板视为相似
-    if norm1 == norm2:
-        return True
-    
-    # 计算标准化后的单词级别的差异
-    words1 = set(norm1.split())
-    words2 = set(norm2.split())
-    
-    # 如果共同词占比超过85%则视为相似
-    common_words = words1.intersection(words2)
-    total_words = words1.union(words2)
-    if len(total_words) == 0:
-        return False
-    
-    similarity = len(common_words) / len(total_words)
-    return similarity > 0.85
+    return mask_log(log)
 
 def filter_similar_logs(logs: List[str]) -> List[str]:
     """
-    更智能地过滤相似日志
-    使用日志模板提取和更精确的相似度判断
+    按日志模板过滤相似日志，每个模板只保留第一条
+    模板为mask_log替换变量后的整行（按行缓存），只比较本组日志，结果与处理顺序和其他VM无关
     """
-    if not logs:
-        return []
-    
-    # 提取日志模板和对应索引
-    templates = extract_log_template(logs)
-    
-    # 为每个模板组保留一个代表性日志
+    seen_templates = set()
     unique_logs = []
-    for indices in templates.values():
-        if indices:  # 如果该模板组有日志
-            # 保留第一条作为代表
-            unique_logs.append(logs[indices[0]])
-    
+    for log in logs:
+        template = line_template(log)
+        if template not in seen_templates:
+            seen_templates.add(template)
+            unique_logs.append(log)
     return unique_logs
 
+def dedup_context_records(vm_results: List[Tuple[Dict[str, Any], List[str], List[str]]], context_size: int) -> List[Dict[str, Any]]:
+    """对一个VM的所有异常记录的上下文去重并限制长度"""
+    records = []
+    for anomaly_record, before_lines, after_lines in vm_results:
+        # 对上文和下文应用相似度过滤
+        filtered_before = filter_similar_logs(before_lines)
+        filtered_after = filter_similar_logs(after_lines)
+        
+        # 限制上下文长度
+        anomaly_record['context_before'] = filtered_before[:context_size]
+        anomaly_record['context_after'] = filtered_after[:context_size]
+        records.append(anomaly_record)
+    return records
+
 def extract_log_context(log_file: str, vm_ids: List[str], context_size: int = 3) -> List[Dict[str, Any]]:
     """提取异常日志及其上下文"""
     results = []
@@ -154,17 +115,257 @@ def extract_log_context(log_file: str, vm_ids: List[str], context_size: int = 3)
         if vm_results:
             print(f"对VM ID: {vm_id} 的上下文进行去重...")
             # 批量处理所有上下文进行更高效的去重
-            for anomaly_record, before_lines, after_lines in vm_results:
-                # 对上文和下文应用相似度过滤
-                filtered_before = filter_similar_logs(before_lines)
-                filtered_after = filter_similar_logs(after_lines)
-                
-                # 限制上下文长度
-                anomaly_record['context_before'] = filtered_before[:context_size]
-                anomaly_record['context_after'] = filtered_after[:context_size]
-                
-                # 添加到最终结果列表
-                results.append(anomaly_record)
+            results.extend(dedup_context_records(vm_results, context_size))
+    
+    return results
+
+class AhoCorasick:
+    """
+    Aho-Corasick多模式匹配自动机，一次扫描找出一行中出现的所有模式串
+    用于VM ID不是UUID格式、无法按UUID token查表的情况
+    """
+    def __init__(self, patterns: List[str]):
+        self.goto = [{}]  # 状态 -> {字符: 下一状态}
+        self.fail = [0]
+        self.output = [set()]
+        
+        # 构建字典树
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].add(pattern)
+        
+        # 按广度优先顺序构建失败指针
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+    
+    def find(self, text: str) -> Set[str]:
+        """返回text中出现的所有模式串"""
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+def build_vm_matcher(vm_ids: List[str]):
+    """
+    构建一次匹配所有VM ID的函数: 日志行 -> 行中出现的VM ID集合
+    VM ID都是UUID时，提取行中的UUID token并查哈希表；否则使用Aho-Corasick自动机
+    """
+    vm_set = set(vm_ids)
+    if all(UUID_PATTERN.fullmatch(vm_id) for vm_id in vm_set):
+        def match_uuid(line: str) -> Set[str]:
+            return {token for token in UUID_PATTERN.findall(line) if token in vm_set}
+        return match_uuid
+    
+    automaton = AhoCorasick(list(vm_set))
+    return automaton.find
+
+def extract_log_context_single_pass(log_file: str, vm_ids: List[str], context_size: int = 3) -> List[Dict[str, Any]]:
+    """
+    单次顺序扫描提取所有VM的异常日志及其上下文
+    日志按行流式读取，上文保存在长度为context_size的环形缓冲区中，下文在后续行到达时补齐，
+    内存占用与日志文件大小无关。输出与extract_log_context相同。
+    """
+    match_vms = build_vm_matcher(vm_ids)
+    vm_results = {vm_id: [] for vm_id in vm_ids}  # VM ID -> [(记录, 上文, 下文)]
+    before_buffer = deque(maxlen=context_size)  # 最近的context_size行
+    pending_after = []  # 下文尚未收集满的记录的下文列表
+    
+    print(f"单次扫描日志文件，匹配 {len(set(vm_ids))} 个VM ID...")
+    with open(log_file, 'r') as f, tqdm(total=os.path.getsize(log_file), unit='B', unit_scale=True, desc="扫描日志") as pbar:
+        read_size = 0
+        for line_count, line in enumerate(f, 1):
+            read_size += len(line)
+            if line_count % 65536 == 0:
+                pbar.update(read_size)
+                read_size = 0
+            
+            stripped = line.strip()
+            # 当前行作为之前异常记录的下文
+            if pending_after:
+                for after_lines in pending_after:
+                    after_lines.append(stripped)
+                pending_after = [after_lines for after_lines in pending_after if len(after_lines) < context_size]
+            
+            matched_vms = match_vms(line)
+            if matched_vms:
+                before_lines = list(before_buffer)
+                for vm_id in matched_vms:
+                    anomaly_record = {
+                        'vm_id': vm_id,
+                        'anomaly_log': stripped,
+                        'context_before': [],
+                        'context_after': []
+                    }
+                    after_lines = []
+                    vm_results[vm_id].append((anomaly_record, before_lines, after_lines))
+                    if context_size > 0:
+                        pending_after.append(after_lines)
+            
+            before_buffer.append(stripped)
+        pbar.update(read_size)
+    
+    # 按VM ID顺序输出，每个VM的记录保持日志顺序
+    results = []
+    for vm_id in vm_ids:
+        print(f"找到 {len(vm_results[vm_id])} 条包含 {vm_id} 的异常日志")
+        results.extend(dedup_context_records(vm_results[vm_id], context_size))
+    
+    return results
+
+def iter_log_context_indexed(log_file: str, vm_ids: List[str], context_size: int = 3,
+                             labels: Optional[UUIDLabelStore] = None) -> Iterator[Dict[str, Any]]:
+    """
+    通过LogIndex提取异常日志及其上下文，逐个VM产出记录
+    首次运行时建立索引，之后直接按倒排表定位包含VM ID的行，按行偏移从mmap中读取上下文，
+    无需再扫描日志。索引中的UUID与异常标签一次向量化求交，日志中没有出现的VM不再逐个查倒排表。
+    labels为vm_ids对应的UUIDLabelStore，不传时由vm_ids构建。
+    VM ID不是UUID格式时退回单次扫描。输出与extract_log_context相同。
+    """
+    if labels is None:
+        try:
+            labels = UUIDLabelStore.from_uuids(vm_ids)
+        except ValueError:
+            print("VM ID不全是UUID格式，无法使用日志索引，改用单次扫描")
+            yield from extract_log_context_single_pass(log_file, vm_ids, context_size)
+            return
+    
+    with LogIndex(log_file) as index:
+        # 索引键按字节排序，UUID都排在 "req-" 开头的请求ID之前
+        uuid_keys = index.keys[:int(np.searchsorted(index.keys, b'req-'))]
+        present = {key.decode('ascii') for key in uuid_keys[labels.contains(uuid_array(uuid_keys))]}
+        for vm_id in vm_ids:
+            vm_results = []
+            for line_no in (index.lookup(vm_id) if vm_id in present else ()):
+                before_lines, anomaly_log, after_lines = index.context(line_no, context_size)
+                anomaly_record = {
+                    'vm_id': vm_id,
+                    'anomaly_log': anomaly_log,
+                    'context_before': [],
+                    'context_after': []
+                }
+                vm_results.append((anomaly_record, before_lines, after_lines))
+            
+            print(f"找到 {len(vm_results)} 条包含 {vm_id} 的异常日志")
+            yield from dedup_context_records(vm_results, context_size)
+
+def extract_log_context_indexed(log_file: str, vm_ids: List[str], context_size: int = 3,
+                                labels: Optional[UUIDLabelStore] = None) -> List[Dict[str, Any]]:
+    """iter_log_context_indexed的列表版本"""
+    return list(iter_log_context_indexed(log_file, vm_ids, context_size, labels))
+
+def iter_log_context(log_file: str, vm_ids: List[str], context_size: int = 3, mode: str = 'neighbor',
+                     use_index: bool = True, labels: Optional[UUIDLabelStore] = None) -> Iterator[Dict[str, Any]]:
+    """
+    按上下文模式选择提取方式，产出异常记录
+    使用日志索引时记录逐个VM产出；单次扫描需要读完日志才能确定每条记录的下文，扫描结束后一并产出
+    """
+    if mode == 'correlated':
+        yield from extract_log_context_correlated(log_file, vm_ids, context_size)
+    elif not use_index:
+        yield from extract_log_context_single_pass(log_file, vm_ids, context_size)
+    else:
+        yield from iter_log_context_indexed(log_file, vm_ids, context_size, labels)
+
+def load_anomaly_labels(anomaly_vms_file: str) -> Optional[UUIDLabelStore]:
+    """加载标签文件的UUID集合（sidecar文件缓存，重复运行时直接mmap加载），存在非UUID的ID时返回None"""
+    try:
+        return UUIDLabelStore.load(anomaly_vms_file)
+    except ValueError:
+        return None
+
+def get_request_id(line: str):
+    """解析日志行的请求ID，返回 "req-<uuid>"，没有请求ID时返回None"""
+    record = parse_line(line)
+    if record and record.request_id and UUID_PATTERN.fullmatch(record.request_id[len('req-'):]):
+        return record.request_id
+    return None
+
+def extract_log_context_correlated(log_file: str, vm_ids: List[str], context_size: int = 3,
+                                   max_open_requests: int = 100000) -> List[Dict[str, Any]]:
+    """
+    关联模式：按请求ID和实例ID提取异常日志的上下文
+    nova-api/compute日志中的相邻行常常属于其他进程交错的请求，与异常无关。本模式单次流式扫描日志，
+    把日志按请求ID分组为时间线，异常日志的上下文取自同一请求的前后日志；没有请求ID时按实例ID关联。
+    每条时间线只保留最近context_size行，最多保留max_open_requests条最近活跃的时间线。
+    """
+    match_vms = build_vm_matcher(vm_ids)
+    vm_results = {vm_id: [] for vm_id in vm_ids}  # VM ID -> [(记录, 上文, 下文)]
+    timelines = OrderedDict()  # 关联键(请求ID或VM ID) -> 最近的context_size行，按最近活跃排序
+    pending_after = {}  # 关联键 -> 下文尚未收集满的记录的下文列表
+    
+    print(f"单次扫描日志文件，按请求关联 {len(set(vm_ids))} 个VM ID的上下文...")
+    with open(log_file, 'r') as f, tqdm(total=os.path.getsize(log_file), unit='B', unit_scale=True, desc="扫描日志") as pbar:
+        read_size = 0
+        for line_count, line in enumerate(f, 1):
+            read_size += len(line)
+            if line_count % 65536 == 0:
+                pbar.update(read_size)
+                read_size = 0
+            
+            stripped = line.strip()
+            request_id = get_request_id(line)
+            matched_vms = match_vms(line)
+            keys = ([request_id] if request_id else []) + list(matched_vms)
+            
+            # 当前行作为同一请求（或同一VM）之前异常记录的下文
+            for key in keys:
+                if key in pending_after:
+                    for after_lines in pending_after[key]:
+                        after_lines.append(stripped)
+                    remaining = [after_lines for after_lines in pending_after[key] if len(after_lines) < context_size]
+                    if remaining:
+                        pending_after[key] = remaining
+                    else:
+                        del pending_after[key]
+            
+            for vm_id in matched_vms:
+                context_key = request_id or vm_id
+                anomaly_record = {
+                    'vm_id': vm_id,
+                    'request_id': request_id,
+                    'anomaly_log': stripped,
+                    'context_before': [],
+                    'context_after': []
+                }
+                after_lines = []
+                vm_results[vm_id].append((anomaly_record, list(timelines.get(context_key, ())), after_lines))
+                if context_size > 0:
+                    pending_after.setdefault(context_key, []).append(after_lines)
+            
+            for key in keys:
+                if key not in timelines:
+                    timelines[key] = deque(maxlen=context_size)
+                    if len(timelines) > max_open_requests:
+                        timelines.popitem(last=False)
+                else:
+                    timelines.move_to_end(key)
+                timelines[key].append(stripped)
+        pbar.update(read_size)
+    
+    results = []
+    for vm_id in vm_ids:
+        print(f"找到 {len(vm_results[vm_id])} 条包含 {vm_id} 的异常日志")
+        results.extend(dedup_context_records(vm_results[vm_id], context_size))
     
     return results
 
@@ -178,6 +379,9 @@ def main():
     parser.add_argument("--log-file", type=str, help="日志文件路径")
     parser.add_argument("--output", type=str, help="输出文件路径")
     parser.add_argument("--context-size", type=int, help="上下文大小")
+    parser.add_argument("--no-index", action="store_true", help="不使用日志索引，单次扫描日志文件")
+    parser.add_argument("--mode", type=str, choices=["neighbor", "correlated"],
+                        help="上下文模式: neighbor为相邻行, correlated为同一请求/实例的前后日志")
     args = parser.parse_args()
     
     # 加载配置
@@ -193,6 +397,7 @@ def main():
     
     # 上下文大小
     context_size = args.context_size or config['log_analysis']['context_size']
+    context_mode = args.mode or config['log_analysis'].get('context_mode', 'neighbor')
     
     # 确保输出目录存在
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
@@ -202,13 +407,16 @@ def main():
     print(f"日志文件: {log_file}")
     print(f"输出文件: {output_file}")
     print(f"上下文大小: {context_size}")
+    print(f"上下文模式: {context_mode}")
     
     # 读取异常VM ID
     vm_ids = read_anomaly_vms(anomaly_vms_file)
     print(f"读取到 {len(vm_ids)} 个异常VM ID")
     
     # 提取日志上下文
-    results = extract_log_context(log_file, vm_ids, context_size)
+    use_index = not args.no_index and config['log_analysis'].get('use_log_index', True)
+    labels = load_anomaly_labels(anomaly_vms_file) if use_index and context_mode != 'correlated' else None
+    results = list(iter_log_context(log_file, vm_ids, context_size, context_mode, use_index, labels))
     
     # 保存结果
     print(f"保存结果到 {output_file}...")
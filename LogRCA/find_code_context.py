@@ -1,22 +1,41 @@
 import json
 import os
 import re
-import subprocess
 import hashlib
 import yaml
 from collections import defaultdict
 from tqdm import tqdm
 import glob
 import argparse
+import io
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+
+from code_index import LogStatementIndex
+from nova_log_parser import format_timestamp, parse_line
+from template_miner import mask_log
 
 # 日志语句模式，扩展匹配范围
 LOG_CODE_PATTERN = re.compile(
     r"(LOG\.\w+\(|logging\.\w+\(|\.\w+_log\(|\w+log\(|print\()"
 )
 
-# 创建日志片段到代码的缓存，避免重复搜索
+# wsgi访问日志的消息: IP "方法 路径 ..."
+API_PATTERN = re.compile(r'(?P<ip>[\d\.]+) "(?P<method>\w+) (?P<api_path>[^\s"]+)[^"]*"')
+
+# 日志模板到代码的缓存，避免重复搜索，键为 (模块, 去掉变量部分的消息)
 CODE_CACHE = {}
 
+# 需要解析的不同日志模板数超过该值时使用进程池并行解析
+PARALLEL_MIN_LOGS = 64
+
+# 源码目录 -> 日志语句索引
+STATEMENT_INDEXES = {}
+
+# 函数源码最多保留的行数
+MAX_FUNCTION_LINES = 80
+
 # 读取配置文件
 def load_config(config_path="config.yaml"):
     with open(config_path, 'r', encoding='utf-8') as f:
@@ -25,16 +44,9 @@ def load_config(config_path="config.yaml"):
 
 def extract_log_info(log_line):
     """解析日志行，提取详细信息"""
-    # 更强大的OpenStack日志解析正则表达式
-    LOG_PATTERN = re.compile(
-        r"(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d+) "
-        r"(?P<pid>\d+) (?P<level>\w+) (?P<module>[\w\.]+) "
-        r"\[(?:req-)?(?P<request_id>[\w-]+)(?:.*?)\] "
-        r"(?:(?P<ip>[\d\.]+) \"(?P<method>\w+) (?P<api_path>[^\s\"]+).*?\"|(?P<message>.*))"
-    )
-    
-    match = LOG_PATTERN.search(log_line)
-    if not match:
+    # 标准nova日志行由nova_log_parser按快速路径解析
+    record = parse_line(log_line)
+    if record is None:
         # 尝试使用简化的模式匹配
         simple_pattern = re.compile(
             r"(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d+).*?"
@@ -51,15 +63,32 @@ def extract_log_info(log_line):
                     "message": " ".join(parts[4:])
                 }
             return {"full_text": log_line.strip()}
+        
+        info = {
+            "full_text": log_line.strip()
+        }
+        for field in ["timestamp", "level", "module", "message"]:
+            if match.group(field):
+                info[field] = match.group(field).strip()
+        return info
     
     info = {
-        "full_text": log_line.strip()
+        "full_text": log_line.strip(),
+        "timestamp": format_timestamp(record.timestamp),
+        "pid": str(record.pid),
+        "level": record.level.name,
+        "module": record.module
     }
+    if record.request_id:
+        info["request_id"] = record.request_id[len('req-'):]
     
-    # 提取所有匹配的字段
-    for field in ["timestamp", "pid", "level", "module", "request_id", "method", "api_path", "message"]:
-        if match.group(field):
-            info[field] = match.group(field).strip()
+    # API访问日志: IP "方法 路径 ..."
+    api_match = API_PATTERN.match(record.message)
+    if api_match:
+        info["method"] = api_match.group('method')
+        info["api_path"] = api_match.group('api_path')
+    elif record.message.strip():
+        info["message"] = record.message.strip()
     
     return info
 
@@ -87,123 +116,109 @@ def find_all_python_files(source_dir):
     """找到源码目录下所有的Python文件"""
     return glob.glob(f"{source_dir}/**/*.py", recursive=True)
 
-def find_module_files(module_name, source_dir):
-    """查找可能包含指定模块的Python文件"""
-    potential_files = []
-    
-    # 尝试直接基于模块名查找
-    module_path_parts = module_name.split('.')
-    for i in range(len(module_path_parts)):
-        partial_module = '.'.join(module_path_parts[i:])
-        
-        # 使用glob模式匹配
-        pattern = f"{source_dir}/**/*{partial_module.replace('.', '/')}*.py"
-        module_files = glob.glob(pattern, recursive=True)
-        potential_files.extend(module_files)
-        
-        # 尝试找到包含模块名的文件
-        last_part = module_path_parts[-1]
-        pattern = f"{source_dir}/**/*{last_part}*.py"
-        name_files = glob.glob(pattern, recursive=True)
-        potential_files.extend(name_files)
-    
-    # 去重
-    return list(set(potential_files))
+def get_statement_index(source_dir, index_file=None):
+    """获取源码目录的日志语句索引，每个目录只加载一次；index_file为None时不持久化"""
+    key = os.path.abspath(source_dir)
+    if key not in STATEMENT_INDEXES:
+        STATEMENT_INDEXES[key] = LogStatementIndex(source_dir, index_file)
+    return STATEMENT_INDEXES[key]
 
-def find_exact_log_statement(log_info, source_dir):
-    """尝试在源码中找到与日志消息匹配的LOG语句"""
-    if not log_info:
-        return None
-    
-    # 检查缓存
-    cache_key = log_info.get('full_text', '')[:100]  # 使用前100个字符作为缓存键
-    if cache_key in CODE_CACHE:
-        return CODE_CACHE[cache_key]
-    
+def get_function_context(file_path, statement, max_lines=MAX_FUNCTION_LINES):
+    """日志调用所在函数的源码，函数过长时只保留日志调用附近的max_lines行"""
+    function_range = statement.get('function_range')
+    if not function_range:
+        return []
+    start, end = function_range
+    if end - start + 1 > max_lines:
+        start = max(start, statement['line_number'] - max_lines // 2)
+        end = min(end, start + max_lines - 1)
+    try:
+        all_lines = read_source_lines(file_path)
+    except Exception as e:
+        print(f"获取文件 {file_path} 函数源码时出错: {str(e)}")
+        return []
+    return [{'line_number': i, 'content': all_lines[i - 1].rstrip()} for i in range(start, min(end, len(all_lines)) + 1)]
+
+def build_code_context(index, rel_path, statement, match_score, match_type):
+    """日志语句的代码上下文"""
+    py_file = index.path(rel_path)
+    return {
+        'file': py_file,
+        'line_number': statement['line_number'],
+        'end_line_number': statement['end_line_number'],
+        'function': statement['function'],
+        'log_statement': statement['log_statement'],
+        'format_string': statement['format_string'],
+        'context': get_file_context(py_file, statement['line_number']),
+        'function_context': get_function_context(py_file, statement),
+        'match_score': match_score,
+        'match_type': match_type
+    }
+
+def get_log_message(log_info):
+    """日志消息，解析失败时取完整文本第5个空格之后的部分"""
     message = log_info.get('message', '')
     if not message and 'full_text' in log_info:
         parts = log_info['full_text'].split(' ', 4)
         if len(parts) > 4:
             message = parts[4]
+    return message
+
+def code_cache_key(log_info):
+    """代码缓存的键: 模块和去掉时间戳、ID、数字等变量部分的消息，同一模板的日志共享结果"""
+    return log_info.get('module'), mask_log(get_log_message(log_info))
+
+def find_exact_log_statement(log_info, source_dir):
+    """尝试在源码中找到与日志消息匹配的LOG语句"""
+    if not log_info:
+        return None
     
+    message = get_log_message(log_info)
     if not message:
         return None
     
+    # 检查缓存
+    cache_key = code_cache_key(log_info)
+    if cache_key in CODE_CACHE:
+        return CODE_CACHE[cache_key]
+    
     # 提取关键词
     keywords = extract_keywords(message)
     if not keywords:
         return None
     
-    # 确定要搜索的文件
-    potential_files = []
-    
-    # 如果有模块信息，优先基于模块查找
-    if 'module' in log_info:
-        module_files = find_module_files(log_info['module'], source_dir)
-        potential_files.extend(module_files)
-    
-    # 如果没有找到文件或文件数量太少，尝试基于关键词搜索整个源码
-    if len(potential_files) < 5:
-        for keyword in keywords[:2]:  # 只使用前两个关键词避免搜索过多
-            cmd = f"grep -l '{keyword}' {source_dir}/**/*.py 2>/dev/null || true"
-            try:
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-                if result.stdout:
-                    keyword_files = result.stdout.splitlines()
-                    potential_files.extend(keyword_files)
-            except Exception:
-                pass
-    
-    # 去重
-    potential_files = list(set(potential_files))
-    
-    # 如果仍然没有找到文件，返回所有Python文件（最后的尝试）
-    if not potential_files:
-        try:
-            all_files_cmd = f"find {source_dir} -name '*.py' | head -50"  # 限制文件数量
-            result = subprocess.run(all_files_cmd, shell=True, capture_output=True, text=True)
-            if result.stdout:
-                potential_files = result.stdout.splitlines()
-        except Exception:
-            pass
-    
-    # 在每个文件中搜索日志语句
-    best_match = None
-    best_score = 0
+    index = get_statement_index(source_dir)
+    module_files = index.module_files(log_info['module']) if 'module' in log_info else set()
     
-    for py_file in potential_files:
-        # 检查文件是否存在
-        if not os.path.exists(py_file):
-            continue
-            
-        try:
-            # 读取文件内容
-            with open(py_file, 'r', encoding='utf-8', errors='ignore') as f:
-                file_content = f.read()
-            
-            # 在文件中查找所有LOG语句
-            log_lines = []
-            for i, line in enumerate(file_content.splitlines(), 1):
-                if LOG_CODE_PATTERN.search(line):
-                    log_lines.append((i, line))
-            
-            # 对每个LOG语句计算与日志消息的匹配分数
-            for line_num, line in log_lines:
-                match_score = calculate_match_score(line, message, keywords)
-                if match_score > best_score:
-                    best_score = match_score
-                    best_match = {
-                        'file': py_file,
-                        'line_number': line_num,
-                        'log_statement': line.strip(),
-                        'context': get_file_context(py_file, line_num),
-                        'match_score': match_score
-                    }
-        except Exception as e:
-            print(f"处理文件 {py_file} 时出错: {str(e)}")
+    # 优先按格式字符串精确匹配，多个语句匹配时优先选择模块对应文件中的语句
+    matched_ids, confidence = index.match_message(message)
+    if matched_ids:
+        statement_id = next((i for i in matched_ids if index.statements[i][0] in module_files), matched_ids[0])
+        rel_path, statement = index.statements[statement_id]
+        result = build_code_context(index, rel_path, statement, confidence, 'format_string')
+        CODE_CACHE[cache_key] = result
+        return result
+    
+    # 没有精确匹配时使用关键词启发式：从索引中取出包含关键词或消息片段的日志语句作为候选
+    msg_parts = [p for p in re.split(r'[^\w]+', message.lower()) if len(p) > 3]
+    candidate_ids = index.candidates(keywords + msg_parts)
+    
+    # 如果有模块信息，优先选择模块对应文件中分数足够高的语句
+    best_match = None
+    best_key = (False, 0)
+    for statement_id in candidate_ids:
+        rel_path, statement = index.statements[statement_id]
+        match_score = calculate_match_score(statement['log_statement'], message, keywords)
+        match_key = (match_score > 0.3 and rel_path in module_files, match_score)
+        if match_key > best_key:
+            best_key = match_key
+            best_match = (rel_path, statement, match_score)
     
     # 只有当匹配分数足够高时才返回结果
-    result = best_match if best_score > 0.3 else None
+    result = None
+    if best_match and best_key[1] > 0.3:
+        rel_path, statement, match_score = best_match
+        result = build_code_context(index, rel_path, statement, match_score, 'keyword')
     
     # 保存到缓存
     CODE_CACHE[cache_key] = result
@@ -232,11 +247,21 @@ def calculate_match_score(code_line, log_message, keywords):
     # 归一化分数
     return min(score, 1.0)
 
+@lru_cache(maxsize=256)
+def read_source_file(file_path):
+    """读取源码文件内容，同一文件只读取一次"""
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        return f.read()
+
+@lru_cache(maxsize=256)
+def read_source_lines(file_path):
+    """源码文件按行切分（与readlines相同），同一文件只切分一次"""
+    return tuple(io.StringIO(read_source_file(file_path)).readlines())
+
 def get_file_context(file_path, line_number, context_lines=5):
     """获取文件中指定行的上下文"""
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            all_lines = f.readlines()
+        all_lines = read_source_lines(file_path)
         
         start_line = max(0, line_number - context_lines - 1)
         end_line = min(len(all_lines), line_number + context_lines)
@@ -254,78 +279,104 @@ def get_file_context(file_path, line_number, context_lines=5):
         print(f"获取文件 {file_path} 上下文时出错: {str(e)}")
         return []
 
-def find_code_for_logs(anomaly_data, source_dir):
-    """为异常日志和上下文日志查找代码上下文"""
-    results = []
-    
-    # 遍历每条异常记录
-    for i, record in enumerate(tqdm(anomaly_data, desc="处理异常记录")):
-        vm_id = record['vm_id']
-        anomaly_log = record['anomaly_log']
-        context_before = record['context_before']
-        context_after = record['context_after']
-        
-        # 为异常日志查找代码上下文
-        anomaly_info = extract_log_info(anomaly_log)
-        print(f"\n处理VM ID: {vm_id}的异常日志")
-        print(f"日志内容: {anomaly_log[:100]}...")
-        
-        code_context = find_exact_log_statement(anomaly_info, source_dir)
-        if code_context:
-            print(f"找到匹配代码! 文件: {os.path.basename(code_context['file'])}, 行: {code_context['line_number']}")
-        else:
-            print("未找到匹配代码")
-        
-        # 创建结果记录
-        result_record = {
-            'vm_id': vm_id,
-            'anomaly_log': {
-                'text': anomaly_log,
-                'parsed_info': anomaly_info,
-                'code_context': code_context
-            },
-            'context_before': [],
-            'context_after': []
+def resolve_code_contexts(log_infos, source_dir, index_file=None, workers=None, progress=True):
+    """
+    按日志模板去重后解析所有日志的代码上下文，结果写入CODE_CACHE
+    不同模板较多且索引已持久化时用进程池并行解析，每个进程从index_file加载索引；
+    progress为False时不输出模板数和进度条
+    """
+    unique_infos = {}
+    for log_info in log_infos:
+        if not get_log_message(log_info):
+            continue
+        cache_key = code_cache_key(log_info)
+        if cache_key not in CODE_CACHE and cache_key not in unique_infos:
+            unique_infos[cache_key] = log_info
+    
+    if progress:
+        print(f"{len(unique_infos)} 个不同的日志模板需要查找代码")
+    if len(unique_infos) >= PARALLEL_MIN_LOGS and index_file and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=get_statement_index,
+                                 initargs=(source_dir, index_file)) as executor:
+            results = executor.map(find_exact_log_statement, unique_infos.values(), repeat(source_dir), chunksize=8)
+            for cache_key, result in zip(unique_infos, tqdm(results, total=len(unique_infos), desc="查找代码", disable=not progress)):
+                CODE_CACHE[cache_key] = result
+    else:
+        for log_info in tqdm(unique_infos.values(), desc="查找代码", disable=not progress):
+            find_exact_log_statement(log_info, source_dir)
+
+def lookup_code_context(log_info):
+    """从CODE_CACHE中取出已解析的代码上下文"""
+    if not get_log_message(log_info):
+        return None
+    return CODE_CACHE.get(code_cache_key(log_info))
+
+def parse_record_logs(anomaly_data, log_infos):
+    """解析记录中尚未解析过的日志行，结果存入log_infos（日志行 -> 解析信息），返回新解析的日志行"""
+    new_logs = []
+    for record in anomaly_data:
+        for log in [record['anomaly_log']] + record['context_before'] + record['context_after']:
+            if log not in log_infos:
+                log_infos[log] = extract_log_info(log)
+                new_logs.append(log)
+    return new_logs
+
+def resolve_record(record, log_infos):
+    """为一条异常记录的每行日志附上解析信息和代码上下文"""
+    def resolve(log):
+        return {
+            'text': log,
+            'parsed_info': log_infos[log],
+            'code_context': lookup_code_context(log_infos[log])
         }
-        
-        # 为上文日志查找代码上下文
-        print(f"处理 {len(context_before)} 条上文日志...")
-        for log in tqdm(context_before, desc="处理上文"):
-            log_info = extract_log_info(log)
-            code = find_exact_log_statement(log_info, source_dir)
-            
-            result_record['context_before'].append({
-                'text': log,
-                'parsed_info': log_info,
-                'code_context': code
-            })
-        
-        # 为下文日志查找代码上下文
-        print(f"处理 {len(context_after)} 条下文日志...")
-        for log in tqdm(context_after, desc="处理下文"):
-            log_info = extract_log_info(log)
-            code = find_exact_log_statement(log_info, source_dir)
-            
-            result_record['context_after'].append({
-                'text': log,
-                'parsed_info': log_info,
-                'code_context': code
-            })
-        
-        results.append(result_record)
-        
-        # 输出当前找到的匹配率
-        found_anomaly = 1 if result_record['anomaly_log']['code_context'] else 0
-        found_before = sum(1 for item in result_record['context_before'] if item['code_context'])
-        found_after = sum(1 for item in result_record['context_after'] if item['code_context'])
-        
-        total_before = len(result_record['context_before'])
-        total_after = len(result_record['context_after'])
-        
-        print(f"当前匹配率 - 异常日志: {found_anomaly}/1, 上文: {found_before}/{total_before}, 下文: {found_after}/{total_after}")
+    
+    return {
+        'vm_id': record['vm_id'],
+        'anomaly_log': resolve(record['anomaly_log']),
+        'context_before': [resolve(log) for log in record['context_before']],
+        'context_after': [resolve(log) for log in record['context_after']]
+    }
+
+def find_code_for_logs(anomaly_data, source_dir, index_file=None, workers=None):
+    """为异常日志和上下文日志查找代码上下文"""
+    # 先解析所有记录中的不同日志行，再按模板去重查找代码
+    log_infos = {}
+    parse_record_logs(anomaly_data, log_infos)
+    print(f"{len(anomaly_data)} 条异常记录共 {len(log_infos)} 条不同的日志")
+    resolve_code_contexts(log_infos.values(), source_dir, index_file, workers)
+    
+    results = [resolve_record(record, log_infos) for record in anomaly_data]
+    
+    # 输出总体匹配率
+    found_anomaly = sum(1 for result in results if result['anomaly_log']['code_context'])
+    found_before = sum(1 for result in results for item in result['context_before'] if item['code_context'])
+    found_after = sum(1 for result in results for item in result['context_after'] if item['code_context'])
+    total_before = sum(len(result['context_before']) for result in results)
+    total_after = sum(len(result['context_after']) for result in results)
+    print(f"匹配率 - 异常日志: {found_anomaly}/{len(results)}, 上文: {found_before}/{total_before}, 下文: {found_after}/{total_after}")
     
     return results
 
+def iter_code_for_logs(anomaly_records, source_dir, index_file=None, workers=1, batch_size=8):
+    """
+    find_code_for_logs的流式版本: 每收到batch_size条异常记录就查找一次代码并产出结果
+    各批共享日志解析结果和CODE_CACHE，之前批次见过的模板不再查找
+    """
+    log_infos = {}
+    batch = []
+    for record in anomaly_records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield from resolve_code_batch(batch, log_infos, source_dir, index_file, workers)
+            batch = []
+    if batch:
+        yield from resolve_code_batch(batch, log_infos, source_dir, index_file, workers)
+
+def resolve_code_batch(batch, log_infos, source_dir, index_file, workers):
+    new_logs = parse_record_logs(batch, log_infos)
+    resolve_code_contexts([log_infos[log] for log in new_logs], source_dir, index_file, workers, progress=False)
+    return [resolve_record(record, log_infos) for record in batch]
+
 def main():
     # 解析命令行参数
     parser = argparse.ArgumentParser(description="查找日志对应的代码上下文")
@@ -333,6 +384,7 @@ def main():
     parser.add_argument("--source", type=str, help="源码目录路径")
     parser.add_argument("--input", type=str, help="输入文件路径")
     parser.add_argument("--output", type=str, help="输出文件路径")
+    parser.add_argument("--workers", type=int, help="并行查找代码的进程数，默认为CPU核数，1为不并行")
     args = parser.parse_args()
     
     # 加载配置
@@ -349,6 +401,9 @@ def main():
     input_file = args.input or os.path.join(script_dir, output_config['output_dir'], output_config['anomaly_context_file'])
     output_file = args.output or os.path.join(script_dir, output_config['output_dir'], output_config['code_context_file'])
     
+    # 日志语句索引文件
+    index_file = os.path.join(script_dir, config['source_code'].get('log_index_file', os.path.join(output_config['output_dir'], 'log_statement_index.json')))
+    
     # 确保输出目录存在
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     
@@ -362,9 +417,12 @@ def main():
         with open(input_file, 'r', encoding='utf-8') as f:
             anomaly_data_list = json.load(f)
     
+        # 加载（必要时建立）日志语句索引
+        get_statement_index(source_dir, index_file)
+        
         # 为每条异常日志查找代码上下文
         print(f"处理 {len(anomaly_data_list)} 条异常记录...")
-        result_list = find_code_for_logs(anomaly_data_list, source_dir)
+        result_list = find_code_for_logs(anomaly_data_list, source_dir, index_file, args.workers)
     
     # 保存结果
         with open(output_file, 'w', encoding='utf-8') as f:
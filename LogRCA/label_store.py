@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+from typing import List
+
+import numpy as np
+
+# UUID中"-"所在的列和十六进制数字所在的列
+DASH_COLUMNS = [8, 13, 18, 23]
+HEX_COLUMNS = [i for i in range(36) if i not in DASH_COLUMNS]
+
+# ASCII -> 十六进制数值，非十六进制字符为255
+HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+for digit in b'0123456789abcdef':
+    HEX_VALUES[digit] = int(chr(digit), 16)
+for digit in b'ABCDEF':
+    HEX_VALUES[digit] = int(chr(digit), 16)
+
+# 标签文件格式版本，格式变化时旧文件自动重建
+STORE_VERSION = 1
+
+
+def replace_file(path, write, mode='w'):
+    """
+    先写入本线程的临时文件再os.replace到path，读取方不会看到写了一半的文件；
+    其他线程已mmap的旧文件被替换而不是被截断。
+    LogRAG/utils/label_store.py中有相同的函数：两个项目分别安装和运行，没有共用的包
+    """
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def uuid_array(uuids) -> np.ndarray:
+    """
+    UUID字符串 -> (n, 2) uint64数组，每行为128位整数的高64位和低64位
+    按字节矩阵整体查表转换，不逐个调用int()；存在不是UUID格式的ID时抛出ValueError
+    """
+    if not isinstance(uuids, np.ndarray):
+        uuids = [uuid.encode('ascii') if isinstance(uuid, str) else uuid for uuid in uuids]
+    # 多留一个字节，超过36个字符的ID不会被截断成合法的UUID
+    chars = np.asarray(uuids, dtype='S37').reshape(-1).view(np.uint8).reshape(-1, 37)
+    nibbles = HEX_VALUES[chars[:, HEX_COLUMNS]]
+    if (nibbles > 15).any() or (chars[:, DASH_COLUMNS] != ord('-')).any() or chars[:, 36].any():
+        raise ValueError("存在不是UUID格式的ID")
+    octets = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+    return np.ascontiguousarray(octets).view('>u8').astype(np.uint64)
+
+
+def uuid_strings(ids: np.ndarray) -> List[str]:
+    """uuid_array的逆变换，输出小写UUID字符串"""
+    hex_text = np.ascontiguousarray(ids, dtype='>u8').tobytes().hex()
+    return [f"{hex_text[i:i + 8]}-{hex_text[i + 8:i + 12]}-{hex_text[i + 12:i + 16]}-"
+            f"{hex_text[i + 16:i + 20]}-{hex_text[i + 20:i + 32]}" for i in range(0, len(hex_text), 32)]
+
+
+class UUIDLabelStore:
+    """
+    异常实例UUID集合
+    UUID以128位整数保存为按(高64位, 低64位)排序去重的 (n, 2) uint64数组，一万个UUID占160KB；
+    成员判断对一批UUID向量化二分查找。从标签文件加载时在旁边保存sidecar文件，之后用mmap打开：
+    - <labels>.store.npy: 排序后的UUID数组
+    - <labels>.store.meta.json: 标签文件大小和修改时间，标签文件变化后重建
+    """
+
+    def __init__(self, ids: np.ndarray):
+        self.ids = ids
+        self.high = ids[:, 0]
+        self.low = ids[:, 1]
+
+    @classmethod
+    def from_uuids(cls, uuids) -> 'UUIDLabelStore':
+        ids = uuid_array(uuids)
+        if len(ids):
+            ids = np.unique(ids, axis=0)
+        return cls(ids)
+
+    @classmethod
+    def load(cls, labels_file: str, rebuild: bool = False) -> 'UUIDLabelStore':
+        """加载标签文件（第一行为注释，之后每行一个UUID），优先使用仍然有效的sidecar文件"""
+        store_path = labels_file + '.store.npy'
+        meta_path = labels_file + '.store.meta.json'
+        stat = os.stat(labels_file)
+        meta = {'version': STORE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+        if not rebuild and os.path.exists(store_path) and os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                if json.load(f) == meta:
+                    return cls(np.load(store_path, mmap_mode='r'))
+
+        with open(labels_file, 'r') as f:
+            # 跳过第一行注释
+            next(f, None)
+            store = cls.from_uuids(line.strip() for line in f if line.strip())
+        # meta最后写入，并发加载时只会信任已经完整写好的数组
+        replace_file(store_path, lambda f: np.save(f, store.ids), mode='wb')
+        replace_file(meta_path, lambda f: json.dump(meta, f))
+        return cls(np.load(store_path, mmap_mode='r'))
+
+    def contains(self, uuids) -> np.ndarray:
+        """
+        批量成员判断，uuids为UUID字符串列表或uuid_array的结果，返回bool数组
+        先在高64位上二分查找，高位唯一时直接比较低位；随机UUID的高位几乎不重复，重复时才逐个处理
+        """
+        query = uuids if isinstance(uuids, np.ndarray) and uuids.dtype == np.uint64 else uuid_array(uuids)
+        query = query.reshape(-1, 2)
+        found = np.zeros(len(query), dtype=bool)
+        if not len(query) or not len(self.ids):
+            return found
+        left = np.searchsorted(self.high, query[:, 0], side='left')
+        right = np.searchsorted(self.high, query[:, 0], side='right')
+        single = right - left == 1
+        found[single] = self.low[left[single]] == query[single, 1]
+        for i in np.flatnonzero(right - left > 1):
+            low = self.low[left[i]:right[i]]
+            pos = np.searchsorted(low, query[i, 1])
+            found[i] = pos < len(low) and low[pos] == query[i, 1]
+        return found
+
+    def __contains__(self, uuid: str) -> bool:
+        try:
+            return bool(self.contains([uuid])[0])
+        except ValueError:
+            return False
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def to_list(self) -> List[str]:
+        return uuid_strings(self.ids)
@@ -0,0 +1,176 @@
+import json
+import mmap
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+# 实例UUID和请求ID (如 "req-cf23fdbf-983e-49c8-a0fe-4407c7832671")
+ID_PATTERN = re.compile(rb'(?:req-)?[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
+# 索引文件格式版本，格式变化时旧索引自动重建
+INDEX_VERSION = 1
+
+# 建索引时每次读取的块大小
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class LogIndex:
+    """
+    大日志文件的内存映射索引
+
+    在日志文件旁保存以下sidecar文件，重复运行时直接加载而无需重新扫描日志：
+    - <log>.idx.offsets.npy: uint64 行偏移数组，第i行为 [offsets[i], offsets[i+1])
+    - <log>.idx.keys.npy: 排序后的实例UUID和请求ID
+    - <log>.idx.postings.npy / <log>.idx.key_offsets.npy: 倒排表，键 -> 行号
+    - <log>.idx.meta.json: 日志文件大小和修改时间，日志变化后索引失效
+    日志本身通过mmap访问，按行偏移切片读取上下文，不再把整个文件读入内存
+    """
+
+    def __init__(self, log_file: str, index_prefix: Optional[str] = None, rebuild: bool = False):
+        self.log_file = log_file
+        self.index_prefix = index_prefix or log_file + '.idx'
+
+        if rebuild or not self._is_valid():
+            self.build()
+        self._load()
+
+    def _paths(self) -> Dict[str, str]:
+        return {name: f"{self.index_prefix}.{name}.npy" for name in ('offsets', 'keys', 'key_offsets', 'postings')}
+
+    def _source_meta(self) -> Dict[str, int]:
+        stat = os.stat(self.log_file)
+        return {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def _is_valid(self) -> bool:
+        """索引文件存在且与当前日志文件一致"""
+        meta_path = f"{self.index_prefix}.meta.json"
+        if not os.path.exists(meta_path) or not all(os.path.exists(p) for p in self._paths().values()):
+            return False
+        with open(meta_path, 'r') as f:
+            return json.load(f) == self._source_meta()
+
+    def build(self):
+        """顺序扫描一次日志，生成行偏移数组和倒排索引"""
+        print(f"为 {self.log_file} 建立索引...")
+        start_time = time.time()
+        file_size = os.path.getsize(self.log_file)
+
+        offset_chunks = [np.zeros(1, dtype=np.uint64)]
+        key_lines = {}  # 键 -> 行号列表
+        line_base = 0
+
+        with open(self.log_file, 'rb') as f, tqdm(total=file_size, unit='B', unit_scale=True, desc="建立索引") as pbar:
+            chunk_start = 0
+            remainder = b''
+            while True:
+                data = f.read(CHUNK_SIZE)
+                chunk = remainder + data
+                if not data:
+                    # 最后一行可能没有换行符
+                    if chunk:
+                        chunk += b'\n'
+                    else:
+                        break
+                # 只处理到最后一个换行符，剩余部分并入下一块
+                last_newline = chunk.rfind(b'\n')
+                if last_newline < 0:
+                    remainder = chunk
+                    continue
+                remainder = chunk[last_newline + 1:]
+                chunk = chunk[:last_newline + 1]
+
+                newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+                offset_chunks.append((newlines + 1 + chunk_start).astype(np.uint64))
+
+                # 每个ID出现位置所在的行号
+                for match in ID_PATTERN.finditer(chunk):
+                    line_no = line_base + int(np.searchsorted(newlines, match.start()))
+                    key = match.group().decode('ascii')
+                    key_lines.setdefault(key, []).append(line_no)
+                    # 请求ID中的UUID也能按UUID查到，与子串匹配的结果一致
+                    if key.startswith('req-'):
+                        key_lines.setdefault(key[4:], []).append(line_no)
+
+                line_base += len(newlines)
+                chunk_start += len(chunk)
+                pbar.update(len(chunk))
+                if not data:
+                    break
+
+        offsets = np.concatenate(offset_chunks)
+        # 没有换行符结尾时，最后一行的结束偏移是文件大小
+        offsets[-1] = min(int(offsets[-1]), file_size)
+
+        keys = sorted(key_lines)
+        postings = [np.unique(np.asarray(key_lines[key], dtype=np.uint64)) for key in keys]
+        key_offsets = np.zeros(len(keys) + 1, dtype=np.uint64)
+        if postings:
+            key_offsets[1:] = np.cumsum([len(p) for p in postings])
+
+        paths = self._paths()
+        np.save(paths['offsets'], offsets)
+        np.save(paths['keys'], np.array(keys, dtype='S40'))
+        np.save(paths['key_offsets'], key_offsets)
+        np.save(paths['postings'], np.concatenate(postings) if postings else np.zeros(0, dtype=np.uint64))
+        with open(f"{self.index_prefix}.meta.json", 'w') as f:
+            json.dump(self._source_meta(), f)
+
+        print(f"索引建立完成: {len(offsets) - 1} 行, {len(keys)} 个ID, 用时 {time.time() - start_time:.2f} 秒")
+
+    def _load(self):
+        paths = self._paths()
+        self.offsets = np.load(paths['offsets'], mmap_mode='r')
+        self.keys = np.load(paths['keys'], mmap_mode='r')
+        self.key_offsets = np.load(paths['key_offsets'], mmap_mode='r')
+        self.postings = np.load(paths['postings'], mmap_mode='r')
+
+        self._file = open(self.log_file, 'rb')
+        # 空文件无法映射
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.log_file) else b''
+        self._view = memoryview(self._mmap)
+
+    def close(self):
+        self._view.release()
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def raw_line(self, line_no: int) -> memoryview:
+        """第line_no行的原始字节（零拷贝，包含换行符）"""
+        return self._view[int(self.offsets[line_no]):int(self.offsets[line_no + 1])]
+
+    def line(self, line_no: int) -> str:
+        """第line_no行的文本，去掉首尾空白"""
+        return bytes(self.raw_line(line_no)).decode('utf-8', errors='replace').strip()
+
+    def lines(self, start: int, end: int) -> List[str]:
+        """[start, end) 行的文本，超出范围的部分被忽略"""
+        return [self.line(line_no) for line_no in range(max(0, start), min(len(self), end))]
+
+    def lookup(self, key: str) -> np.ndarray:
+        """包含实例UUID或请求ID（"req-..."）的所有行号，按行号升序"""
+        encoded = key.encode('ascii')
+        pos = int(np.searchsorted(self.keys, encoded))
+        if pos >= len(self.keys) or self.keys[pos] != encoded:
+            return np.zeros(0, dtype=np.uint64)
+        return self.postings[int(self.key_offsets[pos]):int(self.key_offsets[pos + 1])]
+
+    def context(self, line_no: int, context_size: int):
+        """返回 (上文, 当前行, 下文)"""
+        line_no = int(line_no)
+        return (self.lines(line_no - context_size, line_no),
+                self.line(line_no),
+                self.lines(line_no + 1, line_no + 1 + context_size))
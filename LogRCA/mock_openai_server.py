@@ -0,0 +1,104 @@
+"""
+本地模拟的OpenAI chat completions接口，用于不消耗API额度地测试report_generator的并发和限流处理
+每rate_limit_every个请求返回一次429，带Retry-After（或Retry-After-Ms）响应头；其余请求等待delay秒后返回固定格式的分析结果
+
+    python mock_openai_server.py --port 8765 --rate-limit-every 7
+    python analyze_logs.py --api-base http://127.0.0.1:8765/v1 --api-key test --no-cache --restart
+"""
+
+import json
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockState:
+    """请求计数和并发峰值，结束时打印"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.active = 0
+        self.peak = 0
+
+
+def make_handler(state, rate_limit_every, retry_after, retry_after_ms, delay):
+    class MockHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            with state.lock:
+                state.requests += 1
+                count = state.requests
+                state.active += 1
+                state.peak = max(state.peak, state.active)
+            try:
+                if rate_limit_every and count % rate_limit_every == 0:
+                    with state.lock:
+                        state.rate_limited += 1
+                    headers = {'Retry-After': retry_after}
+                    if retry_after_ms:
+                        headers['Retry-After-Ms'] = retry_after_ms
+                    self.send_json(429, {'error': {'message': 'rate limited', 'type': 'requests'}}, headers)
+                    return
+                time.sleep(delay)
+                prompt = body.get('messages', [{}])[-1].get('content', '')
+                self.send_json(200, {
+                    'id': f'chatcmpl-mock-{count}',
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': body.get('model', 'mock'),
+                    'choices': [{
+                        'index': 0,
+                        'finish_reason': 'stop',
+                        'message': {'role': 'assistant', 'content': f'模拟分析结果（提示长度 {len(prompt)} 字符）'},
+                    }],
+                    'usage': {'prompt_tokens': len(prompt), 'completion_tokens': 10, 'total_tokens': len(prompt) + 10},
+                }, {'x-ratelimit-remaining-requests': '100'})
+            finally:
+                with state.lock:
+                    state.active -= 1
+
+    return MockHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的OpenAI接口，定期返回429')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=8765, help='监听端口')
+    parser.add_argument('--rate-limit-every', type=int, default=7, help='每N个请求返回一次429，0为不限流')
+    parser.add_argument('--retry-after', default='1', help='429响应的Retry-After头（秒）')
+    parser.add_argument('--retry-after-ms', help='429响应的Retry-After-Ms头（毫秒），可以设为无法解析的值测试回退')
+    parser.add_argument('--delay', type=float, default=0.2, help='正常响应前等待的秒数')
+    args = parser.parse_args()
+
+    state = MockState()
+    handler = make_handler(state, args.rate_limit_every, args.retry_after, args.retry_after_ms, args.delay)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f"模拟OpenAI接口: http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"共 {state.requests} 个请求，{state.rate_limited} 个返回429，最大并发 {state.peak}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import json
+import re
+import sys
+import time
+from datetime import date
+from enum import IntEnum
+from functools import lru_cache
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+# 没有按快速路径拆开的日志行用该正则兜底，各部分之间没有可重叠的量词，不会回溯
+FALLBACK_PATTERN = re.compile(
+    r'^(?:(?P<file>\S+) )?(?P<date>\d{4}-\d{2}-\d{2}) (?P<time>\d{2}:\d{2}:\d{2}(?:\.\d+)?) +'
+    r'(?P<pid>\d+) +(?P<level>[A-Z]+) +(?P<module>[\w\.]+) ?(?P<rest>.*)$'
+)
+
+# 消息开头的实例标记 "[instance: <uuid>] "
+INSTANCE_PREFIX = '[instance: '
+UUID_LENGTH = 36
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class LogLevel(IntEnum):
+    """日志级别，数值与Python logging一致；oslo的AUDIT和TRACE也在其中"""
+    UNKNOWN = 0
+    TRACE = 5
+    DEBUG = 10
+    INFO = 20
+    AUDIT = 25
+    WARNING = 30
+    ERROR = 40
+    CRITICAL = 50
+
+
+LEVELS = {level.name: level for level in LogLevel}
+LEVELS['WARN'] = LogLevel.WARNING
+LEVELS['FATAL'] = LogLevel.CRITICAL
+
+
+class NovaLogRecord(NamedTuple):
+    """
+    一行nova日志解析后的记录
+    timestamp为纳秒级epoch时间（日志时间没有时区，按UTC处理）；
+    request_id为 "req-<uuid>"，instance_id为消息开头 [instance: ...] 中的UUID，没有时为None
+    """
+    file: Optional[str]
+    timestamp: int
+    pid: int
+    level: LogLevel
+    module: str
+    request_id: Optional[str]
+    instance_id: Optional[str]
+    message: str
+
+    def to_dict(self) -> dict:
+        record = self._asdict()
+        record['level'] = self.level.name
+        return record
+
+
+# 秒的小数部分按位数换算为纳秒的倍数
+FRACTION_SCALE = [10 ** (9 - digits) for digits in range(10)]
+
+
+@lru_cache(maxsize=4096)
+def day_epoch_ns(date_text: str) -> int:
+    """"YYYY-MM-DD" 当天0点的epoch纳秒，同一天的日志只计算一次"""
+    days = date(int(date_text[0:4]), int(date_text[5:7]), int(date_text[8:10])).toordinal() - EPOCH_ORDINAL
+    return days * 86400 * 1_000_000_000
+
+
+@lru_cache(maxsize=65536)
+def second_epoch_ns(date_text: str, seconds_text: str) -> int:
+    """"YYYY-MM-DD" 和 "HH:MM:SS" 对应的epoch纳秒，同一秒内的日志只计算一次"""
+    seconds = int(seconds_text[0:2]) * 3600 + int(seconds_text[3:5]) * 60 + int(seconds_text[6:8])
+    return day_epoch_ns(date_text) + seconds * 1_000_000_000
+
+
+def timestamp_ns(date_text: str, time_text: str) -> int:
+    """日期和 "HH:MM:SS[.ffffff]" 对应的epoch纳秒"""
+    fraction = time_text[9:18]
+    nanos = int(fraction) * FRACTION_SCALE[len(fraction)] if fraction else 0
+    return second_epoch_ns(date_text, time_text[:8]) + nanos
+
+
+def format_timestamp(timestamp: int) -> str:
+    """epoch纳秒 -> "YYYY-MM-DD HH:MM:SS.mmm"（nova日志的时间格式）"""
+    days, nanos = divmod(timestamp, 86400 * 1_000_000_000)
+    day = date.fromordinal(days + EPOCH_ORDINAL)
+    seconds, nanos = divmod(nanos, 1_000_000_000)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{day.isoformat()} {hours:02d}:{minutes:02d}:{seconds:02d}.{nanos // 1_000_000:03d}"
+
+
+def is_date(text: str) -> bool:
+    return len(text) == 10 and text[4] == '-' and text[7] == '-' and text[:4].isdigit()
+
+
+def is_time(text: str) -> bool:
+    return len(text) >= 8 and text[2] == ':' and text[5] == ':' and text[:2].isdigit()
+
+
+def split_context(rest: str):
+    """拆分 "[请求上下文] 消息"，返回 (请求ID, 消息)"""
+    if not rest.startswith('[') or rest.startswith(INSTANCE_PREFIX):
+        return None, rest
+    end = rest.find('] ')
+    if end < 0:
+        if not rest.endswith(']'):
+            return None, rest
+        context, message = rest[1:-1], ''
+    else:
+        context, message = rest[1:end], rest[end + 2:]
+    first = context.split(' ', 1)[0]
+    return (first if first.startswith('req-') else None), message
+
+
+def instance_of(message: str) -> Optional[str]:
+    if message.startswith(INSTANCE_PREFIX) and message[len(INSTANCE_PREFIX) + UUID_LENGTH:len(INSTANCE_PREFIX) + UUID_LENGTH + 1] == ']':
+        return message[len(INSTANCE_PREFIX):len(INSTANCE_PREFIX) + UUID_LENGTH]
+    return None
+
+
+def parse_line(line: str, file_name: Optional[str] = None) -> Optional[NovaLogRecord]:
+    """
+    解析一行nova日志: [文件名] 日期 时间 进程号 级别 模块 [请求上下文] 消息
+    快速路径只用str.split和定长切片；格式不规整（多个空格等）时用FALLBACK_PATTERN，
+    都不匹配（如多行消息的后续行）时返回None
+    """
+    line = line.rstrip('\r\n')
+    parts = line.split(' ', 6)
+    if parts and is_date(parts[0]):
+        parts = [file_name] + line.split(' ', 5)
+    if (len(parts) == 7 and is_date(parts[1]) and is_time(parts[2]) and parts[3].isdigit()
+            and parts[4] in LEVELS and parts[5]):
+        file, date_text, time_text, pid, level, module, rest = parts
+    else:
+        match = FALLBACK_PATTERN.match(line)
+        if not match:
+            return None
+        file, date_text, time_text, pid, level, module, rest = match.group(
+            'file', 'date', 'time', 'pid', 'level', 'module', 'rest')
+        file = file or file_name
+    request_id, message = split_context(rest)
+    return NovaLogRecord(file, timestamp_ns(date_text, time_text), int(pid), LEVELS.get(level, LogLevel.UNKNOWN),
+                         module, request_id, instance_of(message), message)
+
+
+def parse_lines(lines: Iterable[str], file_name: Optional[str] = None, stats: Optional[dict] = None) -> Iterator[NovaLogRecord]:
+    """逐行解析，跳过空行和无法解析的行；传入stats时记录解析和跳过的行数"""
+    parsed = skipped = 0
+    for line in lines:
+        record = parse_line(line, file_name)
+        if record is None:
+            if line.strip():
+                skipped += 1
+            continue
+        parsed += 1
+        yield record
+    if stats is not None:
+        stats['parsed'] = stats.get('parsed', 0) + parsed
+        stats['skipped'] = stats.get('skipped', 0) + skipped
+
+
+def parse_file(log_file: str, stats: Optional[dict] = None) -> Iterator[NovaLogRecord]:
+    """流式解析日志文件，内存占用与文件大小无关"""
+    with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
+        yield from parse_lines(f, stats=stats)
+
+
+def write_jsonl(records: Iterable[NovaLogRecord], output_file: str) -> int:
+    """每条记录写一行JSON，返回记录数"""
+    count = 0
+    with open(output_file, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record.to_dict(), ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def write_parquet(records: Iterable[NovaLogRecord], output_file: str, batch_size: int = 100000) -> int:
+    """按batch_size条一个row group写入Parquet，返回记录数；需要安装pyarrow"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("写入Parquet需要pyarrow，请先运行: pip install pyarrow")
+
+    schema = pa.schema([
+        ('file', pa.string()),
+        ('timestamp', pa.timestamp('ns')),
+        ('pid', pa.int32()),
+        ('level', pa.dictionary(pa.int8(), pa.string())),
+        ('module', pa.string()),
+        ('request_id', pa.string()),
+        ('instance_id', pa.string()),
+        ('message', pa.string()),
+    ])
+    count = 0
+    with pq.ParquetWriter(output_file, schema) as writer:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                writer.write_batch(records_to_arrow(batch, schema))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_batch(records_to_arrow(batch, schema))
+            count += len(batch)
+    return count
+
+
+def records_to_arrow(records, schema):
+    """一批记录转为按列存储的pyarrow RecordBatch"""
+    import pyarrow as pa
+    files, timestamps, pids, levels, modules, request_ids, instance_ids, messages = zip(*records)
+    arrays = [
+        pa.array(files, type=pa.string()),
+        pa.array(timestamps, type=pa.timestamp('ns')),
+        pa.array(pids, type=pa.int32()),
+        pa.array([level.name for level in levels], type=pa.string()).dictionary_encode().cast(schema.field('level').type),
+        pa.array(modules, type=pa.string()),
+        pa.array(request_ids, type=pa.string()),
+        pa.array(instance_ids, type=pa.string()),
+        pa.array(messages, type=pa.string()),
+    ]
+    return pa.record_batch(arrays, schema=schema)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='把原始nova日志解析为结构化记录')
+    parser.add_argument('log_files', nargs='+', help='nova日志文件')
+    parser.add_argument('--output', required=True, help='输出文件路径')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl',
+                        help='输出格式；导入MongoDB请使用 import_openstack_logs.py --raw')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    stats = {}
+    records = (record for log_file in args.log_files for record in parse_file(log_file, stats))
+    start_time = time.time()
+    if args.format == 'parquet':
+        count = write_parquet(records, args.output)
+    else:
+        count = write_jsonl(records, args.output)
+    elapsed = time.time() - start_time
+    print(f"已写入 {count} 条记录到 {args.output}，跳过 {stats.get('skipped', 0)} 行无法解析的行，"
+          f"用时 {elapsed:.2f} 秒，{count / max(elapsed, 1e-9):.0f} 行/秒")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from openai import AsyncOpenAI
+
+from analyze_logs import build_job, open_report_cache, print_token_summary, prompt_builder, write_report
+import find_code_context
+from extract_anomaly_context import (iter_log_context, iter_log_context_indexed, load_anomaly_labels, load_config,
+                                     read_anomaly_vms)
+from find_code_context import get_statement_index, iter_code_for_logs
+from log_index import LogIndex
+from prompt_builder import PromptBuilder
+from report_generator import ReportGenerator, ReportJournal
+
+
+def collect(records, sink):
+    """原样产出记录，同时保存到sink，用于可选的中间结果输出"""
+    for record in records:
+        sink.append(record)
+        yield record
+
+
+def shard_vm_ids(vm_ids, shard_size):
+    """把VM ID按原顺序切成每段shard_size个的连续分片，按分片顺序合并即保持单进程的记录顺序"""
+    return [vm_ids[i:i + shard_size] for i in range(0, len(vm_ids), shard_size)]
+
+
+def process_shard(vm_ids, log_file, source_dir, index_file, context_size, keep_records, prompt_budget=0, model=None):
+    """
+    在工作进程中处理一个分片: 提取上下文、查找代码并生成提示
+    日志索引和日志语句索引已由主进程建好，工作进程只读加载（日志索引通过mmap共享页缓存）。
+    代码缓存与处理过的日志有关，每个分片重新开始，
+    分片的结果只取决于分片本身，与分到哪个进程、进程数多少无关。
+    keep_records为False时只返回任务，减少进程间传输
+    """
+    find_code_context.CODE_CACHE.clear()
+    records = list(iter_log_context_indexed(log_file, vm_ids, context_size))
+    code_records = list(iter_code_for_logs(records, source_dir, index_file, batch_size=max(len(records), 1)))
+    builder = PromptBuilder(prompt_budget, model) if prompt_budget else None
+    jobs = [build_job(record, builder) for record in code_records]
+    if not keep_records:
+        return [], [], jobs
+    return records, code_records, jobs
+
+
+def iter_sharded_jobs(vm_ids, workers, shard_size, log_file, source_dir, index_file, context_size,
+                      anomaly_records=None, code_records=None, prompt_budget=0, model=None):
+    """
+    分片并行版本的前两步，按VM顺序产出任务
+    VM ID切成固定大小的分片，由workers个进程处理，结果按分片顺序合并，同一shard_size下输出与进程数无关；
+    同时最多提交workers * 2个分片，取出一个结果再提交下一个，下游取够max_logs条后不再处理之后的分片。
+    anomaly_records / code_records为列表时同时保存中间结果
+    """
+    shards = shard_vm_ids(vm_ids, shard_size)
+    keep_records = anomaly_records is not None
+    print(f"{len(vm_ids)} 个VM分为 {len(shards)} 个分片，使用 {workers} 个进程")
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=get_statement_index,
+                                   initargs=(source_dir, index_file))
+    remaining = iter(shards)
+    pending = deque()
+
+    def submit(shard_batch):
+        for shard in shard_batch:
+            pending.append(executor.submit(process_shard, shard, log_file, source_dir, index_file, context_size,
+                                           keep_records, prompt_budget, model))
+
+    try:
+        # 每个进程处理一个分片时另有一个排队，进程不会空等主进程取结果
+        submit(islice(remaining, workers * 2))
+        while pending:
+            shard_records, shard_code_records, jobs = pending.popleft().result()
+            submit(islice(remaining, 1))
+            if keep_records:
+                anomaly_records.extend(shard_records)
+                code_records.extend(shard_code_records)
+            yield from jobs
+    finally:
+        # 下游取够max_logs条后取消已提交但尚未开始的分片
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def dump_json(data, output_file):
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    print(f"中间结果已保存到 {output_file}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='依次完成异常上下文提取、代码查找和报告生成，各阶段之间不经过中间文件')
+    parser.add_argument('--config', type=str, default='config.yaml', help='配置文件路径')
+    parser.add_argument('--anomaly-file', type=str, help='异常VM ID文件路径')
+    parser.add_argument('--log-file', type=str, help='日志文件路径')
+    parser.add_argument('--source', type=str, help='源码目录路径')
+    parser.add_argument('--output', type=str, help='报告输出文件路径')
+    parser.add_argument('--context-size', type=int, help='上下文大小')
+    parser.add_argument('--mode', type=str, choices=['neighbor', 'correlated'],
+                        help='上下文模式: neighbor为相邻行, correlated为同一请求/实例的前后日志')
+    parser.add_argument('--no-index', action='store_true', help='不使用日志索引，单次扫描日志文件')
+    parser.add_argument('--max-logs', type=int, help='最多分析的异常记录数，默认为配置中的max_logs')
+    parser.add_argument('--batch-size', type=int, default=8, help='每批查找代码的异常记录数')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='分片并行提取上下文和查找代码的进程数，0为单进程流式处理；仅在使用日志索引的neighbor上下文模式下有效')
+    parser.add_argument('--shard-size', type=int, default=64, help='每个分片的VM数')
+    parser.add_argument('--api-key', type=str, help='OpenAI API密钥')
+    parser.add_argument('--api-base', type=str, help='OpenAI API基础URL')
+    parser.add_argument('--model', type=str, help='使用的模型名称')
+    parser.add_argument('--concurrency', type=int, help='最大并发请求数，收到429时自动降低')
+    parser.add_argument('--prompt-budget', type=int,
+                        help='每个提示的token上限，0为不压缩；默认为配置中的prompt_token_budget')
+    parser.add_argument('--restart', action='store_true', help='忽略已有的结果日志，重新分析所有记录')
+    parser.add_argument('--no-cache', action='store_true', help='不使用跨运行的报告缓存')
+    parser.add_argument('--dump-intermediate', action='store_true',
+                        help='同时写出流经流水线的异常上下文和代码上下文（anomaly_context.json、code_context.json）')
+    return parser.parse_args()
+
+
+def main():
+    start_time = time.time()
+    args = parse_args()
+
+    # 配置只加载一次，各阶段共用
+    config = load_config(args.config)
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    openai_config = config['api']['openai']
+    source_config = config['source_code']
+    output_config = config['output']
+    analysis_config = config['log_analysis']
+    output_dir = os.path.join(script_dir, output_config['output_dir'])
+
+    anomaly_vms_file = args.anomaly_file or os.path.join(script_dir, source_config['openstack_dir'], 'anomaly_labels.txt')
+    log_file = args.log_file or os.path.join(script_dir, source_config['openstack_dir'], 'openstack_abnormal.log')
+    source_dir = args.source or os.path.join(script_dir, source_config['nova_dir'])
+    index_file = os.path.join(script_dir, source_config.get('log_index_file', os.path.join(output_config['output_dir'], 'log_statement_index.json')))
+    output_file = args.output or os.path.join(output_dir, output_config['analysis_report_file'])
+    context_size = args.context_size or analysis_config['context_size']
+    context_mode = args.mode or analysis_config.get('context_mode', 'neighbor')
+    use_index = not args.no_index and analysis_config.get('use_log_index', True)
+    max_logs = args.max_logs or analysis_config['max_logs']
+    model = args.model or openai_config['default_model']
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    print(f"日志文件: {log_file}")
+    print(f"源码目录: {source_dir}")
+    print(f"输出文件: {output_file}")
+    print(f"上下文模式: {context_mode}，上下文大小: {context_size}，最多分析 {max_logs} 条记录")
+
+    vm_ids = read_anomaly_vms(anomaly_vms_file)
+    print(f"读取到 {len(vm_ids)} 个异常VM ID")
+    labels = load_anomaly_labels(anomaly_vms_file) if use_index and context_mode != 'correlated' else None
+    get_statement_index(source_dir, index_file)
+
+    builder = prompt_builder(config, model, args.prompt_budget)
+    anomaly_records = []
+    code_records = []
+    sharded_jobs = None
+    if args.shards > 1 and labels is None:
+        if context_mode == 'correlated':
+            reason = "correlated上下文模式需要扫描整个日志文件，不支持分片执行"
+        elif not use_index:
+            reason = "分片执行需要日志索引，当前未使用日志索引"
+        else:
+            reason = "分片执行需要VM ID都是UUID格式"
+        print(f"{reason}，改用单进程流式处理")
+    if args.shards > 1 and labels is not None:
+        # 先在主进程建好日志索引，工作进程只加载
+        LogIndex(log_file).close()
+        sharded_jobs = iter_sharded_jobs(vm_ids, args.shards, args.shard_size, log_file, source_dir, index_file, context_size,
+                                         anomaly_records if args.dump_intermediate else None,
+                                         code_records if args.dump_intermediate else None,
+                                         builder.max_tokens if builder else 0, model)
+        jobs = islice(sharded_jobs, max_logs)
+    else:
+        # 各阶段是串联的生成器，记录逐条流过；只取前max_logs条，之后的VM不再提取
+        records = islice(iter_log_context(log_file, vm_ids, context_size, context_mode, use_index, labels), max_logs)
+        if args.dump_intermediate:
+            records = collect(records, anomaly_records)
+        records = iter_code_for_logs(records, source_dir, index_file, batch_size=args.batch_size)
+        if args.dump_intermediate:
+            records = collect(records, code_records)
+        jobs = (build_job(record, builder) for record in records)
+
+    journal_file = os.path.splitext(output_file)[0] + '.journal.jsonl'
+    if args.restart and os.path.exists(journal_file):
+        os.remove(journal_file)
+    print(f"结果日志: {journal_file}")
+
+    cache = None if args.no_cache else open_report_cache(config, script_dir)
+    client = AsyncOpenAI(base_url=args.api_base or openai_config['api_base'],
+                         api_key=args.api_key or openai_config['api_key'], max_retries=0)
+    journal = ReportJournal(journal_file)
+    generator = ReportGenerator(client, model, journal, cache=cache,
+                                concurrency=args.concurrency or analysis_config.get('concurrency', 8))
+    try:
+        jobs = asyncio.run(generator.run_stream(jobs))
+    finally:
+        journal.close()
+        if sharded_jobs is not None:
+            sharded_jobs.close()
+
+    print_token_summary(jobs)
+    write_report(jobs, journal, output_file)
+    if args.dump_intermediate:
+        dump_json(anomaly_records, os.path.join(output_dir, output_config['anomaly_context_file']))
+        dump_json(code_records, os.path.join(output_dir, output_config['code_context_file']))
+
+    print(f"分析完成！结果已保存到 {output_file}，总用时 {time.time() - start_time:.2f} 秒")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from nova_log_parser import INSTANCE_PREFIX, UUID_LENGTH, parse_line
+from report_generator import log_template
+
+PROMPT_TEMPLATE = """指令：你是一名经验丰富的软件工程师。你的任务是分析异常日志、上下文
+信息及源码，找出异常发生的原因，并生成格式化分析报告。输入：
+•异常日志:
+{log_text}
+
+• 上下文信息:
+--- 之前的日志 ---
+{context_before}
+
+--- 之后的日志 ---
+{context_after}
+
+•源码片段:
+{source_code}
+
+异常分析报告输出格式：
+1.异常概述
+- 异常类型：｛异常类型｝
+- 异常信息：｛错误消息｝
+2.详细分析
+- 可能的异常原因：
+-｛基于日志、上下文和源码的推断｝
+- 影响范围：
+-｛异常可能影响的系统组件｝
+3. 解决方案建议
+- 短期修复：｛快速缓解措施｝
+- 长期优化：｛提升代码健壮性的方案｝
+"""
+
+# traceback中的调用帧: File "<路径>", line <行号>, in <函数>
+FRAME_PATTERN = re.compile(r'File "(?P<path>[^"]+)", line (?P<line>\d+), in (?P<function>\S+)')
+
+# 路径中包含该目录的调用帧属于nova源码树
+NOVA_PATH = '/nova/'
+
+# 超出预算时源码先缩小到日志调用附近的行数，仍超出时才继续缩小
+MIN_CODE_LINES = 10
+
+
+def render_prompt(log_text: str, context_before: List[str], context_after: List[str], source_code: str) -> str:
+    return PROMPT_TEMPLATE.format(log_text=log_text, context_before="\n".join(context_before),
+                                  context_after="\n".join(context_after), source_code=source_code)
+
+
+def code_lines(code_context: Optional[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+    """源码片段的标题和代码行，优先使用日志调用所在函数的完整源码"""
+    if not code_context or not (code_context.get("function_context") or "context" in code_context):
+        return "", []
+    header = f"文件路径: {code_context.get('file', '未知文件')}\n"
+    if code_context.get("function_context"):
+        return header + f"函数: {code_context.get('function')}\n", code_context["function_context"]
+    return header, code_context["context"]
+
+
+def format_code(header: str, lines: List[Dict[str, Any]]) -> str:
+    if not header:
+        return ""
+    return header + "\n".join(f"{line['line_number']}: {line['content']}" for line in lines)
+
+
+def full_prompt(anomaly_data: Dict[str, Any]) -> str:
+    """不压缩、不限长度的提示: 完整的上下文和源码片段"""
+    header, lines = code_lines(anomaly_data["anomaly_log"].get("code_context"))
+    return render_prompt(anomaly_data["anomaly_log"]["text"],
+                         [log["text"] for log in anomaly_data.get("context_before", [])],
+                         [log["text"] for log in anomaly_data.get("context_after", [])],
+                         format_code(header, lines))
+
+
+def approximate_tokens(text: str) -> int:
+    """没有tiktoken时的估算: 英文约4个字符一个token，中文等非ASCII字符按一个字符一个token"""
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+def token_counter(model: Optional[str] = None) -> Callable[[str], int]:
+    """按模型的分词器计数，需要安装tiktoken；未安装或取不到编码时使用approximate_tokens"""
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model or '')
+        except KeyError:
+            encoding = tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        return approximate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def log_message(line: str) -> str:
+    """日志行去掉日志头、请求上下文和实例标记后的消息"""
+    record = parse_line(line)
+    if record is None:
+        return line
+    message = record.message
+    if record.instance_id:
+        message = message[len(INSTANCE_PREFIX) + UUID_LENGTH + 2:]
+    return message
+
+
+def compress_traceback(lines: List[str]) -> List[str]:
+    """
+    只保留traceback中nova源码树内的调用帧及其代码行
+    连续的非nova调用帧（eventlet、oslo、标准库等）合并为一行省略说明
+    """
+    result = []
+    omitted = 0
+    in_frame = False  # 上一行是调用帧，本行可能是该帧的代码行
+    keep_frame = False
+
+    def flush():
+        nonlocal omitted
+        if omitted:
+            result.append(f"  ... 省略 {omitted} 个nova以外的调用帧")
+            omitted = 0
+
+    for line in lines:
+        match = FRAME_PATTERN.search(line)
+        if match:
+            keep_frame = NOVA_PATH in match.group('path')
+            in_frame = True
+            if keep_frame:
+                flush()
+                result.append(line)
+            else:
+                omitted += 1
+            continue
+        if in_frame and log_message(line).startswith('    '):
+            in_frame = False
+            if keep_frame:
+                result.append(line)
+            continue
+        in_frame = False
+        flush()
+        result.append(line)
+    flush()
+    return result
+
+
+def collapse_templates(lines: List[str]) -> List[str]:
+    """模板相同的日志只保留第一条，并注明重复次数"""
+    counts = {}
+    first_lines = {}
+    for line in lines:
+        template = log_template(line)
+        counts[template] = counts.get(template, 0) + 1
+        first_lines.setdefault(template, line)
+    return [line if counts[template] == 1 else f"{line} （同模板共 {counts[template]} 条）"
+            for template, line in first_lines.items()]
+
+
+class PromptBuilder:
+    """
+    按token预算生成分析提示
+    上下文先压缩traceback、合并同模板日志；仍超出预算时依次: 上下文减到每边一行，
+    函数源码缩小到日志调用附近的MIN_CODE_LINES行，去掉其余上下文，源码最少保留日志调用一行。
+    异常日志和提示说明总是完整保留。
+    build同时返回压缩前后的token数
+    """
+
+    def __init__(self, max_tokens: int = 3000, model: Optional[str] = None):
+        self.max_tokens = max_tokens
+        self.count_tokens = token_counter(model)
+        # 空白提示的token数，各部分按行累加，不必每次重新计算整个提示
+        self.base_tokens = self.count_tokens(render_prompt('', [], [], ''))
+
+    def build(self, anomaly_data: Dict[str, Any]) -> Tuple[str, Dict[str, int]]:
+        """返回 (提示, {prompt_tokens, original_tokens, tokens_saved})"""
+        anomaly_log = anomaly_data["anomaly_log"]
+        before = collapse_templates(compress_traceback([log["text"] for log in anomaly_data.get("context_before", [])]))
+        after = collapse_templates(compress_traceback([log["text"] for log in anomaly_data.get("context_after", [])]))
+        code_context = anomaly_log.get("code_context") or {}
+        header, lines = code_lines(code_context)
+
+        def line_tokens(text):
+            return self.count_tokens(text) + 1
+
+        before_tokens = [line_tokens(line) for line in before]
+        after_tokens = [line_tokens(line) for line in after]
+        code_tokens = [line_tokens(f"{line['line_number']}: {line['content']}") for line in lines]
+        fixed = self.base_tokens + self.count_tokens(anomaly_log["text"]) + (self.count_tokens(header) if header else 0)
+        total = fixed + sum(before_tokens) + sum(after_tokens) + sum(code_tokens)
+
+        def drop_context(min_lines):
+            """丢弃离异常日志最远的上下文（上文的开头、下文的结尾），两边交替，每边至少保留min_lines行"""
+            nonlocal total
+            while total > self.max_tokens and (len(before) > min_lines or len(after) > min_lines):
+                if len(before) > min_lines and len(before) >= len(after):
+                    before.pop(0)
+                    total -= before_tokens.pop(0)
+                else:
+                    after.pop()
+                    total -= after_tokens.pop()
+
+        def trim_code(min_lines):
+            """按与日志调用的距离从远到近丢弃源码行，至少保留min_lines行"""
+            nonlocal total
+            target = code_context.get('line_number')
+            order = sorted(range(len(lines)), key=lambda i: abs(lines[i]['line_number'] - target) if target else i)
+            for i in reversed(order[min_lines:]):
+                if total <= self.max_tokens:
+                    break
+                total -= code_tokens[i]
+                code_tokens[i] = 0
+                dropped.add(i)
+
+        dropped = set()
+        drop_context(1)
+        trim_code(MIN_CODE_LINES)
+        drop_context(0)
+        trim_code(1)
+        lines = [line for i, line in enumerate(lines) if i not in dropped]
+
+        prompt = render_prompt(anomaly_log["text"], before, after, format_code(header, lines))
+        prompt_tokens = self.count_tokens(prompt)
+        original_tokens = self.count_tokens(full_prompt(anomaly_data))
+        return prompt, {'prompt_tokens': prompt_tokens, 'original_tokens': original_tokens,
+                        'tokens_saved': max(original_tokens - prompt_tokens, 0)}
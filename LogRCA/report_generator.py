@@ -0,0 +1,366 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError, AsyncOpenAI, RateLimitError
+
+from template_miner import MASK_PATTERN, mask_log, split_header
+
+# x-ratelimit-reset-requests 等响应头的时间格式，如 "1s"、"6m0s"、"20ms"
+RESET_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+RESET_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+# 报告缓存文件格式版本
+CACHE_VERSION = 1
+
+
+def record_key(anomaly_data: Dict[str, Any]) -> str:
+    """一条异常记录的键，用于断点续跑时跳过已完成的记录"""
+    text = f"{anomaly_data.get('vm_id', 'unknown')}\n{anomaly_data['anomaly_log']['text']}"
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def log_template(log_line: str) -> str:
+    """日志行的模板: 级别、模块和掩码后的内容，不含时间戳、进程号和请求上下文"""
+    level, module, content = split_header(log_line.strip())
+    return ' '.join(part for part in (level, module, mask_log(content)) if part)
+
+
+def report_key(anomaly_data: Dict[str, Any]) -> str:
+    """
+    报告缓存键: (异常日志模板, 代码调用位置, 上下文日志模板)
+    上下文模板去重排序，同一请求在不同虚拟机上的日志交错顺序不同也得到相同的键
+    """
+    anomaly_log = anomaly_data['anomaly_log']
+    code_context = anomaly_log.get('code_context') or {}
+    key = [
+        log_template(anomaly_log['text']),
+        code_context.get('file'),
+        code_context.get('line_number'),
+        sorted({log_template(log['text']) for log in anomaly_data.get('context_before', [])}),
+        sorted({log_template(log['text']) for log in anomaly_data.get('context_after', [])}),
+    ]
+    return hashlib.sha1(json.dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def record_specifics(anomaly_data: Dict[str, Any]) -> Dict[str, Any]:
+    """共享分析结果时附在每条记录上的虚拟机相关信息: 时间、请求ID和日志中被掩码的参数值"""
+    anomaly_log = anomaly_data['anomaly_log']
+    parsed_info = anomaly_log.get('parsed_info') or {}
+    _, _, content = split_header(anomaly_log['text'].strip())
+    return {
+        'timestamp': parsed_info.get('timestamp'),
+        'request_id': parsed_info.get('request_id'),
+        'parameters': [match.group() for match in MASK_PATTERN.finditer(content)],
+    }
+
+
+def parse_reset_seconds(value: Optional[str]) -> Optional[float]:
+    """解析Retry-After或x-ratelimit-reset-*响应头，返回秒数"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = RESET_PATTERN.findall(value)
+    if not matches:
+        return None
+    return sum(float(number) * RESET_UNITS[unit] for number, unit in matches)
+
+
+def rate_limit_wait(headers) -> Optional[float]:
+    """从响应头中取出需要等待的秒数"""
+    if headers is None:
+        return None
+    # 无法解析的retry-after-ms按没有处理，继续看retry-after
+    wait = parse_reset_seconds(headers.get('retry-after-ms'))
+    if wait is not None:
+        return wait / 1000
+    return parse_reset_seconds(headers.get('retry-after')) or parse_reset_seconds(headers.get('x-ratelimit-reset-requests'))
+
+
+class AdaptiveRateLimiter:
+    """
+    自适应限流
+    同时最多limit个请求，收到429时limit减半并按响应头暂停所有请求；
+    连续limit次成功后limit加一，直到max_concurrency。剩余请求数为0时也提前暂停。
+    """
+
+    def __init__(self, max_concurrency: int = 8, min_concurrency: int = 1, default_wait: float = 1.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.default_wait = default_wait
+        self.limit = max_concurrency
+        self.active = 0
+        self.resume_at = 0.0
+        self.successes = 0
+        self.rate_limited = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        while True:
+            wait = self.resume_at - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            async with self._condition:
+                if self.active < self.limit and self.resume_at <= time.monotonic():
+                    self.active += 1
+                    return
+                await self._condition.wait()
+
+    async def release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def pause(self, seconds: float):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    def on_success(self, headers=None):
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.max_concurrency:
+            self.limit += 1
+            self.successes = 0
+        if headers is not None and headers.get('x-ratelimit-remaining-requests') == '0':
+            self.pause(parse_reset_seconds(headers.get('x-ratelimit-reset-requests')) or self.default_wait)
+
+    def on_rate_limited(self, headers=None):
+        self.rate_limited += 1
+        self.successes = 0
+        self.limit = max(self.min_concurrency, self.limit // 2)
+        self.pause(rate_limit_wait(headers) or self.default_wait)
+
+
+class ReportJournal:
+    """
+    只追加的JSONL结果日志，每完成一条记录写入一行
+    程序中断后重新运行时读取已完成的记录和分析结果，只处理剩余部分
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}  # 记录键 -> 结果
+        self.analyses = {}  # 报告键 -> 分析结果
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 中断时最后一行可能不完整
+                        continue
+                    self.entries[entry['record_key']] = entry
+                    self.analyses[entry['report_key']] = entry['analysis']
+        self._file = open(path, 'a', encoding='utf-8')
+        if self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # 不完整的最后一行单独成行，避免与新写入的记录连在一起
+                    self._file.write('\n')
+
+    def append(self, entry: Dict[str, Any]):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self.entries[entry['record_key']] = entry
+        self.analyses[entry['report_key']] = entry['analysis']
+
+    def close(self):
+        self._file.close()
+
+
+class ReportCache:
+    """
+    跨运行持久化的分析报告缓存，报告键 -> 分析结果
+    超过max_age_days未使用的条目在加载时丢弃，条目数超过max_entries时保存前淘汰最久未使用的条目
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, max_age_days: float = 30):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.entries = {}
+        self.hits = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == CACHE_VERSION:
+                now = time.time()
+                self.entries = {key: entry for key, entry in data['entries'].items()
+                                if now - entry['last_used'] <= self.max_age}
+
+    def get(self, key: str, model: str) -> Optional[str]:
+        """同一模型生成的缓存分析结果，没有时返回None"""
+        entry = self.entries.get(key)
+        if entry is None or entry['model'] != model:
+            return None
+        entry['last_used'] = time.time()
+        entry['hits'] += 1
+        self.hits += 1
+        return entry['analysis']
+
+    def put(self, key: str, model: str, analysis: str):
+        now = time.time()
+        self.entries[key] = {'model': model, 'analysis': analysis, 'created': now, 'last_used': now, 'hits': 0}
+
+    def save(self):
+        if len(self.entries) > self.max_entries:
+            keep = sorted(self.entries, key=lambda key: self.entries[key]['last_used'], reverse=True)[:self.max_entries]
+            self.entries = {key: self.entries[key] for key in keep}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'version': CACHE_VERSION, 'entries': self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_file, self.path)
+
+
+class ReportGenerator:
+    """
+    并发生成分析报告
+    相同报告键的记录只请求一次，结果写入ReportJournal；传入ReportCache时先查缓存，
+    之前运行中分析过的相同异常不再请求。并发数由AdaptiveRateLimiter控制。
+    """
+
+    def __init__(self, client: AsyncOpenAI, model: str, journal: ReportJournal, cache: Optional[ReportCache] = None,
+                 concurrency: int = 8, max_retries: int = 5):
+        self.client = client
+        self.model = model
+        self.journal = journal
+        self.cache = cache
+        self.limiter = AdaptiveRateLimiter(concurrency)
+        self.max_retries = max_retries
+        self.requests = 0
+        self.analyzed = 0
+        self.failed = 0
+        self.first_report_at = None
+
+    async def ask(self, prompt: str) -> Optional[str]:
+        """发送一个提示，429时等待后重试，其他错误指数退避重试"""
+        for attempt in range(self.max_retries + 1):
+            backoff = 0
+            await self.limiter.acquire()
+            try:
+                self.requests += 1
+                response = await self.client.chat.completions.with_raw_response.create(
+                    messages=[{"role": "user", "content": prompt}],
+                    model=self.model,
+                    temperature=0,
+                )
+                self.limiter.on_success(response.headers)
+                return response.parse().choices[0].message.content
+            except RateLimitError as e:
+                self.limiter.on_rate_limited(e.response.headers)
+                print(f"请求被限流(429)，并发数降为 {self.limiter.limit}")
+            except (APIStatusError, APIConnectionError, APITimeoutError) as e:
+                print(f"请求ChatGPT API时出错: {e}")
+                backoff = min(2 ** attempt, 30)
+            finally:
+                await self.limiter.release()
+            if backoff:
+                await asyncio.sleep(backoff)
+        return None
+
+    async def _analyze(self, key: str, prompt: str) -> Optional[str]:
+        """报告键对应的分析结果，依次查journal、报告缓存，都没有时请求模型"""
+        analysis = self.journal.analyses.get(key)
+        if analysis is None and self.cache is not None:
+            analysis = self.cache.get(key, self.model)
+        if analysis is None:
+            self.analyzed += 1
+            analysis = await self.ask(prompt)
+            if analysis is not None and self.cache is not None:
+                self.cache.put(key, self.model, analysis)
+        return analysis
+
+    def _append(self, key: str, job: Dict[str, Any], analysis: str):
+        if self.first_report_at is None:
+            self.first_report_at = time.monotonic()
+        self.journal.append({
+            'record_key': job['record_key'],
+            'report_key': key,
+            'vm_id': job['vm_id'],
+            'anomaly_log': job['anomaly_log'],
+            'specifics': job['specifics'],
+            'analysis': analysis,
+        })
+
+    async def _process_group(self, key: str, group: List[Dict[str, Any]]):
+        analysis = await self._analyze(key, group[0]['prompt'])
+        if analysis is None:
+            self.failed += len(group)
+            print(f"无法获取 {len(group)} 条异常日志的分析结果")
+            return
+        for job in group:
+            self._append(key, job, analysis)
+
+    async def _process_streamed(self, key: str, job: Dict[str, Any], analysis_task: asyncio.Task):
+        analysis = await analysis_task
+        if analysis is None:
+            self.failed += 1
+            print(f"无法获取 {job['vm_id']} 的异常日志的分析结果")
+            return
+        self._append(key, job, analysis)
+
+    def _print_summary(self, pending: int):
+        cache_hits = self.cache.hits if self.cache is not None else 0
+        print(f"共分析 {self.analyzed} 个报告，复用缓存 {cache_hits} 个，"
+              f"节省 {pending - self.analyzed} 次调用")
+        print(f"共发送 {self.requests} 个请求，限流 {self.limiter.rate_limited} 次，失败 {self.failed} 条")
+
+    async def run(self, jobs: List[Dict[str, Any]]):
+        """
+        jobs: [{record_key, report_key, prompt, vm_id, anomaly_log, specifics}]
+        已在journal中完成的记录被跳过
+        """
+        groups = {}
+        for job in jobs:
+            if job['record_key'] not in self.journal.entries:
+                groups.setdefault(job['report_key'], []).append(job)
+        pending = sum(len(group) for group in groups.values())
+        print(f"待处理 {pending} 条记录（已完成 {len(jobs) - pending} 条），去重后 {len(groups)} 个报告")
+        try:
+            await asyncio.gather(*(self._process_group(key, group) for key, group in groups.items()))
+        finally:
+            if self.cache is not None:
+                self.cache.save()
+        self._print_summary(pending)
+
+    async def run_stream(self, jobs: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        run的流式版本，jobs为同步迭代器（如上游的生成器流水线），返回取到的所有任务
+        任务在线程中逐个取出，取到即开始请求，上游仍在提取和查找代码时已有报告生成；
+        相同报告键的记录共享同一个请求，已在journal中完成的记录被跳过
+        """
+        iterator = iter(jobs)
+        start_time = time.monotonic()
+        received = []
+        analysis_tasks = {}  # 报告键 -> 请求分析结果的任务
+        record_tasks = []
+        try:
+            while True:
+                job = await asyncio.to_thread(next, iterator, None)
+                if job is None:
+                    break
+                received.append(job)
+                if job['record_key'] in self.journal.entries:
+                    continue
+                key = job['report_key']
+                if key not in analysis_tasks:
+                    analysis_tasks[key] = asyncio.create_task(self._analyze(key, job['prompt']))
+                record_tasks.append(asyncio.create_task(self._process_streamed(key, job, analysis_tasks[key])))
+            await asyncio.gather(*record_tasks)
+        finally:
+            if self.cache is not None:
+                self.cache.save()
+        pending = len(record_tasks)
+        print(f"处理 {pending} 条记录（已完成 {len(received) - pending} 条），去重后 {len(analysis_tasks)} 个报告")
+        if self.first_report_at is not None:
+            print(f"首个报告用时 {self.first_report_at - start_time:.2f} 秒")
+        self._print_summary(pending)
+        return received
@@ -0,0 +1,159 @@
+import re
+from typing import Dict, List, Optional
+
+# 变量部分的掩码，合并为一个正则，每行只扫描一次（原normalize_log需要六次替换）
+MASK_PATTERN = re.compile(
+    r'(?P<QUOTED_STRING>"[^"]*"|\'[^\']*\')'
+    r'|(?P<TIMESTAMP>\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:\.\d+)?)'
+    r'|(?P<HEX_ID>0x[0-9a-fA-F]+)'
+    r'|(?P<UUID>[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})'
+    r'|(?P<IP_ADDR>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+    r'|(?P<NUMBER>\b\d+\b)'
+)
+
+# OpenStack日志头: [文件名] 时间戳 进程号 级别 模块 [请求上下文] 内容
+HEADER_PATTERN = re.compile(
+    r'^(?:\S+ )?\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d+)? \d+ (?P<level>[A-Z]+) (?P<module>[\w\.]+) '
+    r'(?:\[[^\]]*\] )?(?P<content>.*)$'
+)
+
+# 日志内容开头的实例标记，所有实例日志都相同，不参与解析树的分组
+INSTANCE_PATTERN = re.compile(r'^\[instance: [0-9a-fA-F-]+\] ')
+
+# mask_log产生的占位词，计算相似度时视为参数
+MASK_NAMES = frozenset(MASK_PATTERN.groupindex)
+
+# 模板中的参数占位符
+PARAM = '<*>'
+
+
+def mask_log(log_line: str) -> str:
+    """把日志行中的时间戳、ID、IP、数字和引号内容替换为TIMESTAMP、UUID等占位词"""
+    return MASK_PATTERN.sub(lambda match: match.lastgroup, log_line)
+
+
+def split_header(log_line: str):
+    """拆分日志头，返回 (级别, 模块, 内容)；没有日志头时整行作为内容"""
+    match = HEADER_PATTERN.match(log_line)
+    if not match:
+        return '', '', log_line
+    return match.group('level'), match.group('module'), match.group('content')
+
+
+def strip_prefix(content: str) -> str:
+    """去掉日志内容开头的 [instance: <UUID>] 标记"""
+    return INSTANCE_PATTERN.sub('', content, count=1)
+
+
+def has_digit(token: str) -> bool:
+    return any(char.isdigit() for char in token)
+
+
+class LogCluster:
+    """一个日志模板及其匹配的日志数"""
+    def __init__(self, cluster_id: int, header: str, template_tokens: List[str]):
+        self.cluster_id = cluster_id
+        self.header = header
+        self.template_tokens = template_tokens
+        self.size = 1
+
+    @property
+    def template(self) -> str:
+        return ' '.join(([self.header] if self.header else []) + self.template_tokens)
+
+
+class TemplateMiner:
+    """
+    Drain风格的在线日志模板挖掘
+    固定深度的解析树: 第一层按日志级别、模块和内容的token数分组，之后depth-2层按内容的前几个token分组，
+    叶子节点保存候选模板。每行日志只需比较同一叶子下的少量模板，返回整数模板ID，同一行的结果被缓存。
+    时间戳、进程号、请求上下文和 [instance: <UUID>] 标记不参与模板，解析树按真正的消息开头分组。
+    模板ID与加入日志的顺序有关，只用于分组统计；需要确定结果的去重按mask_log的结果比较。
+
+    参数:
+        depth: 解析树深度（含根节点和叶子层）
+        similarity_threshold: 日志中的常量token与模板相同的比例达到该阈值时归入该模板，
+            mask_log的占位词不计入比例
+        max_children: 每个内部节点最多的子节点数，超出的token归入<*>子节点
+        cache_size: 日志行 -> 模板ID 缓存的最大条目数
+    """
+    def __init__(self, depth: int = 4, similarity_threshold: float = 0.7, max_children: int = 100,
+                 cache_size: int = 100000):
+        assert depth >= 3, "depth至少为3"
+        self.depth = depth
+        self.similarity_threshold = similarity_threshold
+        self.max_children = max_children
+        self.cache_size = cache_size
+        self.root = {}  # (级别, 模块, token数) -> 前缀树节点
+        self.clusters: List[LogCluster] = []
+        self._cache: Dict[str, int] = {}
+
+    def add_log(self, log_line: str) -> int:
+        """把一行日志加入模板树，返回其模板ID"""
+        cluster_id = self._cache.get(log_line)
+        if cluster_id is not None:
+            self.clusters[cluster_id].size += 1
+            return cluster_id
+
+        level, module, content = split_header(log_line.strip())
+        header = f"{level} {module}" if level else ''
+        tokens = mask_log(strip_prefix(content)).split()
+        leaf = self._leaf(header, tokens)
+        cluster = self._best_match(leaf, tokens)
+        if cluster is None:
+            cluster = LogCluster(len(self.clusters), header, tokens)
+            self.clusters.append(cluster)
+            leaf.append(cluster.cluster_id)
+        else:
+            cluster.size += 1
+            cluster.template_tokens = [t if t == token else PARAM for t, token in zip(cluster.template_tokens, tokens)]
+
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[log_line] = cluster.cluster_id
+        return cluster.cluster_id
+
+    def _leaf(self, header: str, tokens: List[str]) -> List[int]:
+        """沿解析树找到（或创建）tokens所属的叶子节点"""
+        node = self.root.setdefault((header, len(tokens)), {})
+        prefix_depth = min(self.depth - 2, len(tokens))
+        for i in range(prefix_depth):
+            token = PARAM if has_digit(tokens[i]) else tokens[i]
+            if token not in node and len(node) >= self.max_children:
+                token = PARAM
+            node = node.setdefault(token, {} if i < prefix_depth - 1 else [])
+        if prefix_depth == 0:
+            node = node.setdefault(PARAM, [])
+        return node
+
+    def _best_match(self, leaf: List[int], tokens: List[str]) -> Optional[LogCluster]:
+        """
+        叶子中与tokens最相似的模板，相似度相同时取参数更多的模板
+        相似度只在日志的常量token上计算: 占位词（UUID、NUMBER等）不算相同也不算不同，
+        模板中已经是<*>的位置算作不同，变量多的短日志不会仅因变量相同而合并
+        """
+        best, best_key = None, None
+        for cluster_id in leaf:
+            cluster = self.clusters[cluster_id]
+            same, params, counted = 0, 0, 0
+            for t, token in zip(cluster.template_tokens, tokens):
+                if token in MASK_NAMES:
+                    continue
+                counted += 1
+                if t == PARAM:
+                    params += 1
+                elif t == token:
+                    same += 1
+            similarity = same / counted if counted else 1.0
+            if best_key is None or (similarity, params) > best_key:
+                best, best_key = cluster, (similarity, params)
+        if best is not None and best_key[0] >= self.similarity_threshold:
+            return best
+        return None
+
+    def template(self, cluster_id: int) -> str:
+        return self.clusters[cluster_id].template
+
+    def counts(self) -> Dict[int, int]:
+        """模板ID -> 匹配的日志数"""
+        return {cluster.cluster_id: cluster.size for cluster in self.clusters}
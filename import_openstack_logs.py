@@ -1,16 +1,50 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
 import csv
-import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import pandas as pd
 import pymongo
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from pymongo.operations import UpdateMany, UpdateOne
 from datetime import datetime, timedelta
+from itertools import islice
 import sys
+import time
+from collections import Counter
 
-def connect_mongodb(uri="mongodb://localhost:27017/", db_name="log-analysis"):
-    """连接到MongoDB数据库"""
+from LogRCA.nova_log_parser import format_timestamp, parse_file
+from LogRCA.template_miner import TemplateMiner, mask_log, strip_prefix
+
+# 每批写入的文档数
+DEFAULT_BATCH_SIZE = 1000
+
+# 连接池大小
+DEFAULT_POOL_SIZE = 10
+
+# 重复键错误码，插入模式下重复导入的行被忽略
+DUPLICATE_KEY_ERROR = 11000
+
+# CSV中的时间戳格式
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# 流水线导入时解析进程与写入线程之间队列的最大批次数
+DEFAULT_QUEUE_SIZE = 8
+
+# 主线程等待解析结果的超时秒数，超时后检查解析进程是否异常退出
+QUEUE_POLL_SECONDS = 5
+
+def connect_mongodb(uri="mongodb://localhost:27017/", db_name="log-analysis", pool_size=DEFAULT_POOL_SIZE):
+    """连接到MongoDB数据库，所有批次共用一个带连接池的客户端"""
     try:
-        client = pymongo.MongoClient(uri)
+        client = pymongo.MongoClient(uri, maxPoolSize=pool_size)
         db = client[db_name]
         print(f"成功连接到MongoDB: {db_name}")
         return db
@@ -18,92 +52,484 @@ def connect_mongodb(uri="mongodb://localhost:27017/", db_name="log-analysis"):
         print(f"连接MongoDB失败: {e}")
         sys.exit(1)
 
-def import_openstack_logs(db, csv_path):
-    """从CSV文件导入OpenStack日志到MongoDB"""
-    collection = db.logs
-    
-    # 检查是否需要删除已有的OpenStack日志
-    existing_logs = collection.count_documents({"service": "openstack-service"})
-    if existing_logs > 0:
-        confirm = input(f"发现{existing_logs}条OpenStack日志记录，是否删除? (y/n): ")
-        if confirm.lower() == 'y':
-            collection.delete_many({"service": "openstack-service"})
-            print(f"已删除{existing_logs}条OpenStack日志记录")
-    
-    # 读取CSV文件并导入数据
-    logs_to_insert = []
+def content_hash(row):
+    """CSV行内容的哈希，作为幂等导入的键，重复导入同一行不会产生重复文档"""
+    text = json.dumps(row, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def template_key(message):
+    """
+    日志模板的稳定键: 去掉实例标记并替换变量后的消息的哈希
+    只取决于消息内容，与导入顺序和导入批次无关，不同次导入的相同模板有相同的键
+    """
+    return hashlib.sha1(mask_log(strip_prefix(message)).encode('utf-8')).hexdigest()[:16]
+
+def parse_timestamps(values):
+    """按固定格式向量化解析一列时间戳，无法解析的为None"""
+    parsed = pd.to_datetime(pd.Series(values, dtype=object), format=TIMESTAMP_FORMAT, errors='coerce')
+    return [None if pd.isna(timestamp) else timestamp.to_pydatetime() for timestamp in parsed]
+
+def build_log_doc(row, imported_at, timestamp=None):
+    """把一行CSV转换为日志文档，timestamp为已解析的时间戳时不再逐行解析"""
+    # 转换日期时间字符串为MongoDB日期对象
+    if timestamp is None:
+        try:
+            timestamp = datetime.strptime(row['timestamp'], TIMESTAMP_FORMAT)
+        except ValueError:
+            print(f"警告: 无法解析时间戳 '{row['timestamp']}'，使用当前时间")
+            timestamp = datetime.now()
+
+    component = row.get('component', 'unknown')
+
+    # 构建日志文档
+    log_doc = {
+        "timestamp": timestamp,
+        "service": "openstack-service",
+        "component": component,
+        "level": row.get('level', 'INFO'),
+        "message": row.get('message', ''),
+        "requestId": row.get('request_id', f"req-{timestamp.strftime('%Y%m%d%H%M%S')}"),
+        "sourceIp": row.get('source_ip', '127.0.0.1'),
+        "status": row.get('status', 'unknown'),
+        "isRecent": True,
+        "importedAt": imported_at,
+        "details": {
+            "instanceId": row.get('instance_id', ''),
+            "userId": row.get('user_id', ''),
+            "projectId": row.get('project_id', ''),
+            "resourceType": row.get('resource_type', ''),
+            "resourceId": row.get('resource_id', ''),
+            "errorCode": row.get('error_code', '')
+        },
+        "originalService": row.get('original_service', ''),
+        "stackTrace": row.get('stack_trace', ''),
+        "templateKey": template_key(row.get('message', '')),
+        "contentHash": content_hash(row)
+    }
+
+    # 如果CSV中没有stack_trace字段，但有message字段，则生成一个模拟的堆栈跟踪
+    if not row.get('stack_trace') and row.get('message'):
+        log_doc["stackTrace"] = f"Error: {row.get('message')}\n"
+        log_doc["stackTrace"] += f"at {component}.process ({component}.py:120)\n"
+        log_doc["stackTrace"] += f"at OpenStack.API.call (API.py:85)\n"
+        log_doc["stackTrace"] += f"at Client.request (client.py:245)"
+
+    # 如果CSV中没有summary字段，则生成一个摘要
+    if not row.get('summary'):
+        log_doc["summary"] = f"OpenStack {component} 服务出现 {row.get('level')} 级别问题: {row.get('message')}。可能与资源分配或状态同步有关。"
+    else:
+        log_doc["summary"] = row.get('summary')
+
+    return log_doc
+
+def read_batches(csv_path, batch_size):
+    """用csv.DictReader流式读取，每次返回batch_size行"""
     with open(csv_path, 'r', encoding='utf-8') as file:
         reader = csv.DictReader(file)
-        for row in reader:
-            # 转换日期时间字符串为MongoDB日期对象
-            try:
-                timestamp = datetime.strptime(row['timestamp'], "%Y-%m-%d %H:%M:%S")
-            except ValueError:
-                print(f"警告: 无法解析时间戳 '{row['timestamp']}'，使用当前时间")
-                timestamp = datetime.now()
-            
-            # 构建日志文档
-            log_doc = {
-                "timestamp": timestamp,
-                "service": "openstack-service",
-                "component": row.get('component', 'unknown'),
-                "level": row.get('level', 'INFO'),
-                "message": row.get('message', ''),
-                "requestId": row.get('request_id', f"req-{timestamp.strftime('%Y%m%d%H%M%S')}"),
-                "sourceIp": row.get('source_ip', '127.0.0.1'),
-                "status": row.get('status', 'unknown'),
-                "isRecent": True,
-                "importedAt": datetime.now(),
-                "details": {
-                    "instanceId": row.get('instance_id', ''),
-                    "userId": row.get('user_id', ''),
-                    "projectId": row.get('project_id', ''),
-                    "resourceType": row.get('resource_type', ''),
-                    "resourceId": row.get('resource_id', ''),
-                    "errorCode": row.get('error_code', '')
-                },
-                "originalService": row.get('original_service', ''),
-                "stackTrace": row.get('stack_trace', '')
+        while True:
+            rows = list(islice(reader, batch_size))
+            if not rows:
+                break
+            yield rows
+
+def write_batch(collection, log_docs, upsert=True):
+    """
+    无序批量写入一批文档，返回新写入的文档数
+    upsert模式按contentHash写入不存在的文档；插入模式直接insert_many，已存在的行（重复键）被跳过
+    """
+    if upsert:
+        requests = [UpdateOne({"contentHash": log_doc["contentHash"]}, {"$setOnInsert": log_doc}, upsert=True)
+                    for log_doc in log_docs]
+        result = collection.bulk_write(requests, ordered=False)
+        return result.upserted_count
+    try:
+        result = collection.insert_many(log_docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+            raise
+        return e.details['nInserted']
+
+def prepare_collection(collection, replace=False):
+    """replace为True时先删除已有的OpenStack日志，并建立contentHash索引"""
+    if replace:
+        result = collection.delete_many({"service": "openstack-service"})
+        print(f"已删除{result.deleted_count}条OpenStack日志记录")
+
+    # contentHash上的唯一索引，用于upsert查找和插入模式的去重；只约束带contentHash的文档
+    collection.create_index("contentHash", unique=True,
+                            partialFilterExpression={"contentHash": {"$exists": True}})
+    # 汇总任务按导入批次查找尚未完成的导入写入的第一条日志
+    collection.create_index([("importedAt", 1), ("_id", 1)])
+
+def start_import_run(db, imported_at, replace=False):
+    """
+    在import_runs中登记一次导入，返回登记的_id；导入完成前汇总任务不会越过本次写入的日志
+    replace为True表示本次导入会删除已有的OpenStack日志，汇总任务等导入完成后重新计算全部汇总
+    在删除日志之前登记，汇总任务不会错过删除
+    """
+    now = datetime.now()
+    run_id = ObjectId()
+    db.import_runs.insert_one({"_id": run_id, "importedAt": imported_at, "replace": replace,
+                               "startedAt": now, "updatedAt": now, "finished": False})
+    return run_id
+
+def touch_import_run(db, run_id):
+    """更新导入的心跳时间，长时间没有心跳的未完成导入被汇总任务视为已中断"""
+    db.import_runs.update_one({"_id": run_id}, {"$set": {"updatedAt": datetime.now()}})
+
+def finish_import_run(db, run_id):
+    now = datetime.now()
+    db.import_runs.update_one({"_id": run_id}, {"$set": {"updatedAt": now, "finishedAt": now, "finished": True}})
+
+def update_templates(collection, miner, template_counts, key_clusters, imported_at):
+    """
+    模板文本在所有日志处理完后才稳定，最后按模板键更新本次新写入（importedAt相同）的文档
+    key_clusters: 模板键 -> 本次导入的模板树中的模板ID；模板ID只用于本次导入内的统计，不写入文档
+    """
+    template_updates = [UpdateMany({"service": "openstack-service", "importedAt": imported_at,
+                                    "templateKey": key},
+                                   {"$set": {"template": miner.template(cluster_id)}})
+                        for key, cluster_id in key_clusters.items()]
+    if template_updates:
+        collection.bulk_write(template_updates, ordered=False)
+
+    print(f"共 {len(template_counts)} 个日志模板，出现最多的模板:")
+    for template_id, count in template_counts.most_common(5):
+        print(f"  [{count}] {miner.template(template_id)}")
+
+def read_nova_batches(log_paths, batch_size):
+    """
+    用nova_log_parser流式解析原始nova日志，转换为与CSV相同字段的行，每次返回batch_size个 (行, 时间戳)
+    行中保留源文件和进程号，不同文件中内容相同的日志行有不同的contentHash
+    """
+    batch = []
+    for log_path in log_paths:
+        for record in parse_file(log_path):
+            module_parts = record.module.split('.')
+            row = {
+                "timestamp": format_timestamp(record.timestamp),
+                "component": module_parts[1] if len(module_parts) > 1 else record.module,
+                "level": record.level.name,
+                "message": record.message,
+                "request_id": record.request_id or '',
+                "status": record.level.name.lower(),
+                "instance_id": record.instance_id or '',
+                "original_service": module_parts[0],
+                "module": record.module,
+                "pid": record.pid,
+                "source_file": record.file or os.path.basename(log_path)
             }
-            
-            # 如果CSV中没有stack_trace字段，但有message字段，则生成一个模拟的堆栈跟踪
-            if not row.get('stack_trace') and row.get('message'):
-                component = row.get('component', 'unknown')
-                log_doc["stackTrace"] = f"Error: {row.get('message')}\n"
-                log_doc["stackTrace"] += f"at {component}.process ({component}.py:120)\n"
-                log_doc["stackTrace"] += f"at OpenStack.API.call (API.py:85)\n"
-                log_doc["stackTrace"] += f"at Client.request (client.py:245)"
-            
-            # 如果CSV中没有summary字段，则生成一个摘要
-            if not row.get('summary'):
-                log_doc["summary"] = f"OpenStack {component} 服务出现 {row.get('level')} 级别问题: {row.get('message')}。可能与资源分配或状态同步有关。"
-            else:
-                log_doc["summary"] = row.get('summary')
-            
-            logs_to_insert.append(log_doc)
-    
-    # 批量插入数据
-    if logs_to_insert:
-        result = collection.insert_many(logs_to_insert)
-        print(f"成功导入 {len(result.inserted_ids)} 条OpenStack日志记录")
-    else:
-        print("CSV文件中没有有效的日志记录")
+            timestamp = datetime(1970, 1, 1) + timedelta(microseconds=record.timestamp // 1000)
+            batch.append((row, timestamp))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def import_nova_logs(db, log_paths, batch_size=DEFAULT_BATCH_SIZE, replace=False, upsert=True):
+    """直接从原始nova日志文件流式导入，不需要先转换为CSV"""
+    import_openstack_logs(db, None, batch_size=batch_size, replace=replace, upsert=upsert,
+                          batches=read_nova_batches(log_paths, batch_size))
+
+def import_openstack_logs(db, csv_path, batch_size=DEFAULT_BATCH_SIZE, replace=False, upsert=True, batches=None):
+    """
+    从CSV文件流式导入OpenStack日志到MongoDB
+    每读取batch_size行写入一批，内存占用与文件大小无关；按内容哈希幂等导入，重复运行不会产生重复文档
+    replace为True时先删除已有的OpenStack日志
+    batches: 可选的 [(行, 已解析的时间戳)] 批次迭代器，代替从csv_path读取
+    """
+    collection = db.logs
+    if batches is None:
+        batches = ([(row, None) for row in rows] for rows in read_batches(csv_path, batch_size))
+    imported_at = datetime.now()
+    run_id = start_import_run(db, imported_at, replace)
+    prepare_collection(collection, replace)
+
+    miner = TemplateMiner()
+    template_counts = Counter()
+    key_clusters = {}
+    total_rows = 0
+    written = 0
+    start_time = time.time()
+    for rows in batches:
+        log_docs = []
+        for row, timestamp in rows:
+            log_doc = build_log_doc(row, imported_at, timestamp)
+            # 模板树给出可读的模板文本，文档按稳定的模板键分组
+            template_id = miner.add_log(log_doc["message"])
+            template_counts[template_id] += 1
+            key_clusters[log_doc["templateKey"]] = template_id
+            log_doc["template"] = miner.template(template_id)
+            log_docs.append(log_doc)
+
+        written += write_batch(collection, log_docs, upsert=upsert)
+        touch_import_run(db, run_id)
+        total_rows += len(rows)
+        elapsed = time.time() - start_time
+        print(f"已处理 {total_rows} 行，新写入 {written} 条，{total_rows / max(elapsed, 1e-9):.0f} 行/秒")
+
+    if not total_rows:
+        finish_import_run(db, run_id)
+        print("没有有效的日志记录")
+        return
+
+    update_templates(collection, miner, template_counts, key_clusters, imported_at)
+    finish_import_run(db, run_id)
+
+    elapsed = time.time() - start_time
+    print(f"成功导入 {written} 条OpenStack日志记录（共 {total_rows} 行，{total_rows - written} 行已存在），"
+          f"用时 {elapsed:.2f} 秒，{total_rows / max(elapsed, 1e-9):.0f} 行/秒")
+
+class ImportCheckpoint:
+    """
+    每个CSV文件已连续写入的行数，保存在JSON文件中
+    写入线程完成批次的顺序不固定，只有某行之前的批次全部写入后检查点才前进到该行；
+    中断后重新导入时从检查点继续，文件修改过则从头导入（由contentHash去重）
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # 绝对路径 -> {size, mtime_ns, rows}
+        self._completed = {}  # 绝对路径 -> {批次起始行: 批次结束行}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.files = json.load(f)
+
+    def start_row(self, csv_path):
+        """从第几行继续导入"""
+        key = os.path.abspath(csv_path)
+        stat = os.stat(csv_path)
+        entry = self.files.get(key)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'rows': 0}
+            self.files[key] = entry
+        self._completed[key] = {}
+        return entry['rows']
+
+    def done(self, csv_path, start_row, end_row):
+        """记录 [start_row, end_row) 已写入，并把检查点推进到连续写入的位置"""
+        key = os.path.abspath(csv_path)
+        with self._lock:
+            entry = self.files[key]
+            completed = self._completed[key]
+            completed[start_row] = end_row
+            while entry['rows'] in completed:
+                entry['rows'] = completed.pop(entry['rows'])
+            self.save()
+
+    def reset(self):
+        self.files = {}
+
+    def save(self):
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.files, f)
+        os.replace(tmp_file, self.path)
+
+def parse_worker(task_queue, batch_queue, batch_size, imported_at):
+    """
+    解析进程: 从task_queue取 (CSV路径, 起始行)，用pandas分块读取并向量化解析时间戳，
+    把 (路径, 起始行, 结束行, 文档列表) 放入有界的batch_queue；文件结束时放入文档为None的标记
+    """
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        csv_path, start_row = task
+        offset = 0
+        try:
+            reader = pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=batch_size, encoding='utf-8')
+            for chunk in reader:
+                chunk_start, offset = offset, offset + len(chunk)
+                # 检查点之前的行已写入
+                if offset <= start_row:
+                    continue
+                if chunk_start < start_row:
+                    chunk = chunk.iloc[start_row - chunk_start:]
+                    chunk_start = start_row
+                timestamps = parse_timestamps(chunk['timestamp'])
+                log_docs = []
+                for row, timestamp in zip(chunk.to_dict('records'), timestamps):
+                    if timestamp is None:
+                        print(f"警告: 无法解析时间戳 '{row['timestamp']}'，使用当前时间")
+                        timestamp = datetime.now()
+                    log_docs.append(build_log_doc(row, imported_at, timestamp))
+                batch_queue.put((csv_path, chunk_start, offset, log_docs))
+        except Exception as e:
+            print(f"解析 {csv_path} 时出错: {e}")
+        batch_queue.put((csv_path, None, None, None))
+
+def import_openstack_logs_parallel(db, csv_paths, batch_size=DEFAULT_BATCH_SIZE, parsers=2, writers=4,
+                                   queue_size=DEFAULT_QUEUE_SIZE, checkpoint_file="import_checkpoint.json",
+                                   replace=False, upsert=True):
+    """
+    流水线导入多个CSV文件
+    parsers个解析进程 -> 有界队列 -> 主线程分配模板ID -> 有界队列 -> writers个写入线程；
+    每批写入后更新检查点，中断后重新运行从检查点继续，已写入的批次不会重复
+    """
+    collection = db.logs
+    imported_at = datetime.now()
+    run_id = start_import_run(db, imported_at, replace)
+    prepare_collection(collection, replace)
+
+    checkpoint = ImportCheckpoint(checkpoint_file)
+    if replace:
+        checkpoint.reset()
+
+    context = multiprocessing.get_context()
+    task_queue = context.Queue()
+    batch_queue = context.Queue(maxsize=queue_size)
+    for csv_path in csv_paths:
+        start_row = checkpoint.start_row(csv_path)
+        if start_row:
+            print(f"{csv_path}: 从检查点第 {start_row} 行继续导入")
+        task_queue.put((csv_path, start_row))
+    for _ in range(parsers):
+        task_queue.put(None)
+    processes = [context.Process(target=parse_worker, args=(task_queue, batch_queue, batch_size, imported_at),
+                                 daemon=True)
+                 for _ in range(parsers)]
+    for process in processes:
+        process.start()
+
+    write_queue = queue.Queue(maxsize=queue_size)
+    stats = {'written': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+
+    def write_worker():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            csv_path, start_row, end_row, log_docs = item
+            try:
+                written = write_batch(collection, log_docs, upsert=upsert)
+            except Exception as e:
+                # 检查点不越过失败的批次，重新运行时会重试
+                print(f"写入 {csv_path} 第 {start_row}-{end_row} 行时出错: {e}")
+                with stats_lock:
+                    stats['failed'] += len(log_docs)
+                continue
+            with stats_lock:
+                stats['written'] += written
+            checkpoint.done(csv_path, start_row, end_row)
+
+    threads = [threading.Thread(target=write_worker, daemon=True) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+
+    miner = TemplateMiner()
+    template_counts = Counter()
+    key_clusters = {}
+    total_rows = 0
+    start_time = time.time()
+    remaining = len(csv_paths)
+    while remaining:
+        try:
+            csv_path, start_row, end_row, log_docs = batch_queue.get(timeout=QUEUE_POLL_SECONDS)
+        except queue.Empty:
+            # 解析进程被杀死（如OOM）时不会放入文件结束标记，不能无限等待
+            failed = [process for process in processes if process.exitcode not in (None, 0)]
+            if not failed and any(process.is_alive() for process in processes):
+                continue
+            for process in processes:
+                process.terminate()
+            # 已分配的批次写完，检查点停在失败位置之前，重新运行时从检查点继续
+            for _ in threads:
+                write_queue.put(None)
+            for thread in threads:
+                thread.join()
+            exit_codes = ', '.join(str(process.exitcode) for process in failed) or '0'
+            raise RuntimeError(f"解析进程异常退出（退出码 {exit_codes}），还有 {remaining} 个文件未解析完")
+        if log_docs is None:
+            remaining -= 1
+            continue
+        # 模板树是有状态的，在主线程中按顺序加入，给出模板文本
+        for log_doc in log_docs:
+            template_id = miner.add_log(log_doc["message"])
+            template_counts[template_id] += 1
+            key_clusters[log_doc["templateKey"]] = template_id
+            log_doc["template"] = miner.template(template_id)
+        write_queue.put((csv_path, start_row, end_row, log_docs))
+        touch_import_run(db, run_id)
+        total_rows += len(log_docs)
+        elapsed = time.time() - start_time
+        print(f"已处理 {total_rows} 行，新写入 {stats['written']} 条，{total_rows / max(elapsed, 1e-9):.0f} 行/秒")
+
+    for _ in threads:
+        write_queue.put(None)
+    for thread in threads:
+        thread.join()
+    for process in processes:
+        process.join()
+
+    if not total_rows:
+        finish_import_run(db, run_id)
+        print("没有需要导入的日志记录")
+        return
+
+    update_templates(collection, miner, template_counts, key_clusters, imported_at)
+    finish_import_run(db, run_id)
+
+    elapsed = time.time() - start_time
+    print(f"成功导入 {stats['written']} 条OpenStack日志记录（共 {total_rows} 行，失败 {stats['failed']} 行），"
+          f"用时 {elapsed:.2f} 秒，{total_rows / max(elapsed, 1e-9):.0f} 行/秒")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='导入OpenStack日志CSV到MongoDB')
+    parser.add_argument('csv_paths', nargs='+', help='CSV文件路径，可以有多个；最后一个参数可以是MongoDB连接URI')
+    parser.add_argument('--raw', action='store_true',
+                        help='输入是原始nova日志文件（nova-*.log）而不是CSV')
+    parser.add_argument('--uri', default="mongodb://localhost:27017/", help='MongoDB连接URI')
+    parser.add_argument('--db', default="log-analysis", help='数据库名称')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='每批写入的文档数')
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE,
+                        help='MongoDB连接池大小')
+    parser.add_argument('--replace', action='store_true',
+                        help='导入前删除已有的OpenStack日志（不再交互确认）')
+    parser.add_argument('--insert', action='store_true',
+                        help='使用insert_many代替upsert，已存在的行按重复键跳过')
+    parser.add_argument('--parsers', type=int, default=0,
+                        help='流水线导入的解析进程数，0表示在当前进程中逐个文件导入')
+    parser.add_argument('--writers', type=int, default=4,
+                        help='流水线导入的写入线程数')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='流水线中等待写入的最大批次数')
+    parser.add_argument('--checkpoint', default="import_checkpoint.json",
+                        help='流水线导入的检查点文件，中断后从检查点继续')
+    args = parser.parse_args()
+    # 兼容旧用法: python import_openstack_logs.py <csv_file_path> [mongodb_uri]
+    if len(args.csv_paths) > 1 and args.csv_paths[-1].startswith('mongodb'):
+        args.uri = args.csv_paths.pop()
+    return args
 
 def main():
-    if len(sys.argv) < 2:
-        print("使用方法: python import_openstack_logs.py <csv_file_path> [mongodb_uri]")
-        sys.exit(1)
-    
-    csv_path = sys.argv[1]
-    mongodb_uri = sys.argv[2] if len(sys.argv) > 2 else "mongodb://localhost:27017/"
-    
+    args = parse_args()
+
     # 连接MongoDB
-    db = connect_mongodb(mongodb_uri)
-    
+    db = connect_mongodb(args.uri, args.db, pool_size=args.pool_size)
+
     # 导入日志
-    import_openstack_logs(db, csv_path)
+    if args.raw:
+        import_nova_logs(db, args.csv_paths, batch_size=args.batch_size, replace=args.replace,
+                         upsert=not args.insert)
+    elif args.parsers > 0:
+        import_openstack_logs_parallel(db, args.csv_paths, batch_size=args.batch_size, parsers=args.parsers,
+                                       writers=args.writers, queue_size=args.queue_size,
+                                       checkpoint_file=args.checkpoint, replace=args.replace,
+                                       upsert=not args.insert)
+    else:
+        for i, csv_path in enumerate(args.csv_paths):
+            import_openstack_logs(db, csv_path, batch_size=args.batch_size, replace=args.replace and i == 0,
+                                  upsert=not args.insert)
 
 if __name__ == "__main__":
-    main() 
+    main()
 
-# python import_openstack_logs.py openstack_logs.csv mongodb://localhost:27017/
\ No newline at end of file
+# python import_openstack_logs.py openstack_logs.csv mongodb://localhost:27017/ --batch-size 1000 --replace
+# python import_openstack_logs.py logs/*.csv --uri mongodb://localhost:27017/ --parsers 4 --writers 8
+# python import_openstack_logs.py LogRCA/OpenStack/*.log --raw --uri mongodb://localhost:27017/
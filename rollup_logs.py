@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from pymongo.operations import UpdateOne
+
+# 时间桶粒度 -> 截断函数
+GRANULARITIES = {
+    "1m": lambda t: t.replace(second=0, microsecond=0),
+    "1h": lambda t: t.replace(minute=0, second=0, microsecond=0),
+    "1d": lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+# 每次从logs读取并写入汇总的日志数
+DEFAULT_CHUNK_SIZE = 50000
+
+# 只汇总_id时间早于当前时间减去该秒数的日志，避免漏掉其他写入方仍在写入、_id稍小的文档
+DEFAULT_LAG_SECONDS = 60
+
+# 导入脚本登记的未完成导入超过该秒数没有心跳时视为已中断，不再阻止汇总前进
+DEFAULT_STALE_IMPORT_SECONDS = 3600
+
+# 重复键错误码，汇总文档已包含本批计数时upsert插入失败
+DUPLICATE_KEY_ERROR = 11000
+
+STATE_ID = "logs"
+
+def connect_mongodb(uri="mongodb://localhost:27017/", db_name="log-analysis"):
+    """连接到MongoDB数据库"""
+    try:
+        client = pymongo.MongoClient(uri)
+        db = client[db_name]
+        print(f"成功连接到MongoDB: {db_name}")
+        return db
+    except Exception as e:
+        print(f"连接MongoDB失败: {e}")
+        sys.exit(1)
+
+def log_dimensions(log):
+    """
+    一条日志参与计数的维度: 总数、服务、级别、虚拟机和模板
+    模板按导入时写入的templateKey计数，不随模板文本在导入结束时的改写而变化
+    """
+    details = log.get("details") or {}
+    yield "all", "all"
+    yield "service", log.get("service") or "unknown"
+    yield "level", log.get("level") or "unknown"
+    vm_id = log.get("vm_id") or details.get("instanceId")
+    if vm_id:
+        yield "vm", vm_id
+    if log.get("templateKey"):
+        yield "template", log["templateKey"]
+
+def count_chunk(logs):
+    """
+    统计一批日志，返回 (计数, 最后一条日志的_id)
+    计数的键为 (粒度, 时间桶, 维度, 值)
+    """
+    counts = Counter()
+    last_id = None
+    for log in logs:
+        last_id = log["_id"]
+        timestamp = log.get("timestamp")
+        if not isinstance(timestamp, datetime):
+            continue
+        dimensions = list(log_dimensions(log))
+        for granularity, truncate in GRANULARITIES.items():
+            bucket = truncate(timestamp)
+            for dimension, value in dimensions:
+                counts[(granularity, bucket, dimension, value)] += 1
+    return counts, last_id
+
+def apply_counts(rollups, counts, chunk_end):
+    """
+    把一批计数累加到汇总集合
+    每个汇总文档记录已累加到的最后一条日志_id（watermark），只有watermark小于本批末尾时才累加；
+    已累加过的文档不匹配过滤条件，upsert插入因唯一索引失败而被忽略，中断后重跑同一批不会重复计数
+    """
+    requests = [
+        UpdateOne({"granularity": granularity, "bucket": bucket, "dimension": dimension, "value": value,
+                   "watermark": {"$lt": chunk_end}},
+                  {"$inc": {"count": count}, "$set": {"watermark": chunk_end}},
+                  upsert=True)
+        for (granularity, bucket, dimension, value), count in counts.items()
+    ]
+    if not requests:
+        return
+    try:
+        rollups.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+            raise
+
+def is_stale(run, stale_seconds):
+    """超过stale_seconds没有心跳的未完成导入视为已中断"""
+    stale_before = datetime.now() - timedelta(seconds=stale_seconds)
+    return not run["finished"] and run.get("updatedAt") is not None and run["updatedAt"] < stale_before
+
+def pending_replace_runs(db, stale_seconds=DEFAULT_STALE_IMPORT_SECONDS):
+    """
+    删除过已有日志、汇总尚未因此重新计算的导入，返回 (仍在进行的, 已结束的)
+    删除的日志已经计入汇总，_id更大的重新导入的日志会被再次计数，只能清空汇总重新计算
+    """
+    running, finished = [], []
+    for run in db.import_runs.find({"replace": True, "rollupRebuilt": {"$ne": True}}):
+        if run["finished"] or is_stale(run, stale_seconds):
+            finished.append(run["_id"])
+        else:
+            running.append(run["_id"])
+    return running, finished
+
+def pending_import_bound(db, stale_seconds=DEFAULT_STALE_IMPORT_SECONDS):
+    """
+    尚未完成的导入写入的第一条日志_id，没有时为None
+    导入脚本在import_runs中登记每次导入（带importedAt），完成后标记finished；
+    汇总不越过仍在进行的导入写入的日志，无论导入用时多长。超过stale_seconds没有心跳的导入视为已中断
+    """
+    bound = None
+    for run in db.import_runs.find({"finished": False}):
+        if is_stale(run, stale_seconds):
+            print(f"警告: {run['startedAt']} 开始的导入超过 {stale_seconds} 秒没有更新，视为已中断")
+            continue
+        first = db.logs.find_one({"importedAt": run["importedAt"]}, {"_id": 1}, sort=[("_id", 1)])
+        if first is not None and (bound is None or first["_id"] < bound):
+            bound = first["_id"]
+    return bound
+
+def rollup_logs(db, chunk_size=DEFAULT_CHUNK_SIZE, lag_seconds=DEFAULT_LAG_SECONDS, rebuild=False,
+                stale_import_seconds=DEFAULT_STALE_IMPORT_SECONDS):
+    """
+    增量汇总logs集合到log_rollups
+    rollup_state中保存已汇总的最后一条日志_id，每次运行只读取其后的新日志；rebuild为True时清空汇总重新计算。
+    watermark只前进到尚未完成的导入写入的第一条日志之前，之后的日志在导入完成后的运行中汇总。
+    有删除已有日志（--replace）的导入时: 导入进行中不汇总，导入结束后的第一次运行自动重新计算
+    """
+    logs = db.logs
+    rollups = db.log_rollups
+    state = db.rollup_state
+
+    running_replaces, finished_replaces = pending_replace_runs(db, stale_import_seconds)
+    if running_replaces:
+        print("有删除已有日志的导入正在进行，等导入完成后再汇总")
+        return 0
+    if finished_replaces:
+        print("已有日志在上次汇总后被删除并重新导入，重新计算全部汇总")
+        rebuild = True
+
+    if rebuild:
+        rollups.delete_many({})
+        state.delete_one({"_id": STATE_ID})
+        print("已清空汇总数据")
+
+    rollups.create_index([("dimension", 1), ("granularity", 1), ("value", 1), ("bucket", 1)], unique=True)
+
+    saved = state.find_one({"_id": STATE_ID})
+    watermark = saved["lastId"] if saved else None
+    upper = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=lag_seconds))
+    pending = pending_import_bound(db, stale_import_seconds)
+    if pending is not None and pending < upper:
+        upper = pending
+        print(f"有尚未完成的导入，只汇总到 {pending} 之前")
+    print(f"从 {watermark or '头'} 开始汇总")
+
+    total = 0
+    start_time = time.time()
+    while True:
+        id_range = {"$lt": upper}
+        if watermark is not None:
+            id_range["$gt"] = watermark
+        cursor = logs.find({"_id": id_range},
+                           {"timestamp": 1, "service": 1, "level": 1, "vm_id": 1, "details.instanceId": 1,
+                            "templateKey": 1}).sort("_id", 1).limit(chunk_size)
+        counts, last_id = count_chunk(cursor)
+        if last_id is None:
+            break
+        apply_counts(rollups, counts, last_id)
+        state.update_one({"_id": STATE_ID}, {"$set": {"lastId": last_id, "updatedAt": datetime.now()}}, upsert=True)
+        watermark = last_id
+        total += sum(count for (granularity, _, dimension, _), count in counts.items()
+                     if granularity == "1d" and dimension == "all")
+        elapsed = time.time() - start_time
+        print(f"已汇总 {total} 条日志，{total / max(elapsed, 1e-9):.0f} 条/秒")
+
+    if finished_replaces:
+        db.import_runs.update_many({"_id": {"$in": finished_replaces}}, {"$set": {"rollupRebuilt": True}})
+    print(f"汇总完成，本次新增 {total} 条日志，用时 {time.time() - start_time:.2f} 秒")
+    return total
+
+def query_counts(db, dimension, granularity="1h", start=None, end=None, value=None):
+    """
+    从汇总集合读取计数，返回按时间桶排序的 [{bucket, value, count}]
+    查询代价与时间桶数成正比，与日志条数无关
+    """
+    query = {"dimension": dimension, "granularity": granularity}
+    if value is not None:
+        query["value"] = value
+    if start or end:
+        query["bucket"] = {}
+        if start:
+            query["bucket"]["$gte"] = GRANULARITIES[granularity](start)
+        if end:
+            query["bucket"]["$lte"] = end
+    return [{"bucket": doc["bucket"], "value": doc["value"], "count": doc["count"]}
+            for doc in db.log_rollups.find(query).sort("bucket", 1)]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='增量汇总日志计数（按服务、级别、虚拟机和模板，1m/1h/1d时间桶）')
+    parser.add_argument('mongodb_uri', nargs='?', default="mongodb://localhost:27017/", help='MongoDB连接URI')
+    parser.add_argument('--db', default="log-analysis", help='数据库名称')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='每批汇总的日志数')
+    parser.add_argument('--lag', type=int, default=DEFAULT_LAG_SECONDS,
+                        help='只汇总写入时间早于该秒数之前的日志')
+    parser.add_argument('--stale-import', type=int, default=DEFAULT_STALE_IMPORT_SECONDS,
+                        help='未完成的导入超过该秒数没有更新时视为已中断，不再等待')
+    parser.add_argument('--rebuild', action='store_true', help='清空汇总数据后重新计算')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    db = connect_mongodb(args.mongodb_uri, args.db)
+    rollup_logs(db, chunk_size=args.chunk_size, lag_seconds=args.lag, rebuild=args.rebuild,
+                stale_import_seconds=args.stale_import)
+
+if __name__ == "__main__":
+    main()
+
+# python rollup_logs.py mongodb://localhost:27017/ --chunk-size 50000